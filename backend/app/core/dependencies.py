@@ -50,3 +50,17 @@ async def get_current_user(
         raise credentials_exception
 
     return user
+
+
+async def get_current_admin_user(
+        current_user=Depends(get_current_user)
+):
+    """
+    Проверяет, что текущий пользователь является администратором.
+    """
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Недостаточно прав"
+        )
+    return current_user
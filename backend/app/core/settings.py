@@ -41,6 +41,73 @@ class Settings(BaseSettings):
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 8  # 8 дней
 
+    # Потоковая передача ответов (SSE)
+    SSE_REPLAY_BUFFER_SIZE: int = 2000  # Максимум событий в буфере одной генерации
+    SSE_REPLAY_TTL_SECONDS: int = 300  # Сколько хранить буфер после завершения генерации
+    SSE_REPLAY_MAX_BYTES: int = 32 * 1024 * 1024  # Общий лимит памяти буферов в одном воркере
+    SSE_FLUSH_INTERVAL_MS: int = 50  # Окно склейки текстовых кусков в одно событие (0 - без склейки)
+    SSE_FLUSH_MAX_BYTES: int = 4096  # Событие отправляется сразу, если накоплено столько байт текста
+
+    # Провайдеры AI и общий HTTP пул соединений
+    OPENAI_BASE_URL: str = "https://api.openai.com/v1"
+    ANTHROPIC_BASE_URL: str = "https://api.anthropic.com"
+    ANTHROPIC_PROMPT_CACHE_ENABLED: bool = True  # Расставлять точки кэширования промпта (cache_control)
+    ANTHROPIC_PROMPT_CACHE_MIN_CHARS: int = 4096  # Минимальная длина кэшируемого префикса (~1024 токена)
+    HTTP_POOL_MAX_CONNECTIONS: int = 200  # Максимум соединений к одному провайдеру в воркере
+    HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS: int = 50  # Сколько простаивающих соединений держать открытыми
+    HTTP_POOL_KEEPALIVE_EXPIRY: float = 60.0  # Время жизни простаивающего соединения, сек
+    HTTP_CONNECT_TIMEOUT: float = 10.0
+    HTTP_READ_TIMEOUT: float = 600.0
+    RATE_LIMIT_MAX_WAIT_SECONDS: float = 30.0  # Максимальное ожидание свободного места в лимитах ключа, сек
+
+    # Кэш ответов AI (точное совпадение запроса)
+    COMPLETION_CACHE_MAX_SIZE: int = 1000  # Записей в памяти процесса
+    COMPLETION_CACHE_TTL_SECONDS: int = 7 * 24 * 3600  # Время жизни ответа в кэше
+
+    # Поиск похожих запросов для кэша ответов (MinHash/LSH)
+    NEAR_DUPLICATE_SIMILARITY: float = 0.8  # Минимальное сходство запросов (оценка Жаккара)
+    NEAR_DUPLICATE_NUM_PERM: int = 64  # Длина MinHash сигнатуры
+    NEAR_DUPLICATE_MAX_CHARS: int = 4000  # Учитываемый хвост текста запроса в символах
+    NEAR_DUPLICATE_LSH_ROWS: int = 4  # Значений сигнатуры в одной полосе LSH
+    NEAR_DUPLICATE_MAX_ENTRIES: int = 200  # Запросов в индексе одного пользователя и модели
+    NEAR_DUPLICATE_MAX_INDEXES: int = 1000  # Индексов (пар пользователь, модель) в памяти процесса
+
+    # Упаковка контекста
+    CONTEXT_OVERFLOW_POLICY: str = "trim"  # trim - обрезать не помещающееся сообщение, reject - отклонить запрос
+
+    # Кэш контекстов тредов
+    THREAD_CONTEXT_CACHE_MAX_SIZE: int = 1000  # Тредов в памяти процесса
+
+    # Подсчет токенов
+    TOKEN_COUNT_OFFLOAD_CHARS: int = 16384  # Больший объем токенизируется в пуле потоков
+    TOKEN_COUNT_BATCH_MAX_ITEMS: int = 256  # Максимум текстов и наборов сообщений в одном запросе
+    TOKEN_ESTIMATOR_MIN_SAMPLES: int = 50  # Меньше сообщений модели - используются общие коэффициенты
+    TOKEN_ESTIMATOR_PRIOR_CHARS: int = 2000  # Вес коэффициентов по умолчанию при подборе, в символах
+    TOKEN_ESTIMATOR_MAX_SAMPLES: int = 50000  # Сколько последних сообщений использует подбор коэффициентов
+
+    # Краткое содержание длинных тредов (пустой SUMMARY_MODEL_CODE отключает)
+    SUMMARY_PROVIDER_CODE: str = "openai"  # Провайдер модели для краткого содержания
+    SUMMARY_MODEL_CODE: str = ""  # Недорогая модель, например gpt-4o-mini
+    SUMMARY_TRIGGER_TOKENS: int = 8000  # Несвернутая история, после которой запускается свертка
+    SUMMARY_KEEP_RECENT_TOKENS: int = 4000  # Последние ходы, которые всегда передаются целиком
+    SUMMARY_BATCH_TOKENS: int = 12000  # Максимум токенов истории за один запрос свертки
+    SUMMARY_MAX_TOKENS: int = 800  # Максимальная длина краткого содержания
+
+    # Повторы и автоматический выключатель запросов к провайдерам
+    PROVIDER_MAX_ATTEMPTS: int = 3  # Попыток на запрос, включая первую
+    PROVIDER_RETRY_BASE_DELAY: float = 0.5  # Начальная пауза между попытками, сек
+    PROVIDER_RETRY_MAX_DELAY: float = 8.0  # Максимальная пауза между попытками, сек
+    PROVIDER_REQUEST_DEADLINE_SECONDS: float = 120.0  # Время на запрос с повторами, если маршрут не задал таймаут
+    CIRCUIT_WINDOW_SECONDS: int = 30  # Окно подсчета ошибок провайдера
+    CIRCUIT_MIN_REQUESTS: int = 10  # Минимум запросов в окне для срабатывания
+    CIRCUIT_ERROR_RATE: float = 0.5  # Доля сбоев, при которой запросы приостанавливаются
+    CIRCUIT_OPEN_SECONDS: int = 30  # Пауза перед пробным запросом
+
+    # Кэш сервисов AI (по ключу API и по паре пользователь/провайдер)
+    SERVICE_CACHE_MAX_SIZE: int = 1000
+    SERVICE_CACHE_TTL_SECONDS: int = 600
+    API_KEY_COOLDOWN_SECONDS: int = 30  # Пауза для ключа после ответа 429, если провайдер не передал Retry-After
+
     # Данные администратора по умолчанию
     # DEFAULT_ADMIN_EMAIL: str
     # DEFAULT_ADMIN_PASSWORD: str
@@ -1,13 +1,14 @@
 from enum import Enum
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON, Float, Date, event, select
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import relationship, validates
+from sqlalchemy.orm import relationship, validates, object_session
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.sql import func
 import re
-import importlib
 from typing import Optional, Type, Dict, Any
 
 from app.db.database import Base
+from app.utils.token_counter import store_message_tokens
 
 
 class ProviderEnum(str, Enum):
@@ -51,20 +52,10 @@ class ProviderOrm(Base):
     models = relationship("AIModelOrm", back_populates="provider", cascade="all, delete-orphan", lazy="selectin")
 
     def get_service_class(self):
-        """Динамически загружает класс сервиса из строкового имени"""
-        try:
-            # Если service_class включает полный путь
-            if "." in self.service_class:
-                module_path, class_name = self.service_class.rsplit(".", 1)
-                module = importlib.import_module(module_path)
-                return getattr(module, class_name)
-            else:
-                # Иначе предполагаем, что класс находится в стандартном пути
-                module_path = f"app.services.{self.code}_service"
-                module = importlib.import_module(module_path)
-                return getattr(module, self.service_class)
-        except (ImportError, AttributeError) as e:
-            raise ImportError(f"Не удалось загрузить класс сервиса {self.service_class}: {str(e)}")
+        """Возвращает класс сервиса из реестра по коду провайдера и строковому имени"""
+        # Импорт внутри метода, чтобы избежать циклического импорта
+        from app.services.service_registry import ServiceRegistry
+        return ServiceRegistry.resolve(self.code, self.service_class)
 
     def is_provider_active(self) -> bool:
         """Проверяет, активен ли провайдер и есть ли у него активные модели"""
@@ -271,6 +262,8 @@ class UsageStatisticsOrm(Base):
     tokens_prompt = Column(Integer, default=0)
     tokens_completion = Column(Integer, default=0)
     total_tokens = Column(Integer, default=0)
+    tokens_cache_write = Column(Integer, default=0)  # Токены запросов, записанные в кэш промптов провайдера
+    tokens_cache_read = Column(Integer, default=0)  # Токены запросов, прочитанные из кэша промптов провайдера
     estimated_cost = Column(Float, default=0)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -285,6 +278,39 @@ class UsageStatisticsOrm(Base):
     model_obj = relationship("AIModelOrm", back_populates="usage_statistics")
 
 
+class CompletionCacheOrm(Base):
+    """Модель для сохраненных ответов AI (постоянный уровень кэша ответов)"""
+    __tablename__ = "completion_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String(64), unique=True, nullable=False, index=True)  # sha256 параметров запроса
+    provider_code = Column(String(50), nullable=True)
+    model_code = Column(String(50), nullable=False, index=True)
+    response = Column(Text, nullable=False)
+    tokens_prompt = Column(Integer, default=0)
+    tokens_completion = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    cost = Column(Float, default=0.0)  # Стоимость исходного запроса к провайдеру
+    hit_count = Column(Integer, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    last_hit_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class CacheStatisticsOrm(Base):
+    """Модель для статистики кэша ответов по пользователям и дням"""
+    __tablename__ = "cache_statistics"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    request_date = Column(Date, nullable=False, index=True)
+    hits = Column(Integer, default=0)
+    misses = Column(Integer, default=0)
+    tokens_saved = Column(Integer, default=0)
+    cost_saved = Column(Float, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
 class ThreadCategoryOrm(Base):
     """Модель для категорий тредов"""
     __tablename__ = "thread_categories"
@@ -354,6 +380,8 @@ class MessageOrm(Base):
     model_code = Column(String(50), nullable=True, index=True)  # Оставлено для обратной совместимости
     cost = Column(Float, default=0.0)
     is_cached = Column(Boolean, default=False)
+    content_tokens = Column(Integer, nullable=True)  # Токены content, считаются один раз при сохранении
+    tokens_encoding = Column(String(50), nullable=True)  # Кодировка, в которой посчитан content_tokens
     model_preference_id = Column(Integer, ForeignKey("model_preferences.id", ondelete="SET NULL"), nullable=True)
     meta_data = Column(JSON, default=lambda: {})  # Дополнительные метаданные
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -372,6 +400,35 @@ class MessageOrm(Base):
         return role
 
 
+class ThreadSummaryOrm(Base):
+    """Модель для краткого содержания ранней части треда"""
+    __tablename__ = "thread_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    thread_id = Column(Integer, ForeignKey("threads.id", ondelete="CASCADE"), nullable=False, unique=True, index=True)
+    content = Column(Text, nullable=False)
+    last_message_id = Column(Integer, nullable=False)  # Последнее сообщение, вошедшее в краткое содержание
+    messages_count = Column(Integer, default=0)  # Сколько сообщений свернуто
+    content_tokens = Column(Integer, default=0)
+    model_code = Column(String(50), nullable=True)  # Модель, которой сделано краткое содержание
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class TokenEstimatorRatiosOrm(Base):
+    """Модель для коэффициентов оценки токенов (токенов на символ) по моделям и видам символов"""
+    __tablename__ = "token_estimator_ratios"
+
+    id = Column(Integer, primary_key=True, index=True)
+    model_code = Column(String(50), nullable=False, unique=True, index=True)  # "*" - общие коэффициенты
+    ratios = Column(JSON, nullable=False)  # {"latin": 0.25, "cyrillic": 0.4, ...}
+    samples = Column(Integer, default=0)  # Сколько сообщений использовано для подбора
+    chars = Column(Integer, default=0)  # Суммарная длина этих сообщений
+    mean_error = Column(Float, nullable=True)  # Средняя относительная ошибка на этих сообщениях
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
 class SavedPromptOrm(Base):
     """Модель для сохраненных промптов"""
     __tablename__ = "saved_prompts"
@@ -470,4 +527,33 @@ def provider_after_save(mapper, connection, target):
             WHERE provider_id = :provider_id
             """,
             {"provider_code": target.code, "provider_id": target.id}
-        )
\ No newline at end of file
+        )
+
+
+def get_message_model_code(connection, target: MessageOrm) -> str:
+    """
+    Возвращает код модели, для которой считаются токены сообщения.
+
+    У сообщений пользователя и системных сообщений модель не указана,
+    поэтому берется модель треда: из сессии, если тред в ней уже загружен,
+    иначе одним запросом по первичному ключу.
+    """
+    if target.model_code:
+        return target.model_code
+    if target.thread_id is None:
+        return ""
+
+    session = object_session(target)
+    thread = session.identity_map.get(identity_key(ThreadOrm, target.thread_id)) if session else None
+    if thread is not None:
+        return thread.model_code or ""
+    return connection.execute(
+        select(ThreadOrm.model_code).where(ThreadOrm.id == target.thread_id)
+    ).scalar() or ""
+
+
+@event.listens_for(MessageOrm, 'before_insert')
+def message_before_insert(mapper, connection, target):
+    """Считает токены содержимого сообщения один раз при сохранении в кодировке модели треда"""
+    if target.content_tokens is None and target.content is not None:
+        store_message_tokens(target, get_message_model_code(connection, target))
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.settings import settings
+
+logger = logging.getLogger(__name__)
+
+NotificationHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class PgNotificationListener:
+    """
+    Слушатель каналов PostgreSQL LISTEN/NOTIFY.
+
+    Позволяет доставлять события всем воркерам uvicorn: каждый процесс держит
+    одно выделенное соединение asyncpg и вызывает зарегистрированные
+    обработчики при получении уведомления. Полезная нагрузка - JSON-объект.
+    """
+
+    _connection: Optional[asyncpg.Connection] = None
+    _handlers: Dict[str, List[NotificationHandler]] = {}
+    _reconnect_delay: float = 5.0
+    _stopping: bool = False
+
+    @classmethod
+    def add_handler(cls, channel: str, handler: NotificationHandler) -> None:
+        """
+        Регистрирует обработчик уведомлений канала.
+
+        Args:
+            channel: Имя канала PostgreSQL
+            handler: Асинхронная функция, принимающая payload уведомления
+        """
+        cls._handlers.setdefault(channel, []).append(handler)
+
+    @classmethod
+    async def start(cls) -> None:
+        """Открывает соединение и подписывается на все зарегистрированные каналы"""
+        cls._stopping = False
+        try:
+            cls._connection = await asyncpg.connect(cls._get_dsn())
+            cls._connection.add_termination_listener(cls._on_termination)
+            for channel in cls._handlers:
+                await cls._connection.add_listener(channel, cls._dispatch)
+            logger.info(f"Подписка на каналы PostgreSQL: {', '.join(cls._handlers)}")
+        except Exception as e:
+            cls._connection = None
+            logger.error(f"Не удалось подключиться к PostgreSQL для LISTEN: {str(e)}")
+            cls._schedule_reconnect()
+
+    @classmethod
+    async def stop(cls) -> None:
+        """Закрывает соединение слушателя"""
+        cls._stopping = True
+        if cls._connection is not None and not cls._connection.is_closed():
+            await cls._connection.close()
+        cls._connection = None
+
+    @staticmethod
+    async def notify(db: AsyncSession, channel: str, payload: Dict[str, Any]) -> None:
+        """
+        Отправляет уведомление в канал через текущую сессию.
+
+        Args:
+            db: Сессия базы данных
+            channel: Имя канала PostgreSQL
+            payload: Данные уведомления (сериализуются в JSON)
+        """
+        await db.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": channel, "payload": json.dumps(payload)}
+        )
+        await db.commit()
+
+    @classmethod
+    def _dispatch(cls, connection, pid: int, channel: str, payload: str) -> None:
+        """Вызывается asyncpg при получении уведомления"""
+        try:
+            data = json.loads(payload) if payload else {}
+        except json.JSONDecodeError:
+            logger.warning(f"Некорректное уведомление в канале {channel}: {payload}")
+            return
+
+        for handler in cls._handlers.get(channel, []):
+            asyncio.create_task(cls._run_handler(handler, channel, data))
+
+    @staticmethod
+    async def _run_handler(handler: NotificationHandler, channel: str, data: Dict[str, Any]) -> None:
+        try:
+            await handler(data)
+        except Exception as e:
+            logger.error(f"Ошибка обработчика уведомлений канала {channel}: {str(e)}")
+
+    @classmethod
+    def _on_termination(cls, connection) -> None:
+        cls._connection = None
+        if not cls._stopping:
+            logger.warning("Соединение LISTEN с PostgreSQL потеряно, переподключение")
+            cls._schedule_reconnect()
+
+    @classmethod
+    def _schedule_reconnect(cls) -> None:
+        async def reconnect():
+            await asyncio.sleep(cls._reconnect_delay)
+            if not cls._stopping and cls._connection is None:
+                await cls.start()
+
+        asyncio.get_event_loop().create_task(reconnect())
+
+    @staticmethod
+    def _get_dsn() -> str:
+        """asyncpg не понимает диалект SQLAlchemy в схеме URL"""
+        return settings.DATABASE_ASYNCPG.replace("postgresql+asyncpg://", "postgresql://", 1)
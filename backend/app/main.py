@@ -1,3 +1,4 @@
+import asyncio
 import uvicorn
 import sys
 from fastapi import FastAPI, Depends, HTTPException, status
@@ -7,10 +8,19 @@ from sqlalchemy.orm import Session
 
 # Исправляем импорты
 from app.core.settings import settings
-from app.db.database import engine, Base, get_async_session
+from app.db.database import engine, Base, get_async_session, new_session
 from app.db.models import UserOrm
 from app.core.security import get_password_hash
-from app.routers import api_keys, auth, users, threads, categories, prompts, model_preferences, statistics, ai_models
+from app.db.notifications import PgNotificationListener
+from app.services.generation_registry import GenerationRegistry, GENERATION_STOP_CHANNEL
+from app.services.http_pool import HttpClientPool
+from app.services.model_catalog import ModelCatalog, MODEL_CATALOG_CHANNEL
+from app.services.service_registry import ServiceRegistry
+from app.services.thread_context_cache import ThreadContextCache, THREAD_CONTEXT_CHANNEL
+from app.services.token_estimator import TokenEstimator
+from app.utils.token_counter import TokenizerRegistry
+from app.routers import api_keys, auth, users, threads, categories, prompts, model_preferences, statistics, ai_models, \
+    system
 
 app = FastAPI(
     title=settings.APP_NAME,
@@ -49,6 +59,40 @@ app.add_middleware(
 #             print(f"Создан администратор: {settings.DEFAULT_ADMIN_EMAIL}")
 
 
+@app.on_event("startup")
+async def startup_event():
+    # Остановка генераций, запущенных на других воркерах, приходит через LISTEN/NOTIFY
+    PgNotificationListener.add_handler(GENERATION_STOP_CHANNEL, GenerationRegistry.handle_stop_notification)
+    # Изменения провайдеров и моделей на других воркерах сбрасывают каталог в памяти
+    PgNotificationListener.add_handler(MODEL_CATALOG_CHANNEL, ModelCatalog.handle_change_notification)
+    # Новые и измененные сообщения на других воркерах сбрасывают кэш контекстов тредов
+    PgNotificationListener.add_handler(THREAD_CONTEXT_CHANNEL, ThreadContextCache.handle_change_notification)
+    await PgNotificationListener.start()
+
+    async with new_session() as db:
+        await ModelCatalog.load(db)
+        # Некорректный service_class у активного провайдера останавливает запуск
+        providers = await ModelCatalog.get_providers(db)
+        ServiceRegistry.validate(providers)
+
+        # Коэффициенты оценки токенов для моделей без локального токенизатора
+        await TokenEstimator.load(db)
+
+        # Загрузка BPE файлов токенизаторов не должна приходиться на первый запрос
+        model_codes = [
+            model.code
+            for provider in providers if provider.is_active
+            for model in await ModelCatalog.get_active_models(db, provider.id)
+        ]
+    await asyncio.to_thread(TokenizerRegistry.warm_up, model_codes)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await PgNotificationListener.stop()
+    await HttpClientPool.close_all()
+
+
 # Аутентификация и пользователи
 app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(users.router, prefix="/api/users", tags=["users"])
@@ -70,6 +114,9 @@ app.include_router(model_preferences.router, prefix="/api/model_preferences", ta
 # Статистика
 app.include_router(statistics.router, prefix="/api/statistics", tags=["statistics"])
 
+# Служебная информация для администраторов
+app.include_router(system.router, prefix="/api/system", tags=["system"])
+
 @app.get("/api/health", tags=["Health"])
 async def health_check():
     return {"status": "ok", "version": settings.APP_VERSION}
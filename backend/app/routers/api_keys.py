@@ -1,12 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List
+from typing import List, Dict, Any
 from sqlalchemy import select
 
 from app.core.dependencies import get_current_user
 from app.db.database import get_async_session
 from app.db.models import UserOrm, ApiKeyOrm, ProviderOrm
 from app.schemas.api_key import ApiKeyCreateSchema, ApiKeyResponseSchema, ApiKeyUpdateSchema
+from app.services.ai_service_factory import AIServiceFactory
+from app.services.key_pool import KeyPoolRegistry
 
 router = APIRouter()
 
@@ -40,6 +42,17 @@ async def get_api_keys(
     return api_keys
 
 
+@router.get("/pool-stats", response_model=List[Dict[str, Any]])
+async def get_api_key_pool_stats(
+        current_user: UserOrm = Depends(get_current_user)
+):
+    """
+    Возвращает распределение запросов по API ключам текущего пользователя
+    (запросы в работе, ошибки, охлаждение после 429) в текущем воркере.
+    """
+    return KeyPoolRegistry.get_stats(user_id=current_user.id)
+
+
 @router.post("/", response_model=ApiKeyResponseSchema, status_code=status.HTTP_201_CREATED)
 async def create_api_key(
         api_key: ApiKeyCreateSchema,
@@ -90,6 +103,9 @@ async def create_api_key(
     await db.commit()
     await db.refresh(db_api_key)
 
+    # Новый ключ становится основным для провайдера, сбрасываем кэш сервисов
+    AIServiceFactory.invalidate_api_key(db_api_key.id, current_user.id, [db_api_key.provider_id])
+
     # Добавляем код провайдера к ответу
     setattr(db_api_key, "provider_code", provider.code)
 
@@ -123,6 +139,7 @@ async def update_api_key(
 
     # Проверяем существование провайдера, если меняется
     provider = None
+    old_provider_id = db_api_key.provider_id
     provider_id = api_key.provider_id or db_api_key.provider_id
 
     if api_key.provider_id is not None:
@@ -158,6 +175,9 @@ async def update_api_key(
     await db.commit()
     await db.refresh(db_api_key)
 
+    # Сбрасываем сервисы, созданные со старым ключом
+    AIServiceFactory.invalidate_api_key(db_api_key.id, current_user.id, [old_provider_id, db_api_key.provider_id])
+
     # Добавляем код провайдера к ответу
     if provider:
         setattr(db_api_key, "provider_code", provider.code)
@@ -189,7 +209,11 @@ async def delete_api_key(
         )
 
     # Удаляем ключ
+    provider_id = db_api_key.provider_id
     await db.delete(db_api_key)
     await db.commit()
 
+    # Сбрасываем сервисы, созданные с удаленным ключом
+    AIServiceFactory.invalidate_api_key(key_id, current_user.id, [provider_id])
+
     return None
\ No newline at end of file
@@ -14,6 +14,7 @@ from app.schemas.model_preferences import (
     AvailableModelsResponseSchema
 )
 from app.services import ai_service_factory
+from app.services.model_catalog import ModelCatalog
 
 router = APIRouter()
 
@@ -26,35 +27,29 @@ async def get_available_models(
     """
     Возвращает список доступных моделей из всех настроенных провайдеров.
     """
-    from sqlalchemy import text
     import json
 
     try:
-        # 1. Получаем список активных провайдеров, для которых у пользователя есть ключи
-        providers_query = text("""
-        SELECT DISTINCT p.id, p.code, p.name, p.description
-        FROM providers p
-        JOIN api_keys a ON p.id = a.provider_id
-        WHERE a.user_id = :user_id AND a.is_active = TRUE AND p.is_active = TRUE
-        """)
-        providers_result = await db.execute(providers_query, {"user_id": current_user.id})
+        # 1. Получаем провайдеров, для которых у пользователя есть активные ключи
+        providers_result = await db.execute(
+            select(ApiKeyOrm.provider_id)
+            .filter(
+                (ApiKeyOrm.user_id == current_user.id) &
+                (ApiKeyOrm.is_active == True)
+            )
+            .distinct()
+        )
 
         available_models = []
 
-        # 2. Для каждого провайдера получаем его модели
-        for provider_row in providers_result.all():
-            provider_id, provider_code, provider_name, provider_desc = provider_row
+        # 2. Провайдеры и их модели берутся из каталога в памяти
+        for provider_id in providers_result.scalars().all():
+            provider = await ModelCatalog.get_provider(db, provider_id)
+            if not provider or not provider.is_active:
+                continue
 
-            # Используем чистый SQL для получения моделей
-            models_query = text("""
-            SELECT id, code, name, description, max_context_length, input_price, output_price, config
-            FROM ai_models
-            WHERE provider_id = :provider_id AND is_active = TRUE
-            """)
-            models_result = await db.execute(models_query, {"provider_id": provider_id})
-
-            for model_row in models_result.all():
-                model_id, model_code, model_name, model_desc, max_tokens, input_price, output_price, config = model_row
+            for model in await ModelCatalog.get_active_models(db, provider_id):
+                config = model.config
 
                 # Правильно обрабатываем config, который может быть в разных форматах
                 capabilities = []
@@ -71,21 +66,21 @@ async def get_available_models(
                     if "capabilities" in config_dict and isinstance(config_dict["capabilities"], list):
                         capabilities = config_dict["capabilities"]
                 except (json.JSONDecodeError, TypeError, ValueError) as e:
-                    print(f"Ошибка при обработке config для модели {model_code}: {str(e)}")
+                    print(f"Ошибка при обработке config для модели {model.code}: {str(e)}")
                     # В случае ошибки используем пустой список возможностей
                     capabilities = []
 
                 available_models.append({
                     "provider_id": provider_id,
-                    "provider_code": provider_code,  # Код провайдера
-                    "id": model_id,
-                    "code": model_code,
-                    "name": model_name,
-                    "description": model_desc or "",
-                    "max_tokens": max_tokens,
+                    "provider_code": provider.code,  # Код провайдера
+                    "id": model.id,
+                    "code": model.code,
+                    "name": model.name,
+                    "description": model.description or "",
+                    "max_tokens": model.max_context_length,
                     "pricing": {
-                        "input": input_price,
-                        "output": output_price
+                        "input": model.input_price,
+                        "output": model.output_price
                     },
                     "capabilities": capabilities
                 })
@@ -122,25 +117,18 @@ async def get_model_preferences(
     provider_ids = [pref.provider_id for pref in preferences]
     model_ids = [pref.model_id for pref in preferences]
 
-    # Получаем коды провайдеров
-    if provider_ids:
-        provider_result = await db.execute(
-            select(ProviderOrm.id, ProviderOrm.code)
-            .filter(ProviderOrm.id.in_(provider_ids))
-        )
-        provider_map = {provider_id: code for provider_id, code in provider_result.all()}
-    else:
-        provider_map = {}
+    # Получаем коды провайдеров и моделей из каталога
+    provider_map = {}
+    for provider_id in set(provider_ids):
+        provider = await ModelCatalog.get_provider(db, provider_id)
+        if provider:
+            provider_map[provider_id] = provider.code
 
-    # Получаем коды моделей
-    if model_ids:
-        model_result = await db.execute(
-            select(AIModelOrm.id, AIModelOrm.code)
-            .filter(AIModelOrm.id.in_(model_ids))
-        )
-        model_map = {model_id: code for model_id, code in model_result.all()}
-    else:
-        model_map = {}
+    model_map = {}
+    for model_id in set(model_ids):
+        model = await ModelCatalog.get_model(db, model_id)
+        if model:
+            model_map[model_id] = model.code
 
     # Обновляем коды в preferences, если они не указаны
     for pref in preferences:
@@ -173,25 +161,18 @@ async def get_default_preferences(
     provider_ids = [pref.provider_id for pref in defaults]
     model_ids = [pref.model_id for pref in defaults]
 
-    # Получаем коды провайдеров
-    if provider_ids:
-        provider_result = await db.execute(
-            select(ProviderOrm.id, ProviderOrm.code)
-            .filter(ProviderOrm.id.in_(provider_ids))
-        )
-        provider_map = {provider_id: code for provider_id, code in provider_result.all()}
-    else:
-        provider_map = {}
+    # Получаем коды провайдеров и моделей из каталога
+    provider_map = {}
+    for provider_id in set(provider_ids):
+        provider = await ModelCatalog.get_provider(db, provider_id)
+        if provider:
+            provider_map[provider_id] = provider.code
 
-    # Получаем коды моделей
-    if model_ids:
-        model_result = await db.execute(
-            select(AIModelOrm.id, AIModelOrm.code)
-            .filter(AIModelOrm.id.in_(model_ids))
-        )
-        model_map = {model_id: code for model_id, code in model_result.all()}
-    else:
-        model_map = {}
+    model_map = {}
+    for model_id in set(model_ids):
+        model = await ModelCatalog.get_model(db, model_id)
+        if model:
+            model_map[model_id] = model.code
 
     # Обновляем коды в preferences, если они не указаны
     for pref in defaults:
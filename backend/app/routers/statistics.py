@@ -7,6 +7,7 @@ from datetime import date, datetime, timedelta
 from app.core.dependencies import get_current_user
 from app.db.database import get_async_session
 from app.db.models import UserOrm, UsageStatisticsOrm
+from app.services.completion_cache import CompletionCache
 from app.schemas.statistics import (
     UsageStatisticsResponseSchema,
     DailyUsageItemSchema,
@@ -224,60 +225,64 @@ async def get_usage_summary(
     }
 
 
-# @router.get("/cached-requests", response_model=Dict[str, Any])
-# async def get_cached_requests_stats(
-#         days: Optional[int] = Query(30, description="Количество дней для анализа"),
-#         db: AsyncSession = Depends(get_async_session),
-#         current_user: UserOrm = Depends(get_current_user)
-# ):
-#     """
-#     Возвращает статистику по кэшированным запросам и экономии.
-#     """
-#     # Получаем статистику из сервиса кэширования
-#     from app.services.cache_service import get_cache_statistics
-#
-#     start_date = (datetime.now() - timedelta(days=days)).date()
-#     end_date = datetime.now().date()
-#
-#     # Получаем статистику использования для сравнения
-#     result = await db.execute(
-#         select(
-#             func.sum(UsageStatisticsOrm.total_tokens).label("tokens"),
-#             func.sum(UsageStatisticsOrm.estimated_cost).label("cost")
-#         ).filter(
-#             (UsageStatisticsOrm.user_id == current_user.id) &
-#             (UsageStatisticsOrm.request_date >= start_date)
-#         )
-#     )
-#     stats = result.one()
-#
-#     total_tokens = stats.tokens or 0
-#     total_cost = stats.cost or 0
-#
-#     # Запрашиваем статистику кэширования
-#     cache_stats = get_cache_statistics(current_user.id, days)
-#
-#     # Рассчитываем экономию
-#     tokens_saved = cache_stats.get("tokens_saved", 0)
-#     cost_saved = cache_stats.get("cost_saved", 0)
-#
-#     # Процент экономии
-#     percent_tokens_saved = (
-#                 tokens_saved / (total_tokens + tokens_saved) * 100) if total_tokens + tokens_saved > 0 else 0
-#     percent_cost_saved = (cost_saved / (total_cost + cost_saved) * 100) if total_cost + cost_saved > 0 else 0
-#
-#     return {
-#         "period": {
-#             "start_date": start_date,
-#             "end_date": end_date,
-#             "days": days
-#         },
-#         "cache_hits": cache_stats.get("hits", 0),
-#         "cache_misses": cache_stats.get("misses", 0),
-#         "hit_ratio": cache_stats.get("hit_ratio", 0),
-#         "tokens_saved": tokens_saved,
-#         "cost_saved": cost_saved,
-#         "percent_tokens_saved": percent_tokens_saved,
-#         "percent_cost_saved": percent_cost_saved,
-#         "estimated_monthly_savings": (cost_saved / days) * 30 if days > 0 else 0
-#     }
\ No newline at end of file
+@router.get("/cached-requests", response_model=Dict[str, Any])
+async def get_cached_requests_stats(
+        days: Optional[int] = Query(30, description="Количество дней для анализа"),
+        db: AsyncSession = Depends(get_async_session),
+        current_user: UserOrm = Depends(get_current_user)
+):
+    """
+    Возвращает статистику по кэшированным запросам и экономии.
+    """
+    start_date = (datetime.now() - timedelta(days=days)).date()
+    end_date = datetime.now().date()
+
+    # Получаем статистику использования для сравнения
+    result = await db.execute(
+        select(
+            func.sum(UsageStatisticsOrm.total_tokens).label("tokens"),
+            func.sum(UsageStatisticsOrm.estimated_cost).label("cost"),
+            func.sum(UsageStatisticsOrm.tokens_cache_write).label("cache_write"),
+            func.sum(UsageStatisticsOrm.tokens_cache_read).label("cache_read")
+        ).filter(
+            (UsageStatisticsOrm.user_id == current_user.id) &
+            (UsageStatisticsOrm.request_date >= start_date)
+        )
+    )
+    stats = result.one()
+
+    total_tokens = stats.tokens or 0
+    total_cost = stats.cost or 0
+
+    # Запрашиваем статистику кэширования
+    cache_stats = await CompletionCache.get_statistics(db, current_user.id, days)
+
+    # Рассчитываем экономию
+    tokens_saved = cache_stats.get("tokens_saved", 0)
+    cost_saved = cache_stats.get("cost_saved", 0)
+
+    # Процент экономии
+    percent_tokens_saved = (
+                tokens_saved / (total_tokens + tokens_saved) * 100) if total_tokens + tokens_saved > 0 else 0
+    percent_cost_saved = (cost_saved / (total_cost + cost_saved) * 100) if total_cost + cost_saved > 0 else 0
+
+    return {
+        "period": {
+            "start_date": start_date,
+            "end_date": end_date,
+            "days": days
+        },
+        "cache_hits": cache_stats.get("hits", 0),
+        "cache_misses": cache_stats.get("misses", 0),
+        "hit_ratio": cache_stats.get("hit_ratio", 0),
+        "tokens_saved": tokens_saved,
+        "cost_saved": cost_saved,
+        "percent_tokens_saved": percent_tokens_saved,
+        "percent_cost_saved": percent_cost_saved,
+        "estimated_monthly_savings": (cost_saved / days) * 30 if days > 0 else 0,
+        # Кэш промптов на стороне провайдера (Anthropic cache_control)
+        "provider_prompt_cache": {
+            "tokens_cache_write": stats.cache_write or 0,
+            "tokens_cache_read": stats.cache_read or 0
+        }
+    }
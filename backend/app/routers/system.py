@@ -0,0 +1,99 @@
+from fastapi import APIRouter, Depends
+from typing import Dict, Any, List
+
+from app.core.dependencies import get_current_admin_user
+from app.db.models import UserOrm
+from app.services.ai_service_factory import AIServiceFactory
+from app.services.completion_cache import CompletionCache
+from app.services.http_pool import HttpClientPool
+from app.services.key_pool import KeyPoolRegistry
+from app.services.near_duplicate_index import NearDuplicateRegistry
+from app.services.request_executor import RequestExecutor
+from app.services.thread_context_cache import ThreadContextCache
+from app.services.token_estimator import TokenEstimator
+from app.utils.token_counter import TokenizerRegistry
+
+router = APIRouter()
+
+
+@router.get("/http-pool", response_model=Dict[str, Any])
+async def get_http_pool_stats(
+        current_user: UserOrm = Depends(get_current_admin_user)
+):
+    """
+    Возвращает состояние общих пулов HTTP соединений к провайдерам в текущем воркере.
+    """
+    return HttpClientPool.get_stats()
+
+
+@router.get("/service-cache", response_model=Dict[str, Any])
+async def get_service_cache_stats(
+        current_user: UserOrm = Depends(get_current_admin_user)
+):
+    """
+    Возвращает статистику кэша сервисов AI в текущем воркере.
+    """
+    return AIServiceFactory.get_cache_stats()
+
+
+@router.get("/key-pools", response_model=List[Dict[str, Any]])
+async def get_key_pool_stats(
+        current_user: UserOrm = Depends(get_current_admin_user)
+):
+    """
+    Возвращает счетчики API ключей по пулам пользователей в текущем воркере.
+    """
+    return KeyPoolRegistry.get_stats()
+
+
+@router.get("/circuit-breakers", response_model=Dict[str, Any])
+async def get_circuit_breaker_stats(
+        current_user: UserOrm = Depends(get_current_admin_user)
+):
+    """
+    Возвращает состояние выключателей запросов к провайдерам в текущем воркере.
+    """
+    return RequestExecutor.get_stats()
+
+
+@router.get("/completion-cache", response_model=Dict[str, Any])
+async def get_completion_cache_stats(
+        current_user: UserOrm = Depends(get_current_admin_user)
+):
+    """
+    Возвращает статистику уровня кэша ответов в памяти текущего воркера.
+    """
+    return {
+        "memory": CompletionCache.get_memory_stats(),
+        "near_duplicates": NearDuplicateRegistry.get_stats()
+    }
+
+
+@router.get("/thread-context-cache", response_model=Dict[str, Any])
+async def get_thread_context_cache_stats(
+        current_user: UserOrm = Depends(get_current_admin_user)
+):
+    """
+    Возвращает размер кэша контекстов тредов и долю попаданий в текущем воркере.
+    """
+    return ThreadContextCache.get_stats()
+
+
+@router.get("/tokenizers", response_model=Dict[str, Any])
+async def get_tokenizer_stats(
+        current_user: UserOrm = Depends(get_current_admin_user)
+):
+    """
+    Возвращает загруженные кодировки токенизаторов и время их загрузки в текущем воркере.
+    """
+    return TokenizerRegistry.get_stats()
+
+
+@router.get("/token-estimator", response_model=Dict[str, Any])
+async def get_token_estimator_stats(
+        current_user: UserOrm = Depends(get_current_admin_user)
+):
+    """
+    Возвращает коэффициенты оценки токенов, загруженные в текущем воркере.
+    """
+    return TokenEstimator.get_stats()
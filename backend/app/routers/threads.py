@@ -1,5 +1,5 @@
-import json
-from fastapi import APIRouter, Depends, HTTPException, status, Query, BackgroundTasks
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, status, Query, BackgroundTasks, Header
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional, Dict, Any
@@ -13,12 +13,22 @@ from app.schemas.thread import (
     ThreadSummarySchema, ThreadListParamsSchema, BulkThreadActionSchema,
     MessageCreateSchema, MessageSchema, SendMessageRequestSchema,
     CompletionRequestSchema, CompletionResponseSchema, TokenCountRequestSchema,
-    TokenCountResponseSchema, ErrorResponseSchema
+    TokenCountResponseSchema, TokenCountBatchRequestSchema, TokenCountBatchResponseSchema,
+    ErrorResponseSchema
 )
 from app.services.thread_service import ThreadService, ThreadNotFoundException, AccessDeniedException, \
     CategoryNotFoundException
 from app.services.message_service import MessageService, MessageServiceException
 from app.services.ai_service_factory import AIServiceFactory, APIKeyNotFoundException
+from app.services.base_ai_service import get_default_deadline
+from app.services.completion_cache import CompletionCache
+from app.services.context_builder import ContextBuilder, ContextBudgetExceededException
+from app.services.generation_registry import GenerationRegistry
+from app.services.model_catalog import ModelCatalog
+from app.services.thread_summarizer import ThreadSummarizer
+from app.services.token_estimator import TokenEstimator
+from app.utils.sse import SSE_HEADERS
+from app.utils.token_counter import TokenizerRegistry, count_tokens_batch
 
 router = APIRouter()
 
@@ -98,7 +108,6 @@ async def create_thread(
 @router.post("/stream", status_code=status.HTTP_201_CREATED, response_class=StreamingResponse)
 async def create_thread_stream(
         thread_data: ThreadCreateSchema,
-        background_tasks: BackgroundTasks,
         db: AsyncSession = Depends(get_async_session),
         current_user: UserOrm = Depends(get_current_user)
 ):
@@ -140,13 +149,13 @@ async def create_thread_stream(
                         } for msg in messages
                     ]
                 }
-                yield f"data: {json.dumps({'thread': thread_info})}\n\n"
+                yield {'thread': thread_info}
 
                 # Получаем пользовательское сообщение
                 user_message = next((msg for msg in messages if msg.role == "user"), None)
                 if not user_message:
                     error_message = "Сообщение пользователя не найдено"
-                    yield f"data: {json.dumps({'error': True, 'error_message': error_message})}\n\n"
+                    yield {'error': True, 'error_message': error_message}
                     return
 
                 # Получаем системное сообщение если есть
@@ -172,7 +181,7 @@ async def create_thread_stream(
                         )
                     except APIKeyNotFoundException:
                         error_message = f"API ключ для провайдера с ID {thread_obj.provider_id} не найден"
-                        yield f"data: {json.dumps({'error': True, 'error_message': error_message})}\n\n"
+                        yield {'error': True, 'error_message': error_message}
 
                         # Сохраняем сообщение об ошибке в БД
                         await MessageService.save_error_message(
@@ -184,7 +193,7 @@ async def create_thread_stream(
                         return
                     except Exception as e:
                         error_message = f"Ошибка при создании AI сервиса: {str(e)}"
-                        yield f"data: {json.dumps({'error': True, 'error_message': error_message})}\n\n"
+                        yield {'error': True, 'error_message': error_message}
 
                         # Сохраняем сообщение об ошибке в БД
                         await MessageService.save_error_message(
@@ -197,7 +206,7 @@ async def create_thread_stream(
 
                 except Exception as e:
                     error_message = f"Ошибка при получении AI сервиса: {str(e)}"
-                    yield f"data: {json.dumps({'error': True, 'error_message': error_message})}\n\n"
+                    yield {'error': True, 'error_message': error_message}
 
                     # Сохраняем сообщение об ошибке в БД
                     await MessageService.save_error_message(
@@ -208,62 +217,110 @@ async def create_thread_stream(
                     )
                     return
 
-                # Формируем контекст для запроса
-                context = []
-                if system_prompt:
-                    context.append({"role": "system", "content": system_prompt})
-                context.append({"role": "user", "content": user_message.content})
-
                 # Определяем параметры для запроса
                 max_tokens = thread_obj.max_tokens  # Используем max_tokens вместо max_completion_tokens
                 temperature = thread_obj.temperature  # Значение по умолчанию
 
+                # Формируем контекст для запроса в пределах бюджета токенов модели
+                try:
+                    context, context_packing = await ContextBuilder.build(
+                        db,
+                        thread.id,
+                        thread_obj.model_code,
+                        max_tokens,
+                        provider_id=thread_obj.provider_id,
+                        system_prompt=system_prompt
+                    )
+                except ContextBudgetExceededException as e:
+                    # Запрос не отправляется провайдеру и не оплачивается
+                    yield e.to_dict()
+                    return
+
+                # Сообщаем клиенту, что запрос ждет свободного места в лимитах ключа
+                wait_seconds = ai_service.get_expected_wait(context, max_tokens)
+                if wait_seconds > 0:
+                    yield {'queued': True, 'wait_seconds': round(wait_seconds, 1)}
+
                 # Генерируем ответ в потоковом режиме
-                full_response = ""
+                response_parts = []
                 tokens_info = {}
-                cost = 0
+                cost = None
+                from_cache = False
 
-                # Используем метод generate_completion вместо stream_generation
                 try:
-                    # Генерируем ответ от ИИ с полным контекстом
-                    result = await ai_service.generate_completion_with_context(
-                        context=context,
-                        model=thread_obj.model_code,
-                        max_tokens=max_tokens,
-                        temperature=temperature
-                    )
-
-                    # Проверяем наличие ошибки
-                    if result.get("error", False):
-                        error_message = result.get("error_message", "Неизвестная ошибка при генерации ответа")
-                        yield f"data: {json.dumps({'error': True, 'error_message': error_message})}\n\n"
+                    # Куски ответа отправляем клиенту сразу по мере получения от провайдера
+                    async for chunk in CompletionCache.stream(
+                            db=db,
+                            user_id=current_user.id,
+                            ai_service=ai_service,
+                            context=context,
+                            model=thread_obj.model_code,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            use_cache=thread_data.use_cache,
+                            near_duplicates=thread_data.near_duplicates,
+                            deadline=get_default_deadline()
+                    ):
+                        # Проверяем наличие ошибки
+                        if chunk.get("error", False):
+                            error_message = chunk.get("error_message", "Неизвестная ошибка при генерации ответа")
+                            yield {'error': True, 'error_message': error_message}
+
+                            # Сохраняем сообщение об ошибке в БД
+                            await MessageService.save_error_message(
+                                db=db,
+                                thread_id=thread.id,
+                                error_message=error_message,
+                                error_type=chunk.get("error_type", "api_error"),
+                                provider_id=thread_obj.provider_id,
+                                model_id=thread_obj.model_id,
+                                error_details=chunk
+                            )
+                            return
+
+                        if chunk.get("text"):
+                            response_parts.append(chunk["text"])
+                            yield {'text': chunk['text']}
+                        elif "preview" in chunk:
+                            # Ответ на похожий запрос, пока модель генерирует настоящий
+                            yield chunk
+                        elif "tokens" in chunk:
+                            # Финальный кусок с информацией о токенах и стоимости
+                            tokens_info = chunk.get("tokens", {})
+                            cost = chunk.get("cost")
+                            from_cache = chunk.get("from_cache", False)
+
+                    # Рассчитываем стоимость, если провайдер ее не вернул
+                    if cost is None:
+                        cost = await ai_service.calculate_cost(
+                            tokens_info.get("prompt_tokens", 0),
+                            tokens_info.get("completion_tokens", 0),
+                            thread_obj.model_code
+                        )
 
-                        # Сохраняем сообщение об ошибке в БД
-                        await MessageService.save_error_message(
+                except asyncio.CancelledError:
+                    # Генерация остановлена через /stream/stop: поток провайдера уже закрыт,
+                    # сохраняем то, что успели получить
+                    partial_response = "".join(response_parts)
+                    message_id = None
+                    if partial_response:
+                        assistant_message = await MessageService.save_ai_response(
                             db=db,
                             thread_id=thread.id,
-                            error_message=error_message,
-                            error_type=result.get("error_type", "api_error"),
-                            provider_id=thread_obj.provider_id,
+                            content=partial_response,
                             model_id=thread_obj.model_id,
-                            error_details=result
+                            provider_id=thread_obj.provider_id,
+                            tokens_data=tokens_info,
+                            cost=0,
+                            meta_data={"with_context": True, "stopped_early": True}
                         )
-                        return
-
-                    # Имитируем потоковую передачу одним куском (если настоящий стриминг не работает)
-                    text = result.get("text", "")
-                    if text:
-                        # Отправляем текст клиенту
-                        yield f"data: {json.dumps({'text': text})}\n\n"
-                        full_response = text
-
-                    # Получаем информацию о токенах и стоимости
-                    tokens_info = result.get("tokens", {})
-                    cost = result.get("cost", 0)
+                        message_id = assistant_message.id
+                    yield {'done': True, 'stopped': True, 'message_id': message_id}
+                    return
 
                 except Exception as e:
                     error_message = f"Ошибка при генерации ответа: {str(e)}"
-                    yield f"data: {json.dumps({'error': True, 'error_message': error_message})}\n\n"
+                    yield {'error': True, 'error_message': error_message}
 
                     # Сохраняем сообщение об ошибке в БД
                     await MessageService.save_error_message(
@@ -277,7 +334,8 @@ async def create_thread_stream(
                     )
                     return
 
-                # Сохраняем ответ ассистента в БД, если он не пустой
+                # Сохраняем ответ ассистента в БД после завершения потока, если он не пустой
+                full_response = "".join(response_parts)
                 if full_response:
                     assistant_message = await MessageService.save_ai_response(
                         db=db,
@@ -287,12 +345,35 @@ async def create_thread_stream(
                         provider_id=thread_obj.provider_id,
                         tokens_data=tokens_info,
                         cost=cost,
-                        meta_data={"with_context": True}
+                        meta_data={
+                            "with_context": True,
+                            "from_cache": from_cache,
+                            "context": context_packing,
+                            # Токены кэша промптов провайдера, если он использовался
+                            **{
+                                key: tokens_info[key]
+                                for key in ("cache_creation_tokens", "cache_read_tokens")
+                                if key in tokens_info
+                            }
+                        }
                     )
+                    if from_cache:
+                        assistant_message.is_cached = True
+                        await db.commit()
+
+                    # Отправляем финальное сообщение с ID сохраненного сообщения
+                    yield {'done': True, 'message_id': assistant_message.id, 'from_cache': from_cache}
 
-                    # Обновляем статистику использования в фоновом режиме
-                    background_tasks.add_task(
-                        ai_service.update_usage_statistics,
+                    # Длинная история сворачивается в краткое содержание в фоне
+                    ThreadSummarizer.schedule(thread.id, current_user.id)
+
+                    # Ответ из кэша не расходует лимиты провайдера и в статистику использования не попадает
+                    if from_cache:
+                        return
+
+                    # Генерация выполняется в отдельной задаче, которая переживает
+                    # отключение клиента, поэтому статистику обновляем здесь же
+                    await ai_service.update_usage_statistics(
                         db=db,
                         user_id=current_user.id,
                         tokens_data=tokens_info,
@@ -300,13 +381,10 @@ async def create_thread_stream(
                         cost=cost
                     )
 
-                    # Отправляем финальное сообщение с ID сохраненного сообщения
-                    yield f"data: {json.dumps({'done': True, 'message_id': assistant_message.id})}\n\n"
-
             except Exception as e:
                 # Обработка ошибок
                 error_message = f"Ошибка при генерации ответа: {str(e)}"
-                yield f"data: {json.dumps({'error': True, 'error_message': error_message})}\n\n"
+                yield {'error': True, 'error_message': error_message}
 
                 # Сохраняем сообщение об ошибке в БД
                 await MessageService.save_error_message(
@@ -319,13 +397,13 @@ async def create_thread_stream(
                     error_details=str(e)
                 )
 
-        # Возвращаем стрим-ответ с правильными заголовками
-        headers = {
-            'Cache-Control': 'no-cache',
-            'Connection': 'keep-alive',
-            'Content-Type': 'text/event-stream'
-        }
-        return StreamingResponse(generate(), headers=headers)
+        # Запускаем генерацию в реестре, чтобы ее можно было прервать через /stream/stop
+        user_message = next((msg for msg in messages if msg.role == "user"), None)
+        generation = GenerationRegistry.create(thread.id, user_message.id if user_message else None)
+        events = generation.subscribe()
+        generation.start(generate())
+
+        return StreamingResponse(events, headers=SSE_HEADERS)
 
     except CategoryNotFoundException as e:
         raise HTTPException(
@@ -778,6 +856,18 @@ async def send_message(
     последний запрос пользователя.
     """
     try:
+        # Запрос, который не поместится в контекст модели, отклоняется до сохранения сообщения
+        thread = await ThreadService.get_thread_by_id(db, current_user.id, thread_id)
+        await ContextBuilder.preflight(
+            db,
+            thread.model_code,
+            message_data.max_tokens or thread.max_tokens,
+            message_data.content,
+            provider_id=thread.provider_id,
+            system_prompt=message_data.system_prompt,
+            thread_id=thread_id if use_context else None
+        )
+
         result = await MessageService.send_message(
             db=db,
             user_id=current_user.id,
@@ -790,12 +880,23 @@ async def send_message(
         # Проверяем, получили ли мы ошибку или сообщение
         if isinstance(result, dict) and result.get("error", False):
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE if result.get(
+                    "error_type") == "context_length_exceeded" else status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=result
             )
 
+        # Ответ сохранен: длинная история сворачивается в краткое содержание в фоне
+        ThreadSummarizer.schedule(thread_id, current_user.id)
+
         return MessageSchema.from_orm(result)
 
+    except ContextBudgetExceededException as e:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=e.to_dict()
+        )
+    except HTTPException:
+        raise
     except ThreadNotFoundException as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -833,6 +934,25 @@ async def generate_completion(
     Генерирует ответ на основе запроса пользователя без сохранения в тред.
     """
     try:
+        # Запрос, который не поместится в контекст модели, отклоняется до обращения к провайдеру
+        preference_result = await db.execute(
+            select(ModelPreferencesOrm).filter(
+                (ModelPreferencesOrm.id == request.model_preference_id) &
+                (ModelPreferencesOrm.user_id == current_user.id)
+            )
+        )
+        preference = preference_result.scalars().first()
+        model = await ModelCatalog.get_model(db, preference.model_id) if preference else None
+        if model is not None:
+            await ContextBuilder.preflight(
+                db,
+                model.code,
+                request.max_tokens,
+                request.prompt,
+                provider_id=model.provider_id,
+                system_prompt=request.system_prompt
+            )
+
         # Преобразуем запрос в словарь для передачи в сервис
         request_data = {
             "provider_id": request.provider_id,
@@ -853,14 +973,22 @@ async def generate_completion(
 
         # Проверяем наличие ошибки
         if result.get("error", False):
+            error_statuses = {
+                "api_key_not_found": status.HTTP_400_BAD_REQUEST,
+                "context_length_exceeded": status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            }
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if result.get(
-                    "error_type") != "api_key_not_found" else status.HTTP_400_BAD_REQUEST,
+                status_code=error_statuses.get(result.get("error_type"), status.HTTP_500_INTERNAL_SERVER_ERROR),
                 detail=result
             )
 
         return result
 
+    except ContextBudgetExceededException as e:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=e.to_dict()
+        )
     except Exception as e:
         if isinstance(e, HTTPException):
             raise e
@@ -933,6 +1061,79 @@ async def count_tokens(
         )
 
 
+@router.post(
+    "/token-count/batch",
+    response_model=TokenCountBatchResponseSchema
+)
+async def count_tokens_batch_route(
+        request: TokenCountBatchRequestSchema,
+        db: AsyncSession = Depends(get_async_session),
+        current_user: UserOrm = Depends(get_current_user)
+):
+    """
+    Подсчитывает количество токенов в нескольких текстах или наборах сообщений для одной модели.
+    Тексты токенизируются одним пакетом, большие запросы обрабатываются в пуле потоков.
+    Для моделей не OpenAI токены оцениваются по видам символов (estimated)
+    """
+    try:
+        if request.model_preferences_id:
+            preference_query = select(ModelPreferencesOrm).filter(
+                (ModelPreferencesOrm.id == request.model_preferences_id) &
+                (ModelPreferencesOrm.user_id == current_user.id)
+            )
+            preference_result = await db.execute(preference_query)
+            preference = preference_result.scalars().first()
+
+            if not preference:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Предпочтение модели с ID {request.model_preferences_id} не найдено или принадлежит другому пользователю"
+                )
+
+            provider_id = preference.provider_id
+            model_id = preference.model_id
+        else:
+            provider_id = request.provider_id
+            model_id = request.model_id
+
+        model = await ModelCatalog.get_model(db, model_id) if model_id is not None else None
+        if model is None or model.provider_id != provider_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Модель с ID {model_id} не найдена у провайдера {provider_id}"
+            )
+        provider = await ModelCatalog.get_provider(db, provider_id)
+
+        # Токенизатор tiktoken точен только для моделей OpenAI
+        estimated = provider is None or provider.code != "openai"
+        if estimated:
+            counts = {
+                "texts": [TokenEstimator.estimate(text, model.code) for text in request.texts],
+                "conversations": [
+                    TokenEstimator.estimate_messages(messages, model.code) for messages in request.messages
+                ],
+            }
+        else:
+            counts = await count_tokens_batch(request.texts, request.messages, model.code)
+
+        return {
+            "counts": counts["texts"],
+            "messages_counts": counts["conversations"],
+            "total": sum(counts["texts"]) + sum(counts["conversations"]),
+            "model": model.code,
+            "encoding": None if estimated else TokenizerRegistry.get_encoding_name(model.code),
+            "estimated": estimated
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка при пакетном подсчете токенов: {str(e)}"
+        )
+
+
 @router.post("/{thread_id}/stream", response_class=StreamingResponse)
 async def stream_message(
         thread_id: int,
@@ -941,62 +1142,144 @@ async def stream_message(
         db: AsyncSession = Depends(get_async_session),
         current_user: UserOrm = Depends(get_current_user),
         use_context: bool = Query(True, description="Использовать контекст для генерации ответа"),
-        timeout: int = Query(120, description="Таймаут генерации в секундах")
+        timeout: int = Query(120, description="Таймаут генерации в секундах"),
+        last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
 ):
+    """
+    Отправляет сообщение в тред и возвращает потоковый ответ нейросети.
+
+    Если передан заголовок Last-Event-ID и генерация еще хранится в буфере,
+    клиент подключается к ней повторно и получает пропущенные события
+    без повторного запроса к провайдеру.
+    """
     try:
         # Проверяем доступ к треду
-        await ThreadService.get_thread_by_id(db, current_user.id, thread_id)
+        thread = await ThreadService.get_thread_by_id(db, current_user.id, thread_id)
+
+        # Переподключение к уже запущенной генерации
+        if last_event_id:
+            generation, after_seq = GenerationRegistry.find_for_resume(thread_id, last_event_id)
+            if generation is not None:
+                return StreamingResponse(generation.subscribe(after_seq), headers=SSE_HEADERS)
+
+        # Запрос, который не поместится в контекст модели, отклоняется до сохранения сообщения
+        await ContextBuilder.preflight(
+            db,
+            thread.model_code,
+            message_data.max_tokens or thread.max_tokens,
+            message_data.content,
+            provider_id=thread.provider_id,
+            system_prompt=message_data.system_prompt,
+            thread_id=thread_id if use_context else None
+        )
+
+        # Параметры треда нужны генератору до повторной загрузки треда в обработчиках ошибок
+        provider_id = thread.provider_id
+        max_tokens = message_data.max_tokens or thread.max_tokens
 
         # Функция-генератор для потоковой передачи
         async def generate():
             try:
-                # Используем MessageService для обработки потокового ответа
-                async for chunk in MessageService.handle_stream_response(
+                # Сообщаем клиенту, что запрос ждет свободного места в лимитах ключа
+                # (оценка по новому сообщению: контекст собирается в MessageService)
+                try:
+                    ai_service = await AIServiceFactory.get_service_by_user_and_provider(
+                        db, current_user.id, provider_id
+                    )
+                    wait_seconds = ai_service.get_expected_wait(
+                        [{"role": "user", "content": message_data.content}],
+                        max_tokens
+                    )
+                except APIKeyNotFoundException:
+                    # Ошибку отсутствия ключа вернет MessageService
+                    wait_seconds = 0
+                if wait_seconds > 0:
+                    yield {'queued': True, 'wait_seconds': round(wait_seconds, 1)}
+
+                # Используем MessageService для обработки потокового ответа;
+                # вся генерация вместе с повторами запроса к провайдеру укладывается в таймаут
+                async with asyncio.timeout(timeout):
+                    async for chunk in MessageService.handle_stream_response(
+                            db=db,
+                            user_id=current_user.id,
+                            thread_id=thread_id,
+                            user_message_content=message_data.content,
+                            background_tasks=background_tasks,
+                            system_prompt=message_data.system_prompt,
+                            max_tokens=message_data.max_tokens,
+                            temperature=message_data.temperature,
+                            use_context=use_context,
+                            timeout=timeout,
+                            connection_check_callback=None  # Передаем None вместо функции
+                    ):
+                        # Отправляем чанк клиенту
+                        yield chunk
+
+                        # Ответ сохранен: длинная история сворачивается в краткое содержание в фоне
+                        if chunk.get("done") and chunk.get("message_id"):
+                            ThreadSummarizer.schedule(thread_id, current_user.id)
+
+            except asyncio.CancelledError:
+                # Генерация остановлена через /stream/stop: поток провайдера уже закрыт,
+                # сохраняем частичный ответ
+                message_id = None
+                partial_response = generation.partial_text
+                thread_result = await db.execute(
+                    select(ThreadOrm).filter(ThreadOrm.id == thread_id)
+                )
+                thread_obj = thread_result.scalar_one_or_none()
+
+                if thread_obj and partial_response:
+                    assistant_message = await MessageService.save_ai_response(
                         db=db,
-                        user_id=current_user.id,
                         thread_id=thread_id,
-                        user_message_content=message_data.content,
-                        background_tasks=background_tasks,
-                        system_prompt=message_data.system_prompt,
-                        max_tokens=message_data.max_tokens,
-                        temperature=message_data.temperature,
-                        use_context=use_context,
-                        timeout=timeout,
-                        connection_check_callback=None  # Передаем None вместо функции
-                ):
-                    # Отправляем чанк клиенту
-                    yield f"data: {json.dumps(chunk)}\n\n"
+                        content=partial_response,
+                        model_id=thread_obj.model_id,
+                        provider_id=thread_obj.provider_id,
+                        tokens_data={},
+                        cost=0,
+                        meta_data={"with_context": use_context, "stopped_early": True}
+                    )
+                    message_id = assistant_message.id
+                yield {'done': True, 'stopped': True, 'message_id': message_id}
 
             except Exception as e:
                 # Обработка ошибок
-                error_message = f"Ошибка при генерации потокового ответа: {str(e)}"
-                yield f"data: {json.dumps({'error': True, 'error_message': error_message})}\n\n"
+                if isinstance(e, TimeoutError):
+                    error_message = f"Ошибка при генерации потокового ответа: превышен таймаут {timeout} с"
+                else:
+                    error_message = f"Ошибка при генерации потокового ответа: {str(e)}"
+                yield {'error': True, 'error_message': error_message}
 
                 # Сохраняем сообщение об ошибке в БД
                 thread_result = await db.execute(
                     select(ThreadOrm).filter(ThreadOrm.id == thread_id)
                 )
-                thread = thread_result.scalar_one_or_none()
+                thread_obj = thread_result.scalar_one_or_none()
 
-                if thread:
+                if thread_obj:
                     await MessageService.save_error_message(
                         db=db,
                         thread_id=thread_id,
                         error_message=error_message,
                         error_type="stream_error",
-                        provider_id=thread.provider_id,
-                        model_id=thread.model_id,
+                        provider_id=thread_obj.provider_id,
+                        model_id=thread_obj.model_id,
                         error_details=str(e)
                     )
 
-        # Возвращаем стрим-ответ с правильными заголовками
-        headers = {
-            'Cache-Control': 'no-cache',
-            'Connection': 'keep-alive',
-            'Content-Type': 'text/event-stream'
-        }
-        return StreamingResponse(generate(), headers=headers)
+        # Запускаем генерацию в реестре, чтобы ее можно было прервать через /stream/stop
+        generation = GenerationRegistry.create(thread_id)
+        events = generation.subscribe()
+        generation.start(generate())
+
+        return StreamingResponse(events, headers=SSE_HEADERS)
 
+    except ContextBudgetExceededException as e:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=e.to_dict()
+        )
     except ThreadNotFoundException as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -1014,6 +1297,51 @@ async def stream_message(
         )
 
 
+@router.get("/{thread_id}/stream", response_class=StreamingResponse)
+async def resume_stream(
+        thread_id: int,
+        db: AsyncSession = Depends(get_async_session),
+        current_user: UserOrm = Depends(get_current_user),
+        last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """
+    Переподключается к потоковому ответу после обрыва соединения.
+
+    Браузерный EventSource передает заголовок Last-Event-ID автоматически,
+    клиент получает события после указанного и продолжает читать живой поток.
+    Без заголовка подключение выполняется к текущей генерации треда с начала.
+
+    Args:
+        thread_id: ID треда
+        last_event_id: Идентификатор последнего полученного события
+    """
+    try:
+        # Проверяем доступ к треду
+        await ThreadService.get_thread_by_id(db, current_user.id, thread_id)
+
+        generation, after_seq = GenerationRegistry.find_for_resume(thread_id, last_event_id)
+        if generation is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Активная генерация для треда не найдена"
+            )
+
+        return StreamingResponse(generation.subscribe(after_seq), headers=SSE_HEADERS)
+
+    except HTTPException:
+        raise
+    except ThreadNotFoundException as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except AccessDeniedException as e:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=str(e)
+        )
+
+
 @router.post("/{thread_id}/stream/stop", status_code=status.HTTP_200_OK)
 async def stop_streaming(
         thread_id: int,
@@ -1024,15 +1352,22 @@ async def stop_streaming(
     """
     Прерывает генерацию ответа и сохраняет текущий результат.
 
+    Запрос к провайдеру закрывается сразу, частичный ответ сохраняется
+    в тред. Если генерация выполняется на другом воркере, остановка
+    передается через канал PostgreSQL LISTEN/NOTIFY.
+
     Args:
         thread_id: ID треда
-        message_id: ID сообщения, если уже сохранено (опционально)
+        message_id: ID сообщения пользователя или ответа (опционально, иначе все генерации треда)
     """
     try:
         # Проверяем доступ к треду
         await ThreadService.get_thread_by_id(db, current_user.id, thread_id)
 
-        # Если предоставлен ID сообщения, отмечаем его как прерванное
+        # Прерываем активные генерации
+        await GenerationRegistry.stop(db, thread_id, message_id)
+
+        # Если предоставлен ID уже сохраненного сообщения, отмечаем его как прерванное
         if message_id:
             message_result = await db.execute(
                 select(MessageOrm).filter(
@@ -1044,9 +1379,8 @@ async def stop_streaming(
 
             if message:
                 # Добавляем в метаданные информацию о прерывании
-                if not message.meta_data:
-                    message.meta_data = {}
-                message.meta_data["stopped_early"] = True
+                # (присваиваем новый словарь, чтобы SQLAlchemy отследил изменение JSON)
+                message.meta_data = {**(message.meta_data or {}), "stopped_early": True}
 
                 await db.commit()
 
@@ -1,8 +1,10 @@
-from typing import Optional, List, Dict, Any, Union
+from typing import Optional, List, Dict, Any, Union, Literal
 from datetime import datetime
 from pydantic import BaseModel, Field, validator, constr
 from enum import Enum
 
+from app.core.settings import settings
+
 
 class RoleEnum(str, Enum):
     """Перечисление ролей в диалоге"""
@@ -264,6 +266,10 @@ class ThreadCreateSchema(BaseModel):
     system_prompt: Optional[str] = Field(None, description="Системный промпт для модели (если указан, обновит системный промпт в предпочтениях)")
     max_tokens: Optional[int] = Field(1000, description="Максимальное количество токенов в ответе")
     temperature: Optional[float] = Field(0.7, description="Температура (случайность) ответа")
+    use_cache: Optional[bool] = Field(False, description="Разрешить ответ из кэша (при temperature 0 кэш используется всегда)")
+    near_duplicates: Optional[Literal["reuse", "preview"]] = Field(
+        None, description="Искать ответ на похожий запрос: reuse - вернуть его, preview - показать до ответа модели"
+    )
 
     class Config:
         json_schema_extra = {
@@ -457,6 +463,73 @@ class TokenCountResponseSchema(BaseModel):
         }
 
 
+class TokenCountBatchRequestSchema(BaseModel):
+    """Схема запроса для пакетного подсчета токенов одной модели"""
+    texts: List[str] = Field(default_factory=list, description="Тексты для подсчета токенов")
+    messages: List[List[Dict[str, str]]] = Field(
+        default_factory=list,
+        description="Наборы сообщений чата [{\"role\": ..., \"content\": ...}] для подсчета вместе со служебными токенами"
+    )
+    provider_id: Optional[int] = Field(None, description="ID провайдера AI (необязательно при указании model_preferences_id)")
+    model_id: Optional[int] = Field(None, description="ID модели AI (необязательно при указании model_preferences_id)")
+    model_preferences_id: Optional[int] = Field(None, description="ID предпочтений модели (альтернатива указанию provider_id и model_id)")
+
+    @validator('messages', always=True)
+    def validate_items(cls, v, values):
+        """Проверяет, что передан хотя бы один текст или набор сообщений и их не слишком много"""
+        count = len(values.get('texts') or []) + len(v)
+        if count == 0:
+            raise ValueError("Необходимо указать texts или messages")
+        if count > settings.TOKEN_COUNT_BATCH_MAX_ITEMS:
+            raise ValueError(f"Не более {settings.TOKEN_COUNT_BATCH_MAX_ITEMS} текстов и наборов сообщений в одном запросе")
+        return v
+
+    @validator('model_preferences_id', always=True)
+    def validate_model_preferences_id(cls, v, values):
+        """Проверяет, что либо указан model_preferences_id, либо provider_id и model_id"""
+        provider_id = values.get('provider_id')
+        model_id = values.get('model_id')
+        if v is None and (provider_id is None or model_id is None):
+            raise ValueError("Необходимо указать либо model_preferences_id, либо оба поля provider_id и model_id")
+        return v
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "texts": ["Первый вариант промпта", "Второй вариант промпта"],
+                "messages": [
+                    [
+                        {"role": "system", "content": "Ты помощник программиста"},
+                        {"role": "user", "content": "Напиши функцию для подсчета слов"}
+                    ]
+                ],
+                "model_preferences_id": 7
+            }
+        }
+
+
+class TokenCountBatchResponseSchema(BaseModel):
+    """Схема ответа пакетного подсчета токенов"""
+    counts: List[int] = Field(..., description="Количество токенов для каждого текста из texts")
+    messages_counts: List[int] = Field(..., description="Количество токенов для каждого набора из messages")
+    total: int = Field(..., description="Сумма по всем текстам и наборам сообщений")
+    model: str = Field(..., description="Код модели")
+    encoding: Optional[str] = Field(None, description="Кодировка токенизатора (None для оценки)")
+    estimated: bool = Field(False, description="Подсчет приблизительный (токенизатор модели недоступен)")
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "counts": [5, 6],
+                "messages_counts": [24],
+                "total": 35,
+                "model": "gpt-4o",
+                "encoding": "o200k_base",
+                "estimated": False
+            }
+        }
+
+
 class CategoryErrorResponseSchema(BaseModel):
     """Схема ответа с информацией об ошибке для категорий"""
     detail: str = Field(..., description="Сообщение об ошибке")
@@ -556,6 +629,11 @@ class StreamResponseItem(BaseModel):
     status: Optional[str] = None
     user_message_id: Optional[int] = None
     message_id: Optional[int] = None
+    from_cache: Optional[bool] = None
+    preview: Optional[str] = None
+    similarity: Optional[float] = None
+    queued: Optional[bool] = None
+    wait_seconds: Optional[float] = None
 
     class Config:
         json_schema_extra = {
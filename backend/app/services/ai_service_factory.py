@@ -1,13 +1,16 @@
 from typing import Optional, Type, Dict, Any, List, Union
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, and_
-from sqlalchemy.orm import selectinload
 import importlib
 import logging
 
+from app.core.settings import settings
 from app.services.base_ai_service import BaseAIService
+from app.services.key_pool import KeyPoolRegistry
+from app.services.model_catalog import ModelCatalog
+from app.utils.ttl_cache import TTLCache
 from app.db.models import (
-    ApiKeyOrm, ProviderOrm, AIModelOrm, UserOrm, ModelPreferencesOrm
+    ApiKeyOrm, ProviderOrm, UserOrm, ModelPreferencesOrm
 )
 
 
@@ -42,9 +45,13 @@ class AIServiceFactory:
 
     Эта фабрика управляет созданием сервисов для различных провайдеров AI
     и поддерживает кэширование сервисов для оптимизации производительности.
+
+    Кэш ограничен по размеру (LRU) и времени жизни записей. При изменении
+    или удалении API ключа связанные записи сбрасываются через invalidate_api_key;
+    в других воркерах устаревшая запись живет не дольше SERVICE_CACHE_TTL_SECONDS.
     """
 
-    _service_cache: Dict[str, BaseAIService] = {}
+    _service_cache = TTLCache(settings.SERVICE_CACHE_MAX_SIZE, settings.SERVICE_CACHE_TTL_SECONDS)
     _logger = logging.getLogger("ai_service_factory")
 
     @classmethod
@@ -53,6 +60,27 @@ class AIServiceFactory:
         cls._service_cache.clear()
         cls._logger.info("Кэш сервисов очищен")
 
+    @classmethod
+    def invalidate_api_key(cls, api_key_id: int, user_id: int, provider_ids: List[int]) -> None:
+        """
+        Сбрасывает кэшированные сервисы, построенные на API ключе, и пулы ключей.
+
+        Args:
+            api_key_id: ID API ключа
+            user_id: ID владельца ключа
+            provider_ids: ID провайдеров ключа (старый и новый, если провайдер менялся)
+        """
+        cls._service_cache.pop(cls.get_cache_key(api_key_id=api_key_id))
+        for provider_id in set(provider_ids):
+            cls._service_cache.pop(cls.get_cache_key(user_id=user_id, provider_id=provider_id))
+            KeyPoolRegistry.invalidate(user_id, provider_id)
+        cls._logger.debug(f"Кэш сервисов сброшен для API ключа #{api_key_id}")
+
+    @classmethod
+    def get_cache_stats(cls) -> Dict[str, Any]:
+        """Возвращает статистику кэша сервисов"""
+        return cls._service_cache.get_stats()
+
     @classmethod
     def get_cache_key(cls, api_key_id: Optional[int] = None,
                       user_id: Optional[int] = None,
@@ -85,15 +113,15 @@ class AIServiceFactory:
         cache_key = cls.get_cache_key(api_key_id=api_key_id)
 
         # Проверяем кэш
-        if use_cache and cache_key in cls._service_cache:
-            cls._logger.debug(f"Используется кэшированный сервис для API ключа #{api_key_id}")
-            return cls._service_cache[cache_key]
+        if use_cache:
+            service = cls._service_cache.get(cache_key)
+            if service is not None:
+                cls._logger.debug(f"Используется кэшированный сервис для API ключа #{api_key_id}")
+                return service
 
-        # Получаем API ключ из базы данных с загрузкой связанного провайдера
+        # Получаем API ключ из базы данных, провайдера - из каталога в памяти
         result = await db.execute(
-            select(ApiKeyOrm).options(
-                selectinload(ApiKeyOrm.provider)
-            ).filter(
+            select(ApiKeyOrm).filter(
                 ApiKeyOrm.id == api_key_id,
                 ApiKeyOrm.is_active == True
             )
@@ -103,18 +131,23 @@ class AIServiceFactory:
         if not api_key:
             raise APIKeyNotFoundException(f"API ключ с ID {api_key_id} не найден или неактивен")
 
+        provider = await ModelCatalog.get_provider(db, api_key.provider_id)
+
+        if not provider:
+            raise ProviderNotFoundException(f"Провайдер с ID {api_key.provider_id} не найден")
+
         # Проверяем активность провайдера
-        if not api_key.provider.is_active:
-            raise InactiveProviderException(f"Провайдер {api_key.provider.name} неактивен")
+        if not provider.is_active:
+            raise InactiveProviderException(f"Провайдер {provider.name} неактивен")
 
         # Создаем сервис
         try:
-            service_class = api_key.provider.get_service_class()
+            service_class = provider.get_service_class()
             service = service_class(api_key.api_key)
 
             # Кэшируем сервис
             if use_cache:
-                cls._service_cache[cache_key] = service
+                cls._service_cache.set(cache_key, service)
 
             return service
 
@@ -145,27 +178,13 @@ class AIServiceFactory:
             APIKeyNotFoundException: Если API ключ не найден
             ServiceCreationException: При ошибке создания сервиса
         """
-        model = None
-
-        # Обрабатываем случай, когда передан код модели
-        if isinstance(model_id_or_code, str):
-            # Получаем модель по коду
-            result = await db.execute(
-                select(AIModelOrm).filter(AIModelOrm.code == model_id_or_code)
-            )
-            model = result.scalars().first()
+        # Модель берется из каталога в памяти, запрос к БД нужен только за ключом
+        model = await ModelCatalog.find_model(db, model_id_or_code)
 
-            if not model:
+        if not model:
+            if isinstance(model_id_or_code, str):
                 raise ProviderNotFoundException(f"Модель с кодом {model_id_or_code} не найдена")
-        else:
-            # Получаем модель по ID
-            result = await db.execute(
-                select(AIModelOrm).filter(AIModelOrm.id == model_id_or_code)
-            )
-            model = result.scalars().first()
-
-            if not model:
-                raise ProviderNotFoundException(f"Модель с ID {model_id_or_code} не найдена")
+            raise ProviderNotFoundException(f"Модель с ID {model_id_or_code} не найдена")
 
         # Получаем сервис по провайдеру модели
         return await cls.get_service_by_user_and_provider(
@@ -195,46 +214,38 @@ class AIServiceFactory:
             APIKeyNotFoundException: Если API ключ не найден
             ServiceCreationException: При ошибке создания сервиса
         """
-        cache_key = cls.get_cache_key(user_id=user_id, provider_id=provider_id)
-
-        # Проверяем кэш
-        if use_cache and cache_key in cls._service_cache:
-            cls._logger.debug(f"Используется кэшированный сервис для пользователя #{user_id} и провайдера #{provider_id}")
-            return cls._service_cache[cache_key]
-
-        # Проверяем существование провайдера
-        provider_result = await db.execute(
-            select(ProviderOrm).filter(
-                (ProviderOrm.id == provider_id) &
-                (ProviderOrm.is_active == True)
-            )
-        )
-        provider = provider_result.scalars().first()
+        # Проверяем провайдера по каталогу в памяти
+        provider = await ModelCatalog.get_provider(db, provider_id)
 
-        if not provider:
+        if not provider or not provider.is_active:
             raise ProviderNotFoundException(f"Провайдер с ID {provider_id} не найден или неактивен")
 
-        # Получаем активный API ключ пользователя для указанного провайдера
-        api_key_result = await db.execute(
-            select(ApiKeyOrm).filter(
-                (ApiKeyOrm.user_id == user_id) &
-                (ApiKeyOrm.provider_id == provider_id) &
-                (ApiKeyOrm.is_active == True)
-            ).order_by(ApiKeyOrm.created_at.desc())
-        )
-        api_key = api_key_result.scalars().first()
+        # Выбираем наименее загруженный ключ из активных ключей пользователя
+        pool = await KeyPoolRegistry.get_pool(db, user_id, provider_id)
+        pooled_key = pool.choose()
 
-        if not api_key:
+        if not pooled_key:
             raise APIKeyNotFoundException(f"API ключ для провайдера {provider.name} (ID: {provider_id}) не найден")
 
+        cache_key = cls.get_cache_key(api_key_id=pooled_key.api_key_id)
+
+        # Проверяем кэш
+        if use_cache:
+            service = cls._service_cache.get(cache_key)
+            if service is not None and service.api_key == pooled_key.api_key:
+                cls._logger.debug(f"Используется кэшированный сервис для API ключа #{pooled_key.api_key_id}")
+                service.key_usage = pooled_key
+                return service
+
         # Создаем сервис
         try:
             service_class = provider.get_service_class()
-            service = service_class(api_key.api_key)
+            service = service_class(pooled_key.api_key)
+            service.key_usage = pooled_key
 
             # Кэшируем сервис
             if use_cache:
-                cls._service_cache[cache_key] = service
+                cls._service_cache.set(cache_key, service)
 
             return service
 
@@ -1,23 +1,33 @@
 import asyncio
 import anthropic
 from anthropic import AsyncAnthropic
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from sqlalchemy import select
 
 from app.services.base_ai_service import BaseAIService
+from app.services.http_pool import HttpClientPool
+from app.services.request_executor import CircuitOpenException
+from app.services.token_estimator import TokenEstimator
+from app.services.model_catalog import ModelCatalog
 from app.core.settings import settings
-from app.db.models import UsageStatisticsOrm, ProviderOrm, AIModelOrm
+from app.db.models import UsageStatisticsOrm
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import date
 from sqlalchemy.exc import SQLAlchemyError
 
 
+# Множители цены входных токенов при кэшировании промптов
+CACHE_WRITE_PRICE_MULTIPLIER = 1.25
+CACHE_READ_PRICE_MULTIPLIER = 0.1
+
+
 class AnthropicService(BaseAIService):
     """
     Сервис для работы с API Anthropic (Claude).
     """
 
+    provider_code = "anthropic"
+
     def __init__(self, api_key: str):
         """
         Инициализирует сервис Anthropic.
@@ -26,7 +36,14 @@ class AnthropicService(BaseAIService):
             api_key: Ключ API Anthropic
         """
         super().__init__(api_key)
-        self.client = AsyncAnthropic(api_key=api_key)
+        # Соединения берутся из общего пула процесса, а не создаются для каждого ключа
+        self.client = AsyncAnthropic(
+            api_key=api_key,
+            base_url=settings.ANTHROPIC_BASE_URL,
+            http_client=HttpClientPool.get_client(settings.ANTHROPIC_BASE_URL),
+            # Повторы выполняет RequestExecutor с учетом выключателя и deadline
+            max_retries=0
+        )
 
         # Словарь с тарифами на токены для разных моделей Claude
         # Формат: {модель: (стоимость_input_токенов, стоимость_output_токенов)}
@@ -36,11 +53,6 @@ class AnthropicService(BaseAIService):
             "claude-3-haiku": (0.25 / 1000000, 1.25 / 1000000),  # $0.25 за 1M токенов ввода, $1.25 за 1M токенов вывода
         }
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        retry=retry_if_exception_type((anthropic.APIError, anthropic.APIConnectionError, anthropic.RateLimitError))
-    )
     async def generate_completion(self,
                                   prompt: str,
                                   model: str = "claude-3-sonnet",
@@ -62,36 +74,32 @@ class AnthropicService(BaseAIService):
         """
         # Формируем системный промпт
         system_prompt = kwargs.get("system_prompt", "")
+        request_messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
+        system, messages = self.add_cache_breakpoints(system_prompt, [{"role": "user", "content": prompt}])
 
         # Выполняем запрос к API
         try:
-            response = await self.client.messages.create(
-                model=model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                system=system_prompt,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                **{k: v for k, v in kwargs.items() if k not in ["system_prompt"]}
-            )
+            deadline = kwargs.pop("deadline", None)
+            await self.wait_for_rate_limit(request_messages, max_tokens)
+            with self.track_request():
+                response = await self.call_provider(lambda timeout: self.client.messages.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    system=system or anthropic.NOT_GIVEN,
+                    messages=messages,
+                    **{k: v for k, v in kwargs.items() if k not in ["system_prompt"]},
+                    timeout=timeout if timeout is not None else anthropic.NOT_GIVEN
+                ), deadline)
 
             # Извлекаем ответ
             answer = response.content[0].text
 
             # Собираем данные о токенах
-            tokens_data = {
-                "prompt_tokens": response.usage.input_tokens,
-                "completion_tokens": response.usage.output_tokens,
-                "total_tokens": response.usage.input_tokens + response.usage.output_tokens
-            }
+            tokens_data = self.get_tokens_data(response.usage)
 
             # Рассчитываем стоимость запроса
-            cost = await self.calculate_cost(
-                response.usage.input_tokens,
-                response.usage.output_tokens,
-                model
-            )
+            cost = await self.calculate_cost_for_tokens(tokens_data, model)
 
             # Формируем результат
             result = {
@@ -104,26 +112,309 @@ class AnthropicService(BaseAIService):
 
             return result
 
-        except anthropic.APIError as e:
+        except (anthropic.APIError, CircuitOpenException) as e:
             # Обрабатываем ошибки API
-            error_message = str(e)
-            if "rate_limit" in error_message.lower():
-                error_type = "rate_limit"
-            elif "billing" in error_message.lower():
-                error_type = "billing"
-            else:
-                error_type = "routers"
+            return {
+                "error": True,
+                "error_message": str(e),
+                "error_type": self.get_error_type(e)
+            }
+
+    async def generate_completion_with_context(self,
+                                               context: List[Dict[str, str]],
+                                               model: str = "claude-3-sonnet",
+                                               max_tokens: int = 1000,
+                                               temperature: float = 0.7,
+                                               stream=False,
+                                               **kwargs) -> Dict[str, Any]:
+        """
+        Генерирует ответ на основе контекста диалога с использованием Anthropic API.
+
+        Args:
+            context: Список сообщений в формате [{"role": "user", "content": "..."}, ...]
+            model: Имя модели Claude
+            max_tokens: Максимальное количество токенов в ответе
+            temperature: Температура (случайность) ответа
+            stream: Флаг потоковой генерации
+            **kwargs: Дополнительные параметры для API
+
+        Returns:
+            Словарь с ответом и метаданными
+        """
+        if stream:
+            return self.stream_completion_with_context(
+                context=context,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **kwargs
+            )
 
+        system_prompt, messages = self.prepare_messages(context)
+        if not messages:
             return {
                 "error": True,
-                "error_message": error_message,
-                "error_type": error_type
+                "error_message": "В контексте нет сообщений пользователя",
+                "error_type": "invalid_context"
+            }
+
+        system, messages = self.add_cache_breakpoints(system_prompt, messages)
+
+        try:
+            deadline = kwargs.pop("deadline", None)
+            await self.wait_for_rate_limit(context, max_tokens)
+            with self.track_request():
+                response = await self.call_provider(lambda timeout: self.client.messages.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    system=system or anthropic.NOT_GIVEN,
+                    messages=messages,
+                    **kwargs,
+                    timeout=timeout if timeout is not None else anthropic.NOT_GIVEN
+                ), deadline)
+
+            answer = "".join(block.text for block in response.content if block.type == "text")
+
+            tokens_data = self.get_tokens_data(response.usage)
+            cost = await self.calculate_cost_for_tokens(tokens_data, model)
+
+            return {
+                "text": answer,
+                "tokens": tokens_data,
+                "cost": cost,
+                "model": model,
+                "provider": "anthropic",
+                "from_cache": False
+            }
+
+        except (anthropic.APIError, CircuitOpenException) as e:
+            return {
+                "error": True,
+                "error_message": str(e),
+                "error_type": self.get_error_type(e)
+            }
+
+    async def stream_completion_with_context(self,
+                                             context: List[Dict[str, str]],
+                                             model: str = "claude-3-sonnet",
+                                             max_tokens: int = 1000,
+                                             temperature: float = 0.7,
+                                             **kwargs):
+        """
+        Генерирует ответ в потоковом режиме с учетом контекста через Messages streaming API.
+
+        Количество токенов берется из событий потока: input_tokens приходит
+        в message_start, итоговое output_tokens - в message_delta.
+
+        Args:
+            context: Контекст диалога
+            model: Имя модели Claude
+            max_tokens: Максимальное количество токенов
+            temperature: Температура
+
+        Yields:
+            Куски ответа {"text": ...}, затем {"tokens": ..., "cost": ...}
+        """
+        system_prompt, messages = self.prepare_messages(context)
+        if not messages:
+            yield {
+                "error": True,
+                "error_message": "В контексте нет сообщений пользователя",
+                "error_type": "invalid_context"
+            }
+            return
+
+        system, messages = self.add_cache_breakpoints(system_prompt, messages)
+        input_usage = None
+        output_tokens = 0
+        stream = None
+
+        try:
+            deadline = kwargs.pop("deadline", None)
+            await self.wait_for_rate_limit(context, max_tokens)
+            with self.track_request():
+                stream = await self.call_provider(lambda timeout: self.client.messages.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    system=system or anthropic.NOT_GIVEN,
+                    messages=messages,
+                    stream=True,
+                    **kwargs,
+                    timeout=timeout if timeout is not None else anthropic.NOT_GIVEN
+                ), deadline)
+
+                async for event in stream:
+                    if event.type == "message_start":
+                        # Входные токены, в том числе записанные в кэш и прочитанные из него
+                        input_usage = event.message.usage
+                        output_tokens = event.message.usage.output_tokens
+                    elif event.type == "content_block_delta":
+                        if event.delta.type == "text_delta" and event.delta.text:
+                            yield {"text": event.delta.text}
+                    elif event.type == "message_delta":
+                        # output_tokens в message_delta - накопительное значение
+                        output_tokens = event.usage.output_tokens
+
+            tokens_data = self.get_tokens_data(input_usage, output_tokens)
+            cost = await self.calculate_cost_for_tokens(tokens_data, model)
+
+            yield {"tokens": tokens_data, "cost": cost, "from_cache": False}
+
+        except (anthropic.APIError, CircuitOpenException) as e:
+            yield {
+                "error": True,
+                "error_message": str(e),
+                "error_type": self.get_error_type(e)
             }
 
+        finally:
+            # Закрываем HTTP поток сразу, в том числе при отмене генерации
+            if stream is not None:
+                await stream.close()
+
+    @staticmethod
+    def prepare_messages(context: List[Dict[str, str]]) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """
+        Преобразует контекст треда в формат Messages API.
+
+        Системные сообщения выносятся в отдельный параметр system, подряд идущие
+        сообщения одной роли объединяются (API требует чередования ролей),
+        а диалог должен начинаться с сообщения пользователя.
+
+        Args:
+            context: Список сообщений в формате [{"role": "user", "content": "..."}, ...]
+
+        Returns:
+            Кортеж (системный промпт или None, список сообщений)
+        """
+        system_parts = []
+        messages = []
+
+        for message in context:
+            role = message.get("role")
+            content = message.get("content") or ""
+
+            if role == "system":
+                if content:
+                    system_parts.append(content)
+                continue
+
+            if role not in ("user", "assistant") or not content:
+                continue
+
+            if messages and messages[-1]["role"] == role:
+                messages[-1]["content"] += "\n\n" + content
+            else:
+                messages.append({"role": role, "content": content})
+
+        # Отбрасываем ответы ассистента в начале диалога
+        while messages and messages[0]["role"] != "user":
+            messages.pop(0)
+
+        system_prompt = "\n\n".join(system_parts) if system_parts else None
+        return system_prompt, messages
+
+    @staticmethod
+    def add_cache_breakpoints(system_prompt: Optional[str],
+                              messages: List[Dict[str, Any]]) -> Tuple[Any, List[Dict[str, Any]]]:
+        """
+        Расставляет точки кэширования промпта (cache_control) на неизменной части запроса.
+
+        Неизменная часть - системный промпт и все сообщения до последнего
+        сообщения пользователя. Точка ставится на системный промпт и на последнее
+        сообщение истории, если префикс до нее не короче ANTHROPIC_PROMPT_CACHE_MIN_CHARS
+        (более короткие префиксы API не кэширует). На следующем ходе треда
+        API находит в кэше префикс, записанный на предыдущем.
+
+        Args:
+            system_prompt: Системный промпт или None
+            messages: Сообщения в формате Messages API (не изменяются)
+
+        Returns:
+            Кортеж (значение параметра system, сообщения с точками кэширования)
+        """
+        if not settings.ANTHROPIC_PROMPT_CACHE_ENABLED:
+            return system_prompt, messages
+
+        cache_control = {"type": "ephemeral"}
+        min_chars = settings.ANTHROPIC_PROMPT_CACHE_MIN_CHARS
+        system = system_prompt
+        prefix_chars = len(system_prompt or "")
+
+        if system_prompt and prefix_chars >= min_chars:
+            system = [{"type": "text", "text": system_prompt, "cache_control": cache_control}]
+
+        history = messages[:-1]
+        prefix_chars += sum(len(message["content"]) for message in history if isinstance(message["content"], str))
+        if not history or prefix_chars < min_chars or not isinstance(history[-1]["content"], str):
+            return system, messages
+
+        marked = dict(history[-1])
+        marked["content"] = [{"type": "text", "text": marked["content"], "cache_control": cache_control}]
+        return system, history[:-1] + [marked, messages[-1]]
+
+    @staticmethod
+    def get_tokens_data(usage: Any, output_tokens: Optional[int] = None) -> Dict[str, int]:
+        """
+        Собирает данные о токенах из usage ответа Anthropic.
+
+        input_tokens в ответе не включает токены, записанные в кэш и прочитанные
+        из него, поэтому prompt_tokens - их сумма. Счетчики кэша добавляются,
+        только если кэш использовался.
+
+        Args:
+            usage: usage из ответа или события message_start (может быть None)
+            output_tokens: Итоговое количество токенов ответа (для потока)
+
+        Returns:
+            Словарь с количеством токенов
+        """
+        input_tokens = getattr(usage, "input_tokens", None) or 0
+        cache_creation_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+        cache_read_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+        if output_tokens is None:
+            output_tokens = getattr(usage, "output_tokens", None) or 0
+
+        prompt_tokens = input_tokens + cache_creation_tokens + cache_read_tokens
+        tokens_data = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": output_tokens,
+            "total_tokens": prompt_tokens + output_tokens
+        }
+        if cache_creation_tokens or cache_read_tokens:
+            tokens_data["cache_creation_tokens"] = cache_creation_tokens
+            tokens_data["cache_read_tokens"] = cache_read_tokens
+        return tokens_data
+
+    @staticmethod
+    def get_error_type(error: Exception) -> str:
+        """
+        Определяет тип ошибки Anthropic API для ответа клиенту.
+
+        Args:
+            error: Исключение Anthropic SDK
+
+        Returns:
+            Строковый тип ошибки
+        """
+        if isinstance(error, CircuitOpenException):
+            return "provider_unavailable"
+        error_message = str(error).lower()
+        if isinstance(error, anthropic.RateLimitError) or "rate_limit" in error_message:
+            return "rate_limit"
+        if "billing" in error_message:
+            return "billing"
+        return "api_error"
+
     async def calculate_tokens(self, text: str, model: str = "claude-3-sonnet") -> Dict[str, int]:
         """
         Рассчитывает примерное количество токенов в тексте для моделей Claude.
 
+        Локального токенизатора Claude нет, поэтому используется оценка
+        по видам символов с коэффициентами, подобранными по истории сообщений.
+
         Args:
             text: Текст для подсчета токенов
             model: Имя модели
@@ -131,24 +422,28 @@ class AnthropicService(BaseAIService):
         Returns:
             Словарь с количеством токенов
         """
-        # Для Claude используем приблизительную оценку, поскольку нет официальной библиотеки для подсчета
-        # В среднем 1 токен = 4 символа для английского текста
-        # Для других языков и символов пропорция может отличаться
-        token_count = len(text) // 4
+        token_count = TokenEstimator.estimate(text, model)
 
         return {
             "token_count": token_count,
             "estimated": True  # Флаг, указывающий, что это оценка
         }
 
-    async def calculate_cost(self, prompt_tokens: int, completion_tokens: int, model: str) -> float:
+    async def calculate_cost(self,
+                             prompt_tokens: int,
+                             completion_tokens: int,
+                             model: str,
+                             cache_creation_tokens: int = 0,
+                             cache_read_tokens: int = 0) -> float:
         """
         Рассчитывает стоимость запроса на основе токенов для моделей Claude.
 
         Args:
-            prompt_tokens: Количество токенов в запросе
+            prompt_tokens: Количество токенов в запросе (включая токены кэша)
             completion_tokens: Количество токенов в ответе
             model: Имя модели
+            cache_creation_tokens: Токены запроса, записанные в кэш
+            cache_read_tokens: Токены запроса, прочитанные из кэша
 
         Returns:
             Стоимость в долларах
@@ -158,89 +453,100 @@ class AnthropicService(BaseAIService):
             model, self.token_pricing["claude-3-sonnet"]
         )
 
-        # Рассчитываем стоимость
-        input_cost = prompt_tokens * input_price
+        # Рассчитываем стоимость: запись в кэш дороже обычного ввода, чтение - дешевле
+        uncached_tokens = max(0, prompt_tokens - cache_creation_tokens - cache_read_tokens)
+        input_cost = (uncached_tokens * input_price +
+                      cache_creation_tokens * input_price * CACHE_WRITE_PRICE_MULTIPLIER +
+                      cache_read_tokens * input_price * CACHE_READ_PRICE_MULTIPLIER)
         output_cost = completion_tokens * output_price
         total_cost = input_cost + output_cost
 
         return total_cost
 
+    async def calculate_cost_for_tokens(self, tokens_data: Dict[str, int], model: str) -> float:
+        """Рассчитывает стоимость по данным о токенах из get_tokens_data"""
+        return await self.calculate_cost(
+            tokens_data.get("prompt_tokens", 0),
+            tokens_data.get("completion_tokens", 0),
+            model,
+            cache_creation_tokens=tokens_data.get("cache_creation_tokens", 0),
+            cache_read_tokens=tokens_data.get("cache_read_tokens", 0)
+        )
 
-async def update_usage_statistics(self,
-                                  db: AsyncSession,
-                                  user_id: int,
-                                  tokens_data: Dict[str, int],
-                                  model: str,
-                                  cost: float) -> None:
-    """
-    Обновляет статистику использования API в базе данных.
-
-    Args:
-        db: Сессия базы данных
-        user_id: ID пользователя
-        tokens_data: Данные о токенах
-        model: Название модели
-        cost: Стоимость запроса
-    """
-    try:
-        today = date.today()
+    async def update_usage_statistics(self,
+                                      db: AsyncSession,
+                                      user_id: int,
+                                      tokens_data: Dict[str, int],
+                                      model: str,
+                                      cost: float) -> None:
+        """
+        Обновляет статистику использования API в базе данных.
 
-        # Получаем ID провайдера Anthropic
-        provider_query = select(ProviderOrm).filter(ProviderOrm.code == "anthropic")
-        provider_result = await db.execute(provider_query)
-        provider = provider_result.scalars().first()
+        Args:
+            db: Сессия базы данных
+            user_id: ID пользователя
+            tokens_data: Данные о токенах
+            model: Название модели
+            cost: Стоимость запроса
+        """
+        try:
+            today = date.today()
 
-        if not provider:
-            print("Провайдер Anthropic не найден в базе данных")
-            return
+            # Провайдер и модель берутся из каталога в памяти
+            provider = await ModelCatalog.get_provider_by_code(db, "anthropic")
 
-        # Получаем ID модели по коду модели и ID провайдера
-        model_query = select(AIModelOrm).filter(
-            AIModelOrm.code == model,
-            AIModelOrm.provider_id == provider.id
-        )
-        model_result = await db.execute(model_query)
-        model_obj = model_result.scalars().first()
+            if not provider:
+                print("Провайдер Anthropic не найден в базе данных")
+                return
 
-        if not model_obj:
-            print(f"Модель {model} не найдена в базе данных")
-            return
+            # Получаем модель по коду модели и ID провайдера
+            model_obj = await ModelCatalog.find_model(db, model, provider.id)
 
-        # Ищем или создаем запись статистики за сегодня
-        query = select(UsageStatisticsOrm).filter(
-            UsageStatisticsOrm.user_id == user_id,
-            UsageStatisticsOrm.provider_id == provider.id,
-            UsageStatisticsOrm.model_id == model_obj.id,
-            UsageStatisticsOrm.request_date == today
-        )
+            if not model_obj:
+                print(f"Модель {model} не найдена в базе данных")
+                return
 
-        result = await db.execute(query)
-        usage_stat = result.scalars().first()
-
-        if usage_stat:
-            # Обновляем существующую запись
-            usage_stat.request_count += 1
-            usage_stat.tokens_prompt += tokens_data.get("prompt_tokens", 0)
-            usage_stat.tokens_completion += tokens_data.get("completion_tokens", 0)
-            usage_stat.total_tokens += tokens_data.get("total_tokens", 0)
-            usage_stat.estimated_cost += cost
-        else:
-            # Создаем новую запись
-            new_stat = UsageStatisticsOrm(
-                user_id=user_id,
-                provider_id=provider.id,
-                model_id=model_obj.id,
-                request_date=today,
-                request_count=1,
-                tokens_prompt=tokens_data.get("prompt_tokens", 0),
-                tokens_completion=tokens_data.get("completion_tokens", 0),
-                total_tokens=tokens_data.get("total_tokens", 0),
-                estimated_cost=cost
+            # Ищем или создаем запись статистики за сегодня
+            query = select(UsageStatisticsOrm).filter(
+                UsageStatisticsOrm.user_id == user_id,
+                UsageStatisticsOrm.provider_id == provider.id,
+                UsageStatisticsOrm.model_id == model_obj.id,
+                UsageStatisticsOrm.request_date == today
             )
-            db.add(new_stat)
 
-        await db.commit()
-    except SQLAlchemyError as e:
-        await db.rollback()
-        # Логирование ошибки
-        print(f"Error updating usage statistics: {str(e)}")
\ No newline at end of file
+            result = await db.execute(query)
+            usage_stat = result.scalars().first()
+
+            if usage_stat:
+                # Обновляем существующую запись
+                usage_stat.request_count += 1
+                usage_stat.tokens_prompt += tokens_data.get("prompt_tokens", 0)
+                usage_stat.tokens_completion += tokens_data.get("completion_tokens", 0)
+                usage_stat.total_tokens += tokens_data.get("total_tokens", 0)
+                usage_stat.tokens_cache_write = (usage_stat.tokens_cache_write or 0) + \
+                    tokens_data.get("cache_creation_tokens", 0)
+                usage_stat.tokens_cache_read = (usage_stat.tokens_cache_read or 0) + \
+                    tokens_data.get("cache_read_tokens", 0)
+                usage_stat.estimated_cost += cost
+            else:
+                # Создаем новую запись
+                new_stat = UsageStatisticsOrm(
+                    user_id=user_id,
+                    provider_id=provider.id,
+                    model_id=model_obj.id,
+                    request_date=today,
+                    request_count=1,
+                    tokens_prompt=tokens_data.get("prompt_tokens", 0),
+                    tokens_completion=tokens_data.get("completion_tokens", 0),
+                    total_tokens=tokens_data.get("total_tokens", 0),
+                    tokens_cache_write=tokens_data.get("cache_creation_tokens", 0),
+                    tokens_cache_read=tokens_data.get("cache_read_tokens", 0),
+                    estimated_cost=cost
+                )
+                db.add(new_stat)
+
+            await db.commit()
+        except SQLAlchemyError as e:
+            await db.rollback()
+            # Логирование ошибки
+            print(f"Error updating usage statistics: {str(e)}")
\ No newline at end of file
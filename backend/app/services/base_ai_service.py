@@ -1,6 +1,20 @@
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from typing import Dict, Any, Optional, List
 
+from app.core.settings import settings
+from app.services.rate_limiter import RateLimiterRegistry
+from app.services.request_executor import RequestExecutor
+
+# Коды ответа, после которых запрос имеет смысл повторить
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+def get_default_deadline() -> float:
+    """Возвращает deadline запроса к провайдеру для вызовов без собственного таймаута"""
+    return time.monotonic() + settings.PROVIDER_REQUEST_DEADLINE_SECONDS
+
 
 class BaseAIService(ABC):
     """
@@ -8,8 +22,125 @@ class BaseAIService(ABC):
     Определяет общий интерфейс и вспомогательные методы.
     """
 
+    # Код провайдера для выключателя запросов и метрик
+    provider_code = "unknown"
+
     def __init__(self, api_key: str):
         self.api_key = api_key
+        # Счетчики ключа в пуле (PooledKey), назначаются фабрикой сервисов
+        self.key_usage = None
+        # Локальный лимит запросов ключа по заголовкам провайдера
+        self.rate_limiter = RateLimiterRegistry.get(api_key)
+
+    @staticmethod
+    def estimate_request_tokens(messages: List[Dict[str, str]], max_tokens: int) -> int:
+        """
+        Быстро оценивает токены запроса для лимита провайдера (без токенизатора).
+
+        Args:
+            messages: Сообщения запроса
+            max_tokens: Максимальное количество токенов в ответе
+
+        Returns:
+            Оценка токенов (в среднем 4 символа = 1 токен)
+        """
+        return sum(len(message.get("content") or "") for message in messages) // 4 + (max_tokens or 0)
+
+    def get_expected_wait(self, messages: List[Dict[str, str]], max_tokens: int) -> float:
+        """
+        Возвращает ожидаемую задержку запроса из-за лимитов ключа.
+
+        Args:
+            messages: Сообщения запроса
+            max_tokens: Максимальное количество токенов в ответе
+
+        Returns:
+            Время ожидания в секундах (0 - запрос уйдет сразу)
+        """
+        return self.rate_limiter.expected_wait(self.estimate_request_tokens(messages, max_tokens))
+
+    async def wait_for_rate_limit(self, messages: List[Dict[str, str]], max_tokens: int) -> None:
+        """Дожидается свободного места в лимитах ключа перед запросом к провайдеру"""
+        await self.rate_limiter.acquire(self.estimate_request_tokens(messages, max_tokens))
+
+    @contextmanager
+    def track_request(self):
+        """
+        Учитывает запрос к провайдеру в счетчиках ключа.
+
+        Оборачивает вызов API: увеличивает число запросов в работе, а при ответе 429
+        отправляет ключ на охлаждение, чтобы пул выбирал другие ключи.
+        """
+        if self.key_usage is None:
+            yield
+            return
+
+        self.key_usage.request_started()
+        try:
+            yield
+        except Exception as e:
+            self.key_usage.request_finished(e, self.is_rate_limit_error(e), self.get_retry_after(e))
+            raise
+        except BaseException:
+            # Отмена генерации не считается ошибкой ключа
+            self.key_usage.request_finished()
+            raise
+        else:
+            self.key_usage.request_finished()
+
+    async def call_provider(self, call, deadline: Optional[float] = None):
+        """
+        Выполняет запрос к провайдеру через общий исполнитель (выключатель и повторы).
+
+        Args:
+            call: Функция запроса, принимает таймаут попытки в секундах или None
+            deadline: Крайний момент завершения по time.monotonic()
+                (по умолчанию через PROVIDER_REQUEST_DEADLINE_SECONDS)
+
+        Returns:
+            Результат запроса
+        """
+        if deadline is None:
+            deadline = get_default_deadline()
+        return await RequestExecutor.execute(
+            self.provider_code, call, self.is_retryable_error, self.is_provider_failure, deadline
+        )
+
+    def is_retryable_error(self, error: Exception) -> bool:
+        """Проверяет, имеет ли смысл повторить запрос после ошибки"""
+        status_code = getattr(error, "status_code", None)
+        if status_code is not None:
+            return status_code in RETRYABLE_STATUS_CODES
+        return self.is_connection_error(error)
+
+    def is_provider_failure(self, error: Exception) -> bool:
+        """Проверяет, что ошибка говорит о сбое провайдера, а не о проблеме запроса или ключа"""
+        status_code = getattr(error, "status_code", None)
+        if status_code is not None:
+            return status_code >= 500
+        return self.is_connection_error(error)
+
+    @staticmethod
+    def is_connection_error(error: Exception) -> bool:
+        """Проверяет, что запрос не дошел до провайдера или не дождался ответа"""
+        return isinstance(error, (ConnectionError, TimeoutError)) or \
+            type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+    @staticmethod
+    def is_rate_limit_error(error: Exception) -> bool:
+        """Проверяет, что провайдер отклонил запрос из-за лимита (HTTP 429)"""
+        return getattr(error, "status_code", None) == 429
+
+    @staticmethod
+    def get_retry_after(error: Exception) -> Optional[float]:
+        """Возвращает паузу из заголовка Retry-After ответа с ошибкой, если он есть"""
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
 
     @abstractmethod
     async def generate_completion(self,
@@ -82,6 +213,49 @@ class BaseAIService(ABC):
             **kwargs
         )
 
+    async def stream_completion_with_context(self,
+                                             context: List[Dict[str, str]],
+                                             model: str,
+                                             max_tokens: int = 1000,
+                                             temperature: float = 0.7,
+                                             **kwargs):
+        """
+        Генерирует ответ в потоковом режиме с учетом контекста.
+
+        Реализация по умолчанию для провайдеров без потокового API: выполняет
+        обычный запрос и отдает ответ одним куском. Сервисы с поддержкой
+        стриминга должны переопределить этот метод.
+
+        Args:
+            context: Контекст диалога
+            model: Имя модели
+            max_tokens: Максимальное количество токенов в ответе
+            temperature: Температура (случайность) ответа
+            **kwargs: Дополнительные параметры для API
+
+        Yields:
+            Куски ответа {"text": ...}, затем {"tokens": ...} или {"error": True, ...}
+        """
+        result = await self.generate_completion_with_context(
+            context=context,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs
+        )
+
+        if result.get("error"):
+            yield result
+            return
+
+        if result.get("text"):
+            yield {"text": result["text"]}
+
+        final_chunk = {"tokens": result.get("tokens", {}), "from_cache": result.get("from_cache", False)}
+        if "cost" in result:
+            final_chunk["cost"] = result["cost"]
+        yield final_chunk
+
     @abstractmethod
     async def calculate_tokens(self, text: str, model: str) -> Dict[str, int]:
         """
@@ -0,0 +1,497 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.settings import settings
+from app.db.models import CompletionCacheOrm, CacheStatisticsOrm
+from app.services.base_ai_service import BaseAIService
+from app.services.near_duplicate_index import NearDuplicateRegistry, NEAR_DUPLICATE_REUSE
+from app.utils.ttl_cache import TTLCache
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class CompletionCache:
+    """
+    Кэш ответов AI по точному совпадению запроса.
+
+    Ключ - sha256 от (модель, нормализованный контекст, системный промпт,
+    max_tokens). Кэш используется только для детерминированных запросов
+    (temperature == 0) или если пользователь явно включил use_cache.
+    Ответы, сохраненные только для поиска похожих запросов, хранятся
+    под отдельными ключами и по точному совпадению не отдаются.
+    Первый уровень - LRU в памяти процесса, второй - таблица completion_cache
+    в PostgreSQL, общая для всех воркеров. Попадания и промахи учитываются
+    в cache_statistics по пользователям и дням.
+    """
+
+    _memory = TTLCache(settings.COMPLETION_CACHE_MAX_SIZE, settings.COMPLETION_CACHE_TTL_SECONDS)
+    _logger = logging.getLogger("completion_cache")
+
+    @staticmethod
+    def is_cacheable(temperature: Optional[float], use_cache: bool = False) -> bool:
+        """Проверяет, можно ли отдавать ответ на запрос из кэша"""
+        return bool(use_cache) or temperature == 0
+
+    @staticmethod
+    def normalize_text(text: Optional[str]) -> str:
+        """Схлопывает пробельные символы, чтобы различия в форматировании не влияли на ключ"""
+        return _WHITESPACE.sub(" ", text or "").strip()
+
+    @classmethod
+    def make_key(cls,
+                 model: str,
+                 context: List[Dict[str, str]],
+                 max_tokens: int,
+                 system_prompt: Optional[str] = None,
+                 near_duplicates_only: bool = False) -> str:
+        """
+        Формирует ключ кэша для запроса.
+
+        Args:
+            model: Код модели
+            context: Сообщения запроса в формате [{"role": "user", "content": "..."}, ...]
+            max_tokens: Максимальное количество токенов в ответе
+            system_prompt: Системный промпт, переданный отдельно от контекста (опционально)
+            near_duplicates_only: Ключ для ответа, который нельзя отдавать по точному совпадению
+                (запрос не кэшируемый, ответ сохраняется только для поиска похожих запросов)
+
+        Returns:
+            Hex-строка sha256
+        """
+        messages = [
+            [message.get("role"), cls.normalize_text(message.get("content"))]
+            for message in context
+            if message.get("content")
+        ]
+        parts = [str(model), messages, cls.normalize_text(system_prompt), max_tokens]
+        if near_duplicates_only:
+            parts.append("near_duplicates_only")
+        payload = json.dumps(
+            parts,
+            ensure_ascii=False,
+            separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @classmethod
+    async def get(cls, db: AsyncSession, cache_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Ищет ответ сначала в памяти процесса, затем в базе данных.
+
+        Args:
+            db: Сессия базы данных
+            cache_key: Ключ кэша
+
+        Returns:
+            Словарь {"response", "tokens", "cost"} или None
+        """
+        entry = cls._memory.get(cache_key)
+        if entry is not None:
+            return entry
+
+        border = datetime.now(timezone.utc) - timedelta(seconds=settings.COMPLETION_CACHE_TTL_SECONDS)
+        try:
+            result = await db.execute(
+                select(CompletionCacheOrm).filter(
+                    (CompletionCacheOrm.cache_key == cache_key) &
+                    (CompletionCacheOrm.created_at >= border)
+                )
+            )
+            row = result.scalars().first()
+        except SQLAlchemyError as e:
+            cls._logger.warning(f"Ошибка чтения кэша ответов: {str(e)}")
+            return None
+
+        if row is None:
+            return None
+
+        entry = {
+            "response": row.response,
+            "tokens": {
+                "prompt_tokens": row.tokens_prompt or 0,
+                "completion_tokens": row.tokens_completion or 0,
+                "total_tokens": row.total_tokens or 0
+            },
+            "cost": row.cost or 0.0
+        }
+        cls._memory.set(cache_key, entry)
+        return entry
+
+    @classmethod
+    async def put(cls,
+                  db: AsyncSession,
+                  cache_key: str,
+                  provider_code: Optional[str],
+                  model: str,
+                  response: str,
+                  tokens_data: Dict[str, int],
+                  cost: float) -> None:
+        """
+        Сохраняет ответ в оба уровня кэша.
+
+        Args:
+            db: Сессия базы данных
+            cache_key: Ключ кэша
+            provider_code: Код провайдера
+            model: Код модели
+            response: Текст ответа
+            tokens_data: Данные о токенах ответа
+            cost: Стоимость запроса к провайдеру
+        """
+        entry = {"response": response, "tokens": dict(tokens_data), "cost": cost or 0.0}
+        cls._memory.set(cache_key, entry)
+
+        try:
+            # Одинаковый запрос мог прийти одновременно в несколько воркеров
+            await db.execute(
+                insert(CompletionCacheOrm).values(
+                    cache_key=cache_key,
+                    provider_code=provider_code,
+                    model_code=str(model),
+                    response=response,
+                    tokens_prompt=tokens_data.get("prompt_tokens", 0),
+                    tokens_completion=tokens_data.get("completion_tokens", 0),
+                    total_tokens=tokens_data.get("total_tokens", 0),
+                    cost=cost or 0.0
+                ).on_conflict_do_update(
+                    index_elements=[CompletionCacheOrm.cache_key],
+                    set_={"response": response, "cost": cost or 0.0, "created_at": func.now()}
+                )
+            )
+            await db.commit()
+        except SQLAlchemyError as e:
+            await db.rollback()
+            cls._logger.warning(f"Ошибка сохранения ответа в кэш: {str(e)}")
+
+    @classmethod
+    async def record_hit(cls, db: AsyncSession, user_id: int, cache_key: str, entry: Dict[str, Any]) -> None:
+        """Учитывает попадание в кэш и сэкономленные токены и стоимость"""
+        try:
+            await db.execute(
+                update(CompletionCacheOrm)
+                .where(CompletionCacheOrm.cache_key == cache_key)
+                .values(hit_count=CompletionCacheOrm.hit_count + 1, last_hit_at=func.now())
+            )
+            await cls._update_statistics(
+                db, user_id,
+                hits=1,
+                tokens_saved=entry["tokens"].get("total_tokens", 0),
+                cost_saved=entry.get("cost", 0.0)
+            )
+        except SQLAlchemyError as e:
+            await db.rollback()
+            cls._logger.warning(f"Ошибка обновления статистики кэша: {str(e)}")
+
+    @classmethod
+    async def record_miss(cls, db: AsyncSession, user_id: int) -> None:
+        """Учитывает промах кэша"""
+        try:
+            await cls._update_statistics(db, user_id, misses=1)
+        except SQLAlchemyError as e:
+            await db.rollback()
+            cls._logger.warning(f"Ошибка обновления статистики кэша: {str(e)}")
+
+    @staticmethod
+    async def _update_statistics(db: AsyncSession,
+                                 user_id: int,
+                                 hits: int = 0,
+                                 misses: int = 0,
+                                 tokens_saved: int = 0,
+                                 cost_saved: float = 0.0) -> None:
+        today = date.today()
+
+        result = await db.execute(
+            select(CacheStatisticsOrm).filter(
+                (CacheStatisticsOrm.user_id == user_id) &
+                (CacheStatisticsOrm.request_date == today)
+            )
+        )
+        stat = result.scalars().first()
+
+        if stat:
+            stat.hits += hits
+            stat.misses += misses
+            stat.tokens_saved += tokens_saved
+            stat.cost_saved += cost_saved
+        else:
+            db.add(CacheStatisticsOrm(
+                user_id=user_id,
+                request_date=today,
+                hits=hits,
+                misses=misses,
+                tokens_saved=tokens_saved,
+                cost_saved=cost_saved
+            ))
+
+        await db.commit()
+
+    @classmethod
+    async def _find_near_duplicate(cls,
+                                   db: AsyncSession,
+                                   user_id: int,
+                                   model: str,
+                                   signature: Tuple[int, ...]) -> Optional[Tuple[str, Dict[str, Any], float]]:
+        """Ищет сохраненный ответ на похожий запрос пользователя к той же модели"""
+        match = NearDuplicateRegistry.find(user_id, model, signature)
+        if match is None:
+            return None
+
+        near_key, similarity = match
+        entry = await cls.get(db, near_key)
+        if entry is None:
+            # Ответ удален из кэша или устарел
+            NearDuplicateRegistry.discard(user_id, model, near_key)
+            return None
+        return near_key, entry, similarity
+
+    @staticmethod
+    async def _signature(context: List[Dict[str, str]]) -> Tuple[int, ...]:
+        # Вычисление сигнатуры длинного контекста занимает миллисекунды, не держим на нем event loop
+        return await asyncio.to_thread(NearDuplicateRegistry.signature, context)
+
+    @classmethod
+    async def stream(cls,
+                     db: AsyncSession,
+                     user_id: int,
+                     ai_service: BaseAIService,
+                     context: List[Dict[str, str]],
+                     model: str,
+                     max_tokens: int,
+                     temperature: float,
+                     use_cache: bool = False,
+                     near_duplicates: Optional[str] = None,
+                     **kwargs) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Потоковая генерация с проверкой кэша.
+
+        При попадании ответ отдается одним куском, последний кусок содержит
+        from_cache=True и нулевую стоимость. При промахе куски провайдера
+        передаются без изменений, а успешный полный ответ сохраняется в кэш
+        (ответ на некэшируемый запрос - только для поиска похожих запросов).
+
+        Если включен поиск похожих запросов (near_duplicates), после промаха
+        по точному ключу ищется похожий запрос пользователя к той же модели:
+        в режиме reuse его ответ возвращается вместо запроса к провайдеру,
+        в режиме preview отдается куском {"preview": ..., "similarity": ...},
+        после чего выполняется настоящий запрос.
+
+        Args:
+            db: Сессия базы данных
+            user_id: ID пользователя
+            ai_service: Сервис AI
+            context: Сообщения запроса
+            model: Код модели
+            max_tokens: Максимальное количество токенов в ответе
+            temperature: Температура ответа
+            use_cache: Пользователь разрешил кэш для недетерминированного запроса
+            near_duplicates: Режим использования похожих запросов (reuse, preview или None)
+            **kwargs: Дополнительные параметры для сервиса
+
+        Yields:
+            Куски ответа в формате stream_completion_with_context
+        """
+        cacheable = cls.is_cacheable(temperature, use_cache)
+        if not cacheable and not near_duplicates:
+            async for chunk in ai_service.stream_completion_with_context(
+                    context=context, model=model, max_tokens=max_tokens, temperature=temperature, **kwargs
+            ):
+                yield chunk
+            return
+
+        cache_key = cls.make_key(model, context, max_tokens)
+        if cacheable:
+            entry = await cls.get(db, cache_key)
+            if entry is not None:
+                await cls.record_hit(db, user_id, cache_key, entry)
+                yield {"text": entry["response"]}
+                yield {"tokens": entry["tokens"], "cost": 0.0, "from_cache": True}
+                return
+
+        signature = None
+        if near_duplicates:
+            signature = await cls._signature(context)
+            near = await cls._find_near_duplicate(db, user_id, model, signature)
+            if near is not None:
+                near_key, entry, similarity = near
+                if near_duplicates == NEAR_DUPLICATE_REUSE:
+                    await cls.record_hit(db, user_id, near_key, entry)
+                    yield {"text": entry["response"]}
+                    yield {
+                        "tokens": entry["tokens"],
+                        "cost": 0.0,
+                        "from_cache": True,
+                        "similarity": round(similarity, 3)
+                    }
+                    return
+                yield {"preview": entry["response"], "similarity": round(similarity, 3)}
+
+        if cacheable or near_duplicates == NEAR_DUPLICATE_REUSE:
+            await cls.record_miss(db, user_id)
+
+        response_parts = []
+        tokens_data = None
+        cost = None
+        failed = False
+        async for chunk in ai_service.stream_completion_with_context(
+                context=context, model=model, max_tokens=max_tokens, temperature=temperature, **kwargs
+        ):
+            if chunk.get("error", False):
+                failed = True
+            elif chunk.get("text"):
+                response_parts.append(chunk["text"])
+            elif "tokens" in chunk:
+                tokens_data = chunk["tokens"]
+                cost = chunk.get("cost")
+            yield chunk
+
+        if failed or not response_parts or tokens_data is None:
+            return
+
+        if cost is None:
+            cost = await ai_service.calculate_cost(
+                tokens_data.get("prompt_tokens", 0), tokens_data.get("completion_tokens", 0), model
+            )
+        store_key = cache_key if cacheable else cls.make_key(model, context, max_tokens, near_duplicates_only=True)
+        await cls.put(db, store_key, ai_service.provider_code, model, "".join(response_parts), tokens_data, cost)
+        if signature is not None:
+            NearDuplicateRegistry.add(user_id, model, signature, store_key)
+
+    @classmethod
+    async def complete(cls,
+                       db: AsyncSession,
+                       user_id: int,
+                       ai_service: BaseAIService,
+                       context: List[Dict[str, str]],
+                       model: str,
+                       max_tokens: int,
+                       temperature: float,
+                       use_cache: bool = False,
+                       near_duplicates: Optional[str] = None,
+                       **kwargs) -> Dict[str, Any]:
+        """
+        Генерация ответа целиком с проверкой кэша.
+
+        Без потока показывать предварительный ответ некуда, поэтому из режимов
+        поиска похожих запросов действует только reuse.
+
+        Args:
+            db: Сессия базы данных
+            user_id: ID пользователя
+            ai_service: Сервис AI
+            context: Сообщения запроса
+            model: Код модели
+            max_tokens: Максимальное количество токенов в ответе
+            temperature: Температура ответа
+            use_cache: Пользователь разрешил кэш для недетерминированного запроса
+            near_duplicates: Режим использования похожих запросов (reuse, preview или None)
+            **kwargs: Дополнительные параметры для сервиса
+
+        Returns:
+            Результат в формате generate_completion_with_context
+        """
+        cacheable = cls.is_cacheable(temperature, use_cache)
+        if not cacheable and not near_duplicates:
+            return await ai_service.generate_completion_with_context(
+                context=context, model=model, max_tokens=max_tokens, temperature=temperature, **kwargs
+            )
+
+        cache_key = cls.make_key(model, context, max_tokens)
+        entry, similarity = None, None
+        hit_key = cache_key
+        if cacheable:
+            entry = await cls.get(db, cache_key)
+
+        signature = None
+        if entry is None and near_duplicates:
+            signature = await cls._signature(context)
+            if near_duplicates == NEAR_DUPLICATE_REUSE:
+                near = await cls._find_near_duplicate(db, user_id, model, signature)
+                if near is not None:
+                    hit_key, entry, similarity = near
+
+        if entry is not None:
+            await cls.record_hit(db, user_id, hit_key, entry)
+            result = {
+                "text": entry["response"],
+                "model": model,
+                "provider": ai_service.provider_code,
+                "tokens": entry["tokens"],
+                "cost": 0.0,
+                "from_cache": True
+            }
+            if similarity is not None:
+                result["similarity"] = round(similarity, 3)
+            return result
+
+        if cacheable or near_duplicates == NEAR_DUPLICATE_REUSE:
+            await cls.record_miss(db, user_id)
+
+        result = await ai_service.generate_completion_with_context(
+            context=context, model=model, max_tokens=max_tokens, temperature=temperature, **kwargs
+        )
+        if result.get("error", False) or not result.get("text"):
+            return result
+
+        tokens_data = result.get("tokens", {})
+        cost = result.get("cost")
+        if cost is None:
+            cost = await ai_service.calculate_cost(
+                tokens_data.get("prompt_tokens", 0), tokens_data.get("completion_tokens", 0), model
+            )
+        store_key = cache_key if cacheable else cls.make_key(model, context, max_tokens, near_duplicates_only=True)
+        await cls.put(db, store_key, ai_service.provider_code, model, result["text"], tokens_data, cost)
+        if signature is not None:
+            NearDuplicateRegistry.add(user_id, model, signature, store_key)
+        return result
+
+    @staticmethod
+    async def get_statistics(db: AsyncSession, user_id: int, days: int = 30) -> Dict[str, Any]:
+        """
+        Возвращает статистику кэша пользователя за период.
+
+        Args:
+            db: Сессия базы данных
+            user_id: ID пользователя
+            days: Количество дней
+
+        Returns:
+            Словарь с попаданиями, промахами, долей попаданий и экономией
+        """
+        start_date = date.today() - timedelta(days=days)
+        result = await db.execute(
+            select(
+                func.sum(CacheStatisticsOrm.hits).label("hits"),
+                func.sum(CacheStatisticsOrm.misses).label("misses"),
+                func.sum(CacheStatisticsOrm.tokens_saved).label("tokens_saved"),
+                func.sum(CacheStatisticsOrm.cost_saved).label("cost_saved")
+            ).filter(
+                (CacheStatisticsOrm.user_id == user_id) &
+                (CacheStatisticsOrm.request_date >= start_date)
+            )
+        )
+        stats = result.one()
+
+        hits = stats.hits or 0
+        misses = stats.misses or 0
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses > 0 else 0,
+            "tokens_saved": stats.tokens_saved or 0,
+            "cost_saved": stats.cost_saved or 0
+        }
+
+    @classmethod
+    def get_memory_stats(cls) -> Dict[str, Any]:
+        """Возвращает статистику уровня кэша в памяти текущего воркера"""
+        return cls._memory.get_stats()
@@ -0,0 +1,328 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.settings import settings
+from app.db.models import MessageOrm, ThreadSummaryOrm
+from app.services.model_catalog import ModelCatalog
+from app.services.thread_context_cache import ThreadContextCache
+from app.services.token_estimator import TokenEstimator
+from app.utils.token_counter import TokenizerRegistry, get_message_tokens, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+
+# Длина контекста, если модель не найдена в каталоге
+DEFAULT_CONTEXT_LENGTH = 4096
+# Меньший остаток бюджета не используется для обрезанного сообщения
+MIN_TRUNCATED_TOKENS = 64
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+
+# Что делать, если новое сообщение не помещается в бюджет (CONTEXT_OVERFLOW_POLICY)
+OVERFLOW_TRIM = "trim"  # Оставить конец сообщения
+OVERFLOW_REJECT = "reject"  # Отклонить запрос
+
+
+class ContextBudgetExceededException(Exception):
+    """Исключение при превышении бюджета токенов модели до отправки запроса провайдеру"""
+
+    def __init__(self, tokens_required: int, max_context_length: int, max_tokens: int):
+        self.tokens_required = tokens_required
+        self.max_context_length = max_context_length
+        self.max_tokens = max_tokens
+        self.tokens_over = tokens_required - max_context_length
+        super().__init__(
+            f"Запрос превышает контекст модели на {self.tokens_over} токенов: "
+            f"нужно {tokens_required} (включая max_tokens {max_tokens}), доступно {max_context_length}"
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Возвращает описание ошибки в формате ответов сервисов"""
+        return {
+            "error": True,
+            "error_type": "context_length_exceeded",
+            "error_message": str(self),
+            "tokens_required": self.tokens_required,
+            "tokens_over": self.tokens_over,
+            "max_context_length": self.max_context_length,
+            "max_tokens": self.max_tokens,
+        }
+
+
+class ContextBuilder:
+    """
+    Формирует контекст треда для запроса к модели в пределах бюджета токенов.
+
+    Бюджет - max_context_length модели минус max_tokens ответа. Системный
+    промпт сохраняется всегда, затем сообщения добавляются от новых к старым,
+    пока помещаются. Сообщение на границе бюджета обрезается по токенам
+    (остается его конец), более старые отбрасываются. Размеры сообщений
+    берутся из сохраненных счетчиков (MessageOrm.content_tokens). Для моделей
+    без локального токенизатора (все провайдеры, кроме OpenAI) токены
+    оцениваются по TokenEstimator.
+
+    Если у треда есть краткое содержание (ThreadSummarizer), оно передается
+    после системного промпта вместо свернутых сообщений.
+
+    Сообщения треда берутся из ThreadContextCache, из базы данных они
+    загружаются только при отсутствии треда в кэше.
+
+    Если в бюджет не помещаются системный промпт, краткое содержание
+    и последнее сообщение, запрос отклоняется до отправки провайдеру
+    (ContextBudgetExceededException). При CONTEXT_OVERFLOW_POLICY = "trim"
+    последнее сообщение обрезается, пока от него остается не меньше
+    MIN_TRUNCATED_TOKENS.
+    """
+
+    @staticmethod
+    def check_budget(max_context_length: int,
+                     max_tokens: int,
+                     required_tokens: int,
+                     message_tokens: int = 0) -> None:
+        """
+        Проверяет, помещается ли обязательная часть запроса в контекст модели.
+
+        Args:
+            max_context_length: Максимальная длина контекста модели в токенах
+            max_tokens: Максимальное количество токенов в ответе
+            required_tokens: Токены системного промпта и краткого содержания со служебными токенами
+            message_tokens: Токены последнего сообщения со служебными токенами
+
+        Raises:
+            ContextBudgetExceededException: Если запрос не помещается и не может быть обрезан
+        """
+        max_tokens = max_tokens or 0
+        budget = max_context_length - max_tokens - TOKENS_PER_REPLY
+        if required_tokens + message_tokens <= budget:
+            return
+        # Обрезать можно только последнее сообщение, и от него должно что-то остаться
+        can_trim = (
+            settings.CONTEXT_OVERFLOW_POLICY == OVERFLOW_TRIM and
+            message_tokens > 0 and
+            budget - required_tokens >= MIN_TRUNCATED_TOKENS + TOKENS_PER_MESSAGE
+        )
+        if not can_trim:
+            raise ContextBudgetExceededException(
+                required_tokens + message_tokens + TOKENS_PER_REPLY + max_tokens, max_context_length, max_tokens
+            )
+
+    @staticmethod
+    def count_tokens(text: str, model: str, estimated: bool = False) -> int:
+        """Подсчитывает токены текста токенизатором модели или оценкой TokenEstimator"""
+        if estimated:
+            return TokenEstimator.estimate(text, model)
+        return TokenizerRegistry.count_tokens(text, model)
+
+    @classmethod
+    async def is_estimated(cls, db: AsyncSession, model: str, provider_id: Optional[int] = None) -> bool:
+        """
+        Проверяет, оцениваются ли токены модели по TokenEstimator.
+
+        Токенизатор tiktoken точен только для моделей OpenAI, для моделей
+        других провайдеров и моделей не из каталога используется оценка.
+
+        Args:
+            db: Сессия базы данных
+            model: Код модели
+            provider_id: ID провайдера (опционально, иначе провайдер модели из каталога)
+
+        Returns:
+            True, если токены оцениваются по TokenEstimator
+        """
+        if provider_id is None:
+            model_info = await ModelCatalog.find_model(db, model)
+            provider_id = model_info.provider_id if model_info else None
+        provider = await ModelCatalog.get_provider(db, provider_id) if provider_id is not None else None
+        return provider is None or provider.code != "openai"
+
+    @classmethod
+    async def get_max_context_length(cls, db: AsyncSession, model: str, provider_id: Optional[int] = None) -> int:
+        """Возвращает длину контекста модели из каталога"""
+        model_info = await ModelCatalog.find_model(db, model, provider_id)
+        return (model_info.max_context_length if model_info else None) or DEFAULT_CONTEXT_LENGTH
+
+    @classmethod
+    async def preflight(cls,
+                        db: AsyncSession,
+                        model: str,
+                        max_tokens: int,
+                        content: str,
+                        provider_id: Optional[int] = None,
+                        system_prompt: Optional[str] = None,
+                        thread_id: Optional[int] = None) -> None:
+        """
+        Проверяет бюджет токенов нового сообщения до его сохранения и отправки провайдеру.
+
+        Используются сохраненные счетчики токенов системных сообщений и краткого
+        содержания треда (из ThreadContextCache), токенизируется только новое сообщение.
+
+        Args:
+            db: Сессия базы данных
+            model: Код модели
+            max_tokens: Максимальное количество токенов в ответе
+            content: Текст нового сообщения
+            provider_id: ID провайдера (для поиска модели в каталоге)
+            system_prompt: Системный промпт, заменяющий системные сообщения треда (опционально)
+            thread_id: ID треда, если сообщение отправляется в тред (опционально)
+
+        Raises:
+            ContextBudgetExceededException: Если запрос не помещается в контекст модели
+        """
+        estimated = await cls.is_estimated(db, model, provider_id)
+        required = 0
+        if system_prompt:
+            required += cls.count_tokens(system_prompt, model, estimated) + TOKENS_PER_MESSAGE
+        if thread_id is not None:
+            entry = ThreadContextCache.get(thread_id) or await ThreadContextCache.load(db, thread_id)
+            if not system_prompt:
+                required += sum(
+                    get_message_tokens(message, model, estimated) + TOKENS_PER_MESSAGE
+                    for message in entry.messages
+                    if message.role == "system" and not message.meta_data.get("error")
+                )
+            if entry.summary is not None:
+                required += cls.count_tokens(SUMMARY_PREFIX + entry.summary.content, model, estimated) + \
+                    TOKENS_PER_MESSAGE
+
+        message_tokens = cls.count_tokens(content, model, estimated) + TOKENS_PER_MESSAGE
+        max_context_length = await cls.get_max_context_length(db, model, provider_id)
+        cls.check_budget(max_context_length, max_tokens, required, message_tokens)
+
+    @staticmethod
+    def truncate(text: str, max_tokens: int, model: str, estimated: bool = False) -> str:
+        """Оставляет последние max_tokens токенов текста"""
+        if max_tokens <= 0:
+            return ""
+        if estimated:
+            # Без токенизатора конец текста подбирается по оценке: доля символов по доле токенов
+            tokens = TokenEstimator.estimate(text, model)
+            while tokens > max_tokens:
+                keep = int(len(text) * max_tokens / tokens)
+                text = text[len(text) - keep:]
+                tokens = TokenEstimator.estimate(text, model)
+            return text
+        encoding = TokenizerRegistry.get_encoding(model)
+        tokens = encoding.encode_ordinary(text)
+        return encoding.decode(tokens[-max_tokens:])
+
+    @classmethod
+    def pack(cls,
+             messages: List[MessageOrm],
+             model: str,
+             max_context_length: int,
+             max_tokens: int,
+             system_prompt: Optional[str] = None,
+             summary: Optional[ThreadSummaryOrm] = None,
+             estimated: bool = False) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        Упаковывает сообщения треда в бюджет токенов модели.
+
+        Args:
+            messages: Сообщения треда в хронологическом порядке (MessageOrm или их снимки из кэша)
+            model: Код модели
+            max_context_length: Максимальная длина контекста модели в токенах
+            max_tokens: Максимальное количество токенов в ответе
+            system_prompt: Системный промпт, заменяющий системные сообщения треда (опционально)
+            summary: Краткое содержание треда, сообщения до его контрольной точки пропускаются (опционально)
+            estimated: Оценивать токены по TokenEstimator (модель без локального токенизатора)
+
+        Returns:
+            Кортеж (контекст в формате [{"role": ..., "content": ...}], сведения об упаковке для meta_data)
+
+        Raises:
+            ContextBudgetExceededException: Если последнее сообщение не помещается в бюджет
+        """
+        budget = max_context_length - max_tokens - TOKENS_PER_REPLY
+        used = 0
+
+        # Сообщения с ошибками генерации в контекст не попадают
+        messages = [m for m in messages if not (m.meta_data or {}).get("error")]
+
+        system_context = []
+        if system_prompt:
+            system_context.append({"role": "system", "content": system_prompt})
+            used += cls.count_tokens(system_prompt, model, estimated) + TOKENS_PER_MESSAGE
+        else:
+            for message in messages:
+                if message.role == "system":
+                    system_context.append({"role": "system", "content": message.content})
+                    used += get_message_tokens(message, model, estimated) + TOKENS_PER_MESSAGE
+
+        dialog = [m for m in messages if m.role != "system"]
+        if summary is not None:
+            summary_text = SUMMARY_PREFIX + summary.content
+            system_context.append({"role": "system", "content": summary_text})
+            used += cls.count_tokens(summary_text, model, estimated) + TOKENS_PER_MESSAGE
+            dialog = [m for m in dialog if m.id > summary.last_message_id]
+
+        # Обязательная часть запроса проверяется до отправки провайдеру
+        cls.check_budget(
+            max_context_length,
+            max_tokens,
+            used,
+            get_message_tokens(dialog[-1], model, estimated) + TOKENS_PER_MESSAGE if dialog else 0
+        )
+        included: List[Dict[str, str]] = []
+        truncated_message_id = None
+
+        for message in reversed(dialog):
+            message_tokens = get_message_tokens(message, model, estimated) + TOKENS_PER_MESSAGE
+            if used + message_tokens <= budget:
+                included.append({"role": message.role, "content": message.content})
+                used += message_tokens
+                continue
+
+            # Последнее сообщение пользователя включается всегда, остальные - если остаток не слишком мал
+            remaining = budget - used - TOKENS_PER_MESSAGE
+            if remaining >= MIN_TRUNCATED_TOKENS or not included:
+                content = cls.truncate(message.content, max(remaining, 0), model, estimated)
+                if content:
+                    included.append({"role": message.role, "content": content})
+                    used += cls.count_tokens(content, model, estimated) + TOKENS_PER_MESSAGE
+                    truncated_message_id = message.id
+            break
+
+        included.reverse()
+        packing = {
+            "messages_total": len(dialog),
+            "messages_included": len(included),
+            "messages_dropped": len(dialog) - len(included),
+            "truncated_message_id": truncated_message_id,
+            "tokens_used": used + TOKENS_PER_REPLY,
+            "token_budget": budget + TOKENS_PER_REPLY,
+            "summary_until_message_id": summary.last_message_id if summary is not None else None,
+        }
+        return system_context + included, packing
+
+    @classmethod
+    async def build(cls,
+                    db: AsyncSession,
+                    thread_id: int,
+                    model: str,
+                    max_tokens: int,
+                    provider_id: Optional[int] = None,
+                    system_prompt: Optional[str] = None,
+                    last_message_id: Optional[int] = None) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        Получает сообщения треда и упаковывает их в бюджет токенов модели.
+
+        Args:
+            db: Сессия базы данных
+            thread_id: ID треда
+            model: Код модели
+            max_tokens: Максимальное количество токенов в ответе
+            provider_id: ID провайдера (для поиска модели в каталоге)
+            system_prompt: Системный промпт, заменяющий системные сообщения треда (опционально)
+            last_message_id: ID последнего известного сообщения треда, запись кэша без него не используется (опционально)
+
+        Returns:
+            Кортеж (контекст, сведения об упаковке для meta_data)
+
+        Raises:
+            ContextBudgetExceededException: Если последнее сообщение не помещается в бюджет
+        """
+        entry = ThreadContextCache.get(thread_id, last_message_id)
+        if entry is None:
+            entry = await ThreadContextCache.load(db, thread_id)
+
+        max_context_length = await cls.get_max_context_length(db, model, provider_id)
+        estimated = await cls.is_estimated(db, model, provider_id)
+
+        return cls.pack(entry.messages, model, max_context_length, max_tokens, system_prompt, entry.summary, estimated)
@@ -0,0 +1,362 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.settings import settings
+from app.db.notifications import PgNotificationListener
+from app.utils.sse import format_sse_event, TextChunkCoalescer
+
+GENERATION_STOP_CHANNEL = "aihub_generation_stop"
+
+
+class Generation:
+    """
+    Генерация ответа в треде.
+
+    Генерация выполняется в отдельной задаче asyncio, независимой от HTTP
+    соединения клиента. Каждый кусок ответа один раз сериализуется в событие
+    SSE с идентификатором "<id генерации>:<номер>", попадает в кольцевой буфер
+    и рассылается подписчикам. Переподключившийся клиент передает Last-Event-ID
+    и получает пропущенные события из буфера, после чего продолжает читать
+    живой поток. Текст накапливается, чтобы при остановке сохранить частичный ответ.
+    """
+
+    def __init__(self, thread_id: int, user_message_id: Optional[int] = None):
+        self.id = uuid.uuid4().hex
+        self.thread_id = thread_id
+        self.user_message_id = user_message_id
+        self.message_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.text_parts: List[str] = []
+        self.stopped = False
+        self.finished = False
+        self.finished_at: Optional[float] = None
+        self.buffer_bytes = 0
+        self._next_seq = 1
+        self._frames: Deque[Tuple[int, str]] = deque()
+        self._subscribers: List[asyncio.Queue] = []
+        self._coalescer = TextChunkCoalescer(
+            self._emit, settings.SSE_FLUSH_INTERVAL_MS, settings.SSE_FLUSH_MAX_BYTES
+        )
+
+    @property
+    def partial_text(self) -> str:
+        """Текст, сгенерированный к текущему моменту"""
+        return "".join(self.text_parts)
+
+    def matches(self, message_id: Optional[int]) -> bool:
+        """Проверяет, относится ли генерация к сообщению (None - любое сообщение треда)"""
+        return message_id is None or message_id in (self.user_message_id, self.message_id)
+
+    def publish(self, chunk: Dict[str, Any]) -> None:
+        """
+        Принимает кусок ответа и передает его подписчикам.
+
+        Текстовые куски склеиваются в окне SSE_FLUSH_INTERVAL_MS (см. TextChunkCoalescer),
+        чтобы при быстрой генерации не отправлять событие на каждый токен.
+
+        Args:
+            chunk: Кусок ответа в формате провайдера ({"text": ...}, {"done": True, ...} и т.д.)
+        """
+        if chunk.get("text"):
+            self.text_parts.append(chunk["text"])
+        if chunk.get("user_message_id"):
+            self.user_message_id = chunk["user_message_id"]
+        if chunk.get("message_id"):
+            self.message_id = chunk["message_id"]
+
+        self._coalescer.push(chunk)
+
+    def _emit(self, chunk: Dict[str, Any]) -> None:
+        """Сериализует кусок в событие SSE, сохраняет его в буфер и рассылает подписчикам"""
+        seq = self._next_seq
+        self._next_seq += 1
+        event = format_sse_event(chunk, event_id=f"{self.id}:{seq}")
+
+        self._frames.append((seq, event))
+        self.buffer_bytes += len(event)
+        if len(self._frames) > settings.SSE_REPLAY_BUFFER_SIZE:
+            self.drop_oldest_frame()
+        GenerationRegistry.track_buffer(self, len(event))
+
+        for queue in self._subscribers:
+            queue.put_nowait(event)
+
+    def drop_oldest_frame(self) -> int:
+        """
+        Удаляет самое старое событие из буфера.
+
+        Returns:
+            Освобожденный объем в байтах
+        """
+        if not self._frames:
+            return 0
+        _, event = self._frames.popleft()
+        self.buffer_bytes -= len(event)
+        GenerationRegistry.track_buffer(self, -len(event))
+        return len(event)
+
+    def release_buffer(self) -> None:
+        """Освобождает буфер событий целиком"""
+        GenerationRegistry.track_buffer(self, -self.buffer_bytes)
+        self._frames.clear()
+        self.buffer_bytes = 0
+
+    def subscribe(self, after_seq: int = 0) -> AsyncIterator[str]:
+        """
+        Подписывается на события генерации.
+
+        События из буфера с номером больше after_seq и очередь для живых событий
+        собираются синхронно, поэтому между повтором и живым потоком нет разрыва.
+        Подписка, оформленная до start(), получит все события генерации.
+
+        Args:
+            after_seq: Номер последнего полученного клиентом события (из Last-Event-ID)
+
+        Returns:
+            Асинхронный итератор строк событий SSE
+        """
+        replay = [event for seq, event in self._frames if seq > after_seq]
+        queue: Optional[asyncio.Queue] = None
+        if not self.finished:
+            queue = asyncio.Queue()
+            self._subscribers.append(queue)
+        return self._iterate(replay, queue)
+
+    async def _iterate(self, replay: List[str], queue: Optional[asyncio.Queue]) -> AsyncIterator[str]:
+        try:
+            for event in replay:
+                yield event
+
+            if queue is None:
+                return
+
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            if queue is not None and queue in self._subscribers:
+                self._subscribers.remove(queue)
+
+    def start(self, source: AsyncIterator[Dict[str, Any]]) -> None:
+        """
+        Запускает задачу, которая читает источник и рассылает куски подписчикам.
+
+        Args:
+            source: Асинхронный генератор кусков ответа
+        """
+        self.task = asyncio.create_task(self._run(source))
+
+    async def _run(self, source: AsyncIterator[Dict[str, Any]]) -> None:
+        try:
+            async for chunk in source:
+                self.publish(chunk)
+        except asyncio.CancelledError:
+            # Источник не обработал остановку самостоятельно
+            self.publish({"stopped": True, "done": True, "message_id": self.message_id})
+        except Exception as e:
+            self.publish({"error": True, "error_message": f"Ошибка при генерации ответа: {str(e)}"})
+        finally:
+            self._coalescer.flush()
+            self.finished = True
+            self.finished_at = time.monotonic()
+            for queue in self._subscribers:
+                queue.put_nowait(None)
+
+    def cancel(self) -> bool:
+        """
+        Прерывает генерацию.
+
+        Returns:
+            True, если задача была активна
+        """
+        if self.task is None or self.task.done():
+            return False
+        self.stopped = True
+        self.task.cancel()
+        return True
+
+
+class GenerationRegistry:
+    """
+    Реестр генераций текущего процесса по тредам и сообщениям.
+
+    Завершенные генерации хранятся в реестре SSE_REPLAY_TTL_SECONDS секунд,
+    чтобы клиент мог дочитать ответ после обрыва соединения. Общий объем
+    буферов ограничен SSE_REPLAY_MAX_BYTES: при превышении сначала удаляются
+    самые старые завершенные генерации, затем старые события текущей.
+
+    Буферы живут в памяти воркера, поэтому переподключение должно попадать
+    на тот же воркер. Остановка, пришедшая на другой воркер, доставляется
+    через канал PostgreSQL LISTEN/NOTIFY (см. PgNotificationListener).
+    """
+
+    _generations: Dict[int, Dict[str, Generation]] = {}
+    _buffer_bytes: int = 0
+    _logger = logging.getLogger("generation_registry")
+
+    @classmethod
+    def create(cls, thread_id: int, user_message_id: Optional[int] = None) -> Generation:
+        """
+        Создает и регистрирует генерацию для треда.
+
+        Args:
+            thread_id: ID треда
+            user_message_id: ID сообщения пользователя, на которое генерируется ответ
+
+        Returns:
+            Новая генерация
+        """
+        cls.evict_expired()
+        generation = Generation(thread_id, user_message_id)
+        cls._generations.setdefault(thread_id, {})[generation.id] = generation
+        return generation
+
+    @classmethod
+    def unregister(cls, generation: Generation) -> None:
+        """Удаляет генерацию из реестра и освобождает ее буфер"""
+        generation.release_buffer()
+        thread_generations = cls._generations.get(generation.thread_id)
+        if thread_generations is None:
+            return
+        thread_generations.pop(generation.id, None)
+        if not thread_generations:
+            cls._generations.pop(generation.thread_id, None)
+
+    @classmethod
+    def track_buffer(cls, generation: Generation, delta: int) -> None:
+        """
+        Учитывает изменение объема буферов и применяет лимит памяти.
+
+        Args:
+            generation: Генерация, буфер которой изменился
+            delta: Изменение объема в байтах
+        """
+        cls._buffer_bytes += delta
+        if delta <= 0 or cls._buffer_bytes <= settings.SSE_REPLAY_MAX_BYTES:
+            return
+
+        # Сначала вытесняем завершенные генерации, начиная с самых старых
+        finished = sorted(
+            (g for thread in cls._generations.values() for g in thread.values()
+             if g.finished and g is not generation),
+            key=lambda g: g.finished_at
+        )
+        for old_generation in finished:
+            if cls._buffer_bytes <= settings.SSE_REPLAY_MAX_BYTES:
+                return
+            cls.unregister(old_generation)
+
+        # Затем укорачиваем буфер текущей генерации, оставляя последнее событие
+        while cls._buffer_bytes > settings.SSE_REPLAY_MAX_BYTES and len(generation._frames) > 1:
+            generation.drop_oldest_frame()
+
+    @classmethod
+    def evict_expired(cls) -> None:
+        """Удаляет завершенные генерации, срок хранения которых истек"""
+        deadline = time.monotonic() - settings.SSE_REPLAY_TTL_SECONDS
+        expired = [
+            generation for thread in cls._generations.values() for generation in thread.values()
+            if generation.finished and generation.finished_at < deadline
+        ]
+        for generation in expired:
+            cls.unregister(generation)
+
+    @classmethod
+    def get_active(cls, thread_id: int, message_id: Optional[int] = None) -> List[Generation]:
+        """
+        Возвращает незавершенные генерации треда в текущем процессе.
+
+        Args:
+            thread_id: ID треда
+            message_id: ID сообщения пользователя или ассистента (опционально)
+
+        Returns:
+            Список генераций
+        """
+        return [
+            generation for generation in cls._generations.get(thread_id, {}).values()
+            if not generation.finished and generation.matches(message_id)
+        ]
+
+    @classmethod
+    def find_for_resume(cls, thread_id: int, last_event_id: Optional[str]) -> Tuple[Optional[Generation], int]:
+        """
+        Находит генерацию для переподключения клиента.
+
+        Args:
+            thread_id: ID треда
+            last_event_id: Значение заголовка Last-Event-ID ("<id генерации>:<номер>")
+
+        Returns:
+            Кортеж (генерация или None, номер последнего полученного события)
+        """
+        cls.evict_expired()
+        thread_generations = cls._generations.get(thread_id, {})
+
+        if last_event_id:
+            generation_id, _, seq = last_event_id.partition(":")
+            generation = thread_generations.get(generation_id)
+            if generation is not None:
+                return generation, int(seq) if seq.isdigit() else 0
+
+        # Без корректного Last-Event-ID подключаемся к последней генерации треда с начала
+        active = [generation for generation in thread_generations.values() if not generation.finished]
+        if active:
+            return active[-1], 0
+        return None, 0
+
+    @classmethod
+    def cancel(cls, thread_id: int, message_id: Optional[int] = None) -> int:
+        """
+        Прерывает генерации треда в текущем процессе.
+
+        Args:
+            thread_id: ID треда
+            message_id: ID сообщения (опционально, иначе все генерации треда)
+
+        Returns:
+            Количество прерванных генераций
+        """
+        cancelled = 0
+        for generation in cls.get_active(thread_id, message_id):
+            if generation.cancel():
+                cancelled += 1
+
+        if cancelled:
+            cls._logger.info(f"Прервано генераций в треде #{thread_id}: {cancelled}")
+        return cancelled
+
+    @classmethod
+    async def stop(cls, db: AsyncSession, thread_id: int, message_id: Optional[int] = None) -> int:
+        """
+        Прерывает генерации треда, в том числе запущенные на других воркерах.
+
+        Args:
+            db: Сессия базы данных
+            thread_id: ID треда
+            message_id: ID сообщения (опционально)
+
+        Returns:
+            Количество генераций, прерванных в текущем процессе
+        """
+        cancelled = cls.cancel(thread_id, message_id)
+        if not cancelled:
+            await PgNotificationListener.notify(
+                db, GENERATION_STOP_CHANNEL, {"thread_id": thread_id, "message_id": message_id}
+            )
+        return cancelled
+
+    @classmethod
+    async def handle_stop_notification(cls, payload: Dict[str, Any]) -> None:
+        """Обработчик уведомлений об остановке из канала PostgreSQL"""
+        thread_id = payload.get("thread_id")
+        if thread_id is not None:
+            cls.cancel(int(thread_id), payload.get("message_id"))
@@ -0,0 +1,100 @@
+import logging
+from typing import Any, Dict
+
+import httpx
+
+from app.core.settings import settings
+from app.services.rate_limiter import RateLimiterRegistry
+
+
+class HttpClientPool:
+    """
+    Общие HTTP клиенты для запросов к API провайдеров.
+
+    Для каждого базового URL в процессе создается один httpx.AsyncClient
+    с пулом соединений и keep-alive. Клиенты SDK всех ключей API одного
+    провайдера используют его совместно, поэтому соединения и TLS сессии
+    переиспользуются между пользователями, а не открываются заново на каждый ключ.
+    """
+
+    _clients: Dict[str, httpx.AsyncClient] = {}
+    _requests_total: Dict[str, int] = {}
+    _logger = logging.getLogger("http_pool")
+
+    @classmethod
+    def get_client(cls, base_url: str) -> httpx.AsyncClient:
+        """
+        Возвращает общий HTTP клиент для базового URL провайдера.
+
+        Args:
+            base_url: Базовый URL API провайдера
+
+        Returns:
+            Клиент httpx с общим пулом соединений
+        """
+        key = base_url.rstrip("/")
+        client = cls._clients.get(key)
+        if client is None or client.is_closed:
+            client = cls._create_client(key)
+            cls._clients[key] = client
+            cls._requests_total.setdefault(key, 0)
+            cls._logger.info(f"Создан HTTP пул для {key}")
+        return client
+
+    @classmethod
+    def _create_client(cls, key: str) -> httpx.AsyncClient:
+        async def count_request(request: httpx.Request) -> None:
+            cls._requests_total[key] += 1
+
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.HTTP_POOL_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(settings.HTTP_READ_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT),
+            follow_redirects=True,
+            # Заголовки лимитов из ответов обновляют ограничители ключей
+            event_hooks={"request": [count_request], "response": [RateLimiterRegistry.on_response]},
+        )
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Any]:
+        """
+        Возвращает статистику пулов соединений для подбора лимитов.
+
+        Returns:
+            Словарь с лимитами и состоянием соединений по каждому базовому URL
+        """
+        pools = {}
+        for key, client in cls._clients.items():
+            # httpx не предоставляет публичного API для состояния пула,
+            # поэтому читаем соединения пула httpcore, если он доступен
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+            idle = sum(1 for connection in connections if connection.is_idle())
+
+            pools[key] = {
+                "closed": client.is_closed,
+                "requests_total": cls._requests_total.get(key, 0),
+                "connections": len(connections),
+                "connections_idle": idle,
+                "connections_active": len(connections) - idle,
+                "requests_in_flight": len(getattr(pool, "_requests", [])),
+            }
+
+        return {
+            "limits": {
+                "max_connections": settings.HTTP_POOL_MAX_CONNECTIONS,
+                "max_keepalive_connections": settings.HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS,
+                "keepalive_expiry": settings.HTTP_POOL_KEEPALIVE_EXPIRY,
+            },
+            "pools": pools,
+        }
+
+    @classmethod
+    async def close_all(cls) -> None:
+        """Закрывает все HTTP клиенты (при остановке приложения)"""
+        for client in cls._clients.values():
+            await client.aclose()
+        cls._clients.clear()
@@ -0,0 +1,193 @@
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.settings import settings
+from app.db.models import ApiKeyOrm
+from app.utils.ttl_cache import TTLCache
+
+
+class PooledKey:
+    """
+    API ключ в пуле и его счетчики.
+
+    Объект переживает перезагрузку пула, поэтому счетчики запросов
+    в работе не сбрасываются при обновлении списка ключей.
+    """
+
+    def __init__(self, api_key_id: int, api_key: str):
+        self.api_key_id = api_key_id
+        self.api_key = api_key
+        self.in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+        self.rate_limited_total = 0
+        self.cooldown_until = 0.0
+        self.last_error: Optional[str] = None
+
+    @property
+    def is_cooling_down(self) -> bool:
+        return self.cooldown_until > time.monotonic()
+
+    def request_started(self) -> None:
+        """Отмечает начало запроса к провайдеру"""
+        self.in_flight += 1
+        self.requests_total += 1
+
+    def request_finished(self, error: Optional[BaseException] = None, rate_limited: bool = False,
+                         retry_after: Optional[float] = None) -> None:
+        """
+        Отмечает завершение запроса к провайдеру.
+
+        Args:
+            error: Исключение, которым завершился запрос (если был ошибкой)
+            rate_limited: Провайдер ответил 429 - ключ уходит на охлаждение
+            retry_after: Рекомендованная провайдером пауза в секундах
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+        if error is None:
+            return
+
+        self.errors_total += 1
+        self.last_error = str(error)[:200]
+        if rate_limited:
+            self.rate_limited_total += 1
+            cooldown = retry_after if retry_after is not None else settings.API_KEY_COOLDOWN_SECONDS
+            self.cooldown_until = time.monotonic() + cooldown
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает счетчики ключа (без самого ключа)"""
+        return {
+            "api_key_id": self.api_key_id,
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "rate_limited_total": self.rate_limited_total,
+            "cooldown_seconds_left": round(max(0.0, self.cooldown_until - time.monotonic()), 1),
+            "last_error": self.last_error,
+        }
+
+
+class KeyPool:
+    """
+    Пул активных API ключей пользователя для одного провайдера.
+
+    Запрос получает ключ с наименьшим числом запросов в работе, при равенстве -
+    с наименьшим числом запросов всего (поочередное использование). Ключи
+    на охлаждении после 429 пропускаются, пока есть другие.
+    """
+
+    def __init__(self, user_id: int, provider_id: int):
+        self.user_id = user_id
+        self.provider_id = provider_id
+        self.keys: Dict[int, PooledKey] = {}
+        self.loaded_at = 0.0
+
+    @property
+    def is_expired(self) -> bool:
+        return time.monotonic() - self.loaded_at > settings.SERVICE_CACHE_TTL_SECONDS
+
+    def update_keys(self, rows: List[Tuple[int, str]]) -> None:
+        """
+        Обновляет список ключей пула, сохраняя счетчики уже известных ключей.
+
+        Args:
+            rows: Пары (ID ключа, ключ)
+        """
+        keys = {}
+        for api_key_id, api_key in rows:
+            pooled = self.keys.get(api_key_id)
+            if pooled is None or pooled.api_key != api_key:
+                pooled = PooledKey(api_key_id, api_key)
+            keys[api_key_id] = pooled
+        self.keys = keys
+        self.loaded_at = time.monotonic()
+
+    def choose(self) -> Optional[PooledKey]:
+        """
+        Выбирает ключ для очередного запроса.
+
+        Returns:
+            Ключ или None, если в пуле нет ключей
+        """
+        if not self.keys:
+            return None
+
+        available = [key for key in self.keys.values() if not key.is_cooling_down]
+        if not available:
+            # Все ключи на охлаждении - берем тот, который освободится раньше
+            return min(self.keys.values(), key=lambda key: key.cooldown_until)
+
+        return min(available, key=lambda key: (key.in_flight, key.requests_total))
+
+
+class KeyPoolRegistry:
+    """
+    Пулы API ключей по парам (пользователь, провайдер) в текущем процессе.
+
+    Пулы хранят расшифрованные ключи, поэтому реестр ограничен по размеру (LRU),
+    а пул, к которому не обращались дольше SERVICE_CACHE_TTL_SECONDS, удаляется.
+    """
+
+    _pools = TTLCache(settings.SERVICE_CACHE_MAX_SIZE, settings.SERVICE_CACHE_TTL_SECONDS)
+    _logger = logging.getLogger("key_pool")
+
+    @classmethod
+    async def get_pool(cls, db: AsyncSession, user_id: int, provider_id: int) -> KeyPool:
+        """
+        Возвращает пул ключей, при необходимости загружая ключи из базы данных.
+
+        Args:
+            db: Сессия базы данных
+            user_id: ID пользователя
+            provider_id: ID провайдера
+
+        Returns:
+            Пул ключей
+        """
+        pool = cls._pools.get((user_id, provider_id))
+        if pool is None:
+            pool = KeyPool(user_id, provider_id)
+        # Повторное сохранение продлевает жизнь пула, пока он используется
+        cls._pools.set((user_id, provider_id), pool)
+        if not pool.is_expired:
+            return pool
+
+        result = await db.execute(
+            select(ApiKeyOrm.id, ApiKeyOrm.api_key).filter(
+                (ApiKeyOrm.user_id == user_id) &
+                (ApiKeyOrm.provider_id == provider_id) &
+                (ApiKeyOrm.is_active == True)
+            ).order_by(ApiKeyOrm.created_at.desc())
+        )
+        pool.update_keys(result.all())
+        return pool
+
+    @classmethod
+    def invalidate(cls, user_id: int, provider_id: int) -> None:
+        """Удаляет пул вместе с ключами, они будут загружены заново при следующем запросе"""
+        cls._pools.pop((user_id, provider_id))
+
+    @classmethod
+    def get_stats(cls, user_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Возвращает счетчики ключей по пулам.
+
+        Args:
+            user_id: ID пользователя (опционально, иначе все пулы)
+
+        Returns:
+            Список пулов со счетчиками ключей
+        """
+        return [
+            {
+                "user_id": pool.user_id,
+                "provider_id": pool.provider_id,
+                "keys": [key.get_stats() for key in pool.keys.values()],
+            }
+            for pool in cls._pools.values()
+            if user_id is None or pool.user_id == user_id
+        ]
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+from itertools import chain
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from sqlalchemy import event, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.db.models import ProviderOrm, AIModelOrm
+
+MODEL_CATALOG_CHANNEL = "aihub_model_catalog"
+
+
+class ProviderInfo:
+    """Снимок провайдера из каталога (не привязан к сессии БД)"""
+
+    def __init__(self, provider: ProviderOrm):
+        self.id = provider.id
+        self.code = provider.code
+        self.name = provider.name
+        self.description = provider.description
+        self.is_active = provider.is_active
+        self.service_class = provider.service_class
+
+    # Загрузка класса сервиса использует только code и service_class
+    get_service_class = ProviderOrm.get_service_class
+
+
+class ModelInfo:
+    """Снимок модели из каталога (не привязан к сессии БД)"""
+
+    def __init__(self, model: AIModelOrm):
+        self.id = model.id
+        self.provider_id = model.provider_id
+        self.code = model.code
+        self.name = model.name
+        self.description = model.description
+        self.is_active = model.is_active
+        self.max_context_length = model.max_context_length
+        self.supports_streaming = model.supports_streaming
+        self.input_price = model.input_price
+        self.output_price = model.output_price
+        self.config = model.config or {}
+
+
+class ModelCatalog:
+    """
+    Каталог провайдеров и моделей в памяти процесса.
+
+    Таблицы providers и ai_models меняются редко, поэтому каталог загружается
+    один раз и перечитывается только после смены версии. Версия увеличивается,
+    когда в любой сессии фиксируется изменение ProviderOrm или AIModelOrm
+    (в том числе при sync_openai_models и правках администратора). Другие
+    воркеры узнают об изменении через канал PostgreSQL LISTEN/NOTIFY:
+    уведомление отправляется в той же транзакции и доставляется после commit.
+    """
+
+    _providers: Dict[int, ProviderInfo] = {}
+    _providers_by_code: Dict[str, ProviderInfo] = {}
+    _models: Dict[int, ModelInfo] = {}
+    _models_by_code: Dict[Tuple[int, str], ModelInfo] = {}
+    _version = 1
+    _loaded_version = 0
+    _lock = asyncio.Lock()
+    _logger = logging.getLogger("model_catalog")
+
+    @classmethod
+    def invalidate(cls) -> None:
+        """Увеличивает версию каталога, при следующем обращении он будет перечитан"""
+        cls._version += 1
+        cls._logger.info(f"Каталог моделей устарел, новая версия {cls._version}")
+
+    @classmethod
+    async def handle_change_notification(cls, payload: Dict[str, Any]) -> None:
+        """Обработчик уведомлений об изменении каталога из канала PostgreSQL"""
+        cls.invalidate()
+
+    @classmethod
+    async def load(cls, db: AsyncSession) -> None:
+        """
+        Загружает провайдеров и модели из базы данных.
+
+        Args:
+            db: Сессия базы данных
+        """
+        async with cls._lock:
+            version = cls._version
+            if cls._loaded_version == version:
+                return
+
+            providers_result = await db.execute(select(ProviderOrm))
+            providers = [ProviderInfo(provider) for provider in providers_result.scalars().all()]
+            models_result = await db.execute(select(AIModelOrm))
+            models = [ModelInfo(model) for model in models_result.scalars().all()]
+
+            cls._providers = {provider.id: provider for provider in providers}
+            cls._providers_by_code = {provider.code: provider for provider in providers}
+            cls._models = {model.id: model for model in models}
+            cls._models_by_code = {(model.provider_id, model.code): model for model in models}
+            # Если каталог изменился во время загрузки, он будет перечитан при следующем обращении
+            cls._loaded_version = version
+
+            cls._logger.info(f"Каталог моделей загружен: провайдеров {len(providers)}, моделей {len(models)}")
+
+    @classmethod
+    async def ensure_loaded(cls, db: AsyncSession) -> None:
+        """Перечитывает каталог, если его версия изменилась"""
+        if cls._loaded_version != cls._version:
+            await cls.load(db)
+
+    @classmethod
+    async def get_providers(cls, db: AsyncSession) -> List[ProviderInfo]:
+        """Возвращает всех провайдеров"""
+        await cls.ensure_loaded(db)
+        return list(cls._providers.values())
+
+    @classmethod
+    async def get_provider(cls, db: AsyncSession, provider_id: int) -> Optional[ProviderInfo]:
+        """Возвращает провайдера по ID"""
+        await cls.ensure_loaded(db)
+        return cls._providers.get(provider_id)
+
+    @classmethod
+    async def get_provider_by_code(cls, db: AsyncSession, code: str) -> Optional[ProviderInfo]:
+        """Возвращает провайдера по коду (openai, anthropic и т.д.)"""
+        await cls.ensure_loaded(db)
+        return cls._providers_by_code.get(code)
+
+    @classmethod
+    async def get_model(cls, db: AsyncSession, model_id: int) -> Optional[ModelInfo]:
+        """Возвращает модель по ID"""
+        await cls.ensure_loaded(db)
+        return cls._models.get(model_id)
+
+    @classmethod
+    async def find_model(cls,
+                         db: AsyncSession,
+                         model_id_or_code: Union[int, str],
+                         provider_id: Optional[int] = None) -> Optional[ModelInfo]:
+        """
+        Находит модель по ID или коду.
+
+        Args:
+            db: Сессия базы данных
+            model_id_or_code: ID модели или её код (например, 'gpt-4')
+            provider_id: ID провайдера (опционально, иначе любой провайдер)
+
+        Returns:
+            Модель или None
+        """
+        await cls.ensure_loaded(db)
+
+        if not isinstance(model_id_or_code, str):
+            model = cls._models.get(model_id_or_code)
+            if model and (provider_id is None or model.provider_id == provider_id):
+                return model
+            return None
+
+        if provider_id is not None:
+            return cls._models_by_code.get((provider_id, model_id_or_code))
+        return next((model for model in cls._models.values() if model.code == model_id_or_code), None)
+
+    @classmethod
+    async def get_active_models(cls, db: AsyncSession, provider_id: int) -> List[ModelInfo]:
+        """Возвращает активные модели провайдера"""
+        await cls.ensure_loaded(db)
+        return [
+            model for model in cls._models.values()
+            if model.provider_id == provider_id and model.is_active
+        ]
+
+
+@event.listens_for(Session, "after_flush")
+def catalog_after_flush(session, flush_context):
+    """Отправляет уведомление об изменении каталога в транзакции, которая его меняет"""
+    changed = any(
+        isinstance(obj, (ProviderOrm, AIModelOrm))
+        for obj in chain(session.new, session.dirty, session.deleted)
+    )
+    if not changed or session.info.get("model_catalog_changed"):
+        return
+
+    session.info["model_catalog_changed"] = True
+    # NOTIFY внутри транзакции доставляется слушателям только после commit
+    session.connection().execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": MODEL_CATALOG_CHANNEL, "payload": json.dumps({"changed": True})}
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def catalog_after_commit(session):
+    """Сбрасывает каталог текущего процесса сразу после фиксации изменений"""
+    if session.info.pop("model_catalog_changed", False):
+        ModelCatalog.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def catalog_after_rollback(session):
+    session.info.pop("model_catalog_changed", None)
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.core.settings import settings
+from app.utils.minhash import MinHasher
+
+# Режимы использования похожих запросов
+NEAR_DUPLICATE_REUSE = "reuse"  # Вернуть сохраненный ответ вместо запроса к провайдеру
+NEAR_DUPLICATE_PREVIEW = "preview"  # Показать сохраненный ответ, пока выполняется настоящий запрос
+
+
+class NearDuplicateIndex:
+    """
+    LSH индекс недавних запросов одного пользователя к одной модели.
+
+    Сигнатура делится на полосы по NEAR_DUPLICATE_LSH_ROWS значений. Запросы, у которых
+    совпала хотя бы одна полоса, становятся кандидатами, для них сходство
+    оценивается по полной сигнатуре. Размер индекса ограничен
+    NEAR_DUPLICATE_MAX_ENTRIES, вытесняются самые давние записи.
+    """
+
+    def __init__(self, rows: int, max_entries: int):
+        self.rows = rows
+        self.max_entries = max_entries
+        # Ключ кэша ответа -> сигнатура запроса
+        self._entries: "OrderedDict[str, Tuple[int, ...]]" = OrderedDict()
+        # (номер полосы, значения полосы) -> ключи кэша
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _bands(self, signature: Tuple[int, ...]):
+        for band, start in enumerate(range(0, len(signature), self.rows)):
+            yield band, signature[start:start + self.rows]
+
+    def add(self, cache_key: str, signature: Tuple[int, ...]) -> None:
+        """Добавляет запрос в индекс (повторное добавление обновляет его позицию)"""
+        if cache_key in self._entries:
+            self._entries.move_to_end(cache_key)
+            return
+
+        self._entries[cache_key] = signature
+        for band_key in self._bands(signature):
+            self._buckets.setdefault(band_key, set()).add(cache_key)
+
+        while len(self._entries) > self.max_entries:
+            self.remove(next(iter(self._entries)))
+
+    def remove(self, cache_key: str) -> None:
+        """Удаляет запрос из индекса"""
+        signature = self._entries.pop(cache_key, None)
+        if signature is None:
+            return
+        for band_key in self._bands(signature):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(cache_key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def find(self, signature: Tuple[int, ...], threshold: float) -> Optional[Tuple[str, float]]:
+        """
+        Ищет самый похожий запрос с оценкой сходства не ниже порога.
+
+        Args:
+            signature: Сигнатура нового запроса
+            threshold: Минимальное сходство (0..1)
+
+        Returns:
+            Пара (ключ кэша, сходство) или None
+        """
+        candidates: Set[str] = set()
+        for band_key in self._bands(signature):
+            candidates.update(self._buckets.get(band_key, ()))
+
+        best = None
+        for cache_key in candidates:
+            similarity = MinHasher.similarity(signature, self._entries[cache_key])
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (cache_key, similarity)
+
+        if best is not None:
+            self._entries.move_to_end(best[0])
+        return best
+
+
+class NearDuplicateRegistry:
+    """
+    Индексы похожих запросов по парам (пользователь, модель) в памяти процесса.
+
+    Количество индексов ограничено NEAR_DUPLICATE_MAX_INDEXES: при превышении
+    удаляется индекс, к которому дольше всего не обращались.
+    """
+
+    _hasher = MinHasher(settings.NEAR_DUPLICATE_NUM_PERM)
+    _indexes: "OrderedDict[Tuple[int, str], NearDuplicateIndex]" = OrderedDict()
+    lookups = 0
+    matches = 0
+
+    @classmethod
+    def signature(cls, context: List[Dict[str, str]]) -> Tuple[int, ...]:
+        """
+        Возвращает сигнатуру запроса по тексту его сообщений.
+
+        Учитываются последние NEAR_DUPLICATE_MAX_CHARS символов: новый запрос
+        пользователя в конце контекста, а время вычисления растет с длиной текста.
+        """
+        text = "\n".join(
+            f"{message.get('role')}: {message.get('content')}"
+            for message in context
+            if message.get("content")
+        )
+        return cls._hasher.signature(text[-settings.NEAR_DUPLICATE_MAX_CHARS:])
+
+    @classmethod
+    def _get_index(cls, user_id: int, model: str, create: bool) -> Optional[NearDuplicateIndex]:
+        key = (user_id, str(model))
+        index = cls._indexes.get(key)
+        if index is None:
+            if not create:
+                return None
+            index = NearDuplicateIndex(settings.NEAR_DUPLICATE_LSH_ROWS, settings.NEAR_DUPLICATE_MAX_ENTRIES)
+            cls._indexes[key] = index
+            while len(cls._indexes) > settings.NEAR_DUPLICATE_MAX_INDEXES:
+                cls._indexes.popitem(last=False)
+        else:
+            cls._indexes.move_to_end(key)
+        return index
+
+    @classmethod
+    def add(cls, user_id: int, model: str, signature: Tuple[int, ...], cache_key: str) -> None:
+        """
+        Запоминает запрос, ответ на который сохранен в кэше ответов.
+
+        Args:
+            user_id: ID пользователя
+            model: Код модели
+            signature: Сигнатура запроса
+            cache_key: Ключ записи в кэше ответов
+        """
+        cls._get_index(user_id, model, create=True).add(cache_key, signature)
+
+    @classmethod
+    def find(cls, user_id: int, model: str, signature: Tuple[int, ...]) -> Optional[Tuple[str, float]]:
+        """
+        Ищет похожий запрос пользователя к той же модели.
+
+        Args:
+            user_id: ID пользователя
+            model: Код модели
+            signature: Сигнатура нового запроса
+
+        Returns:
+            Пара (ключ кэша, сходство) или None
+        """
+        cls.lookups += 1
+        index = cls._get_index(user_id, model, create=False)
+        if index is None:
+            return None
+
+        match = index.find(signature, settings.NEAR_DUPLICATE_SIMILARITY)
+        if match is not None:
+            cls.matches += 1
+        return match
+
+    @classmethod
+    def discard(cls, user_id: int, model: str, cache_key: str) -> None:
+        """Удаляет запрос, ответ на который больше не доступен в кэше"""
+        index = cls._get_index(user_id, model, create=False)
+        if index is not None:
+            index.remove(cache_key)
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Any]:
+        """Возвращает размер индексов и долю найденных похожих запросов"""
+        return {
+            "indexes": len(cls._indexes),
+            "entries": sum(len(index) for index in cls._indexes.values()),
+            "lookups": cls.lookups,
+            "matches": cls.matches,
+            "match_ratio": cls.matches / cls.lookups if cls.lookups else 0.0,
+        }
@@ -1,15 +1,17 @@
 import httpx
 import asyncio
-import tiktoken
 from typing import Dict, Any, List, Optional
 import openai
 from openai import AsyncOpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from sqlalchemy import select
 
-from app.services.base_ai_service import BaseAIService
+from app.services.base_ai_service import BaseAIService, get_default_deadline
+from app.services.context_builder import ContextBuilder, ContextBudgetExceededException
+from app.services.http_pool import HttpClientPool
+from app.services.model_catalog import ModelCatalog
+from app.utils.token_counter import TokenizerRegistry, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
 from app.core.settings import settings
-from app.db.models import UsageStatisticsOrm, AIModelOrm, ProviderOrm
+from app.db.models import UsageStatisticsOrm
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import date
 from sqlalchemy.exc import SQLAlchemyError
@@ -23,6 +25,8 @@ class OpenAIService(BaseAIService):
     Сервис для работы с API OpenAI.
     """
 
+    provider_code = "openai"
+
     def __init__(self, api_key: str):
         """
         Инициализирует сервис OpenAI.
@@ -31,13 +35,15 @@ class OpenAIService(BaseAIService):
             api_key: Ключ API OpenAI
         """
         super().__init__(api_key)
-        self.client = AsyncOpenAI(api_key=api_key)
+        # Соединения берутся из общего пула процесса, а не создаются для каждого ключа
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=settings.OPENAI_BASE_URL,
+            http_client=HttpClientPool.get_client(settings.OPENAI_BASE_URL),
+            # Повторы выполняет RequestExecutor с учетом выключателя и deadline
+            max_retries=0
+        )
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        retry=retry_if_exception_type((openai.APIError, openai.APIConnectionError, openai.RateLimitError))
-    )
     @classmethod
     async def generate_completion(
             cls,
@@ -49,7 +55,8 @@ class OpenAIService(BaseAIService):
             system_prompt: Optional[str] = None,
             max_tokens: int = 1000,
             temperature: float = 0.7,
-            use_context: bool = True
+            use_context: bool = True,
+            deadline: Optional[float] = None
     ) -> Dict[str, Any]:
         """
         Генерирует ответ от AI.
@@ -64,26 +71,36 @@ class OpenAIService(BaseAIService):
             max_tokens: Максимальное количество токенов в ответе
             temperature: Температура (случайность) ответа
             use_context: Использовать ли контекст
+            deadline: Крайний момент завершения по time.monotonic() (опционально)
 
         Returns:
             Dict[str, Any]: Результат генерации
         """
+        if deadline is None:
+            deadline = get_default_deadline()
         try:
             if use_context:
-                # Получаем контекст сообщений
-                context = await cls.build_message_context(db, thread_id)
-
-                # Применяем системный промпт, если указан
-                if system_prompt:
-                    context = await cls.apply_system_prompt(context, system_prompt)
+                # Получаем контекст сообщений в пределах бюджета токенов модели
+                provider = await ModelCatalog.get_provider_by_code(db, ai_service.provider_code)
+                context, packing = await ContextBuilder.build(
+                    db,
+                    thread_id,
+                    model,
+                    max_tokens,
+                    provider_id=provider.id if provider else None,
+                    system_prompt=system_prompt
+                )
 
                 # Генерируем ответ от ИИ с полным контекстом
                 result = await ai_service.generate_completion_with_context(
                     context=context,
                     model=model,
                     max_tokens=max_tokens,
-                    temperature=temperature
+                    temperature=temperature,
+                    deadline=deadline
                 )
+                # Сведения об упаковке контекста сохраняются в meta_data ответа
+                result["context_packing"] = packing
             else:
                 # Генерируем ответ от ИИ без контекста
                 result = await ai_service.generate_completion(
@@ -92,7 +109,8 @@ class OpenAIService(BaseAIService):
                     model=model,
                     max_tokens=max_tokens,
                     temperature=temperature,
-                    system_prompt=system_prompt
+                    system_prompt=system_prompt,
+                    deadline=deadline
                 )
 
             # Если нет ошибки, добавляем стоимость, если она не была рассчитана
@@ -108,6 +126,9 @@ class OpenAIService(BaseAIService):
 
             return result
 
+        except ContextBudgetExceededException as e:
+            # Запрос не поместился в контекст модели и провайдеру не отправлялся
+            return e.to_dict()
         except Exception as e:
             # Возвращаем информацию об ошибке
             return {
@@ -149,13 +170,17 @@ class OpenAIService(BaseAIService):
 
         try:
             # OpenAI API уже поддерживает формат сообщений, поэтому просто передаем контекст
-            response = await self.client.chat.completions.create(
-                model=model,
-                messages=context,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                **kwargs
-            )
+            deadline = kwargs.pop("deadline", None)
+            await self.wait_for_rate_limit(context, max_tokens)
+            with self.track_request():
+                response = await self.call_provider(lambda timeout: self.client.chat.completions.create(
+                    model=model,
+                    messages=context,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    **kwargs,
+                    timeout=timeout if timeout is not None else openai.NOT_GIVEN
+                ), deadline)
             logger.info(f"AI результат: {response}")
 
             # Получаем информацию о токенах
@@ -194,31 +219,21 @@ class OpenAIService(BaseAIService):
             Словарь с количеством токенов
         """
         try:
-            encoding = tiktoken.encoding_for_model(model)
-            token_count = len(encoding.encode(text))
+            # Для неизвестных моделей реестр использует cl100k_base
+            token_count = TokenizerRegistry.count_tokens(text, model)
 
             return {
                 "token_count": token_count
             }
         except Exception as e:
-            # Если не удалось определить энкодинг для указанной модели,
-            # используем cl100k_base (наиболее универсальный)
-            try:
-                encoding = tiktoken.get_encoding("cl100k_base")
-                token_count = len(encoding.encode(text))
+            # В крайнем случае используем приблизительную оценку
+            # (в среднем 4 символа = 1 токен)
+            token_count = len(text) // 4
 
-                return {
-                    "token_count": token_count
-                }
-            except Exception as e:
-                # В крайнем случае используем приблизительную оценку
-                # (в среднем 4 символа = 1 токен)
-                token_count = len(text) // 4
-
-                return {
-                    "token_count": token_count,
-                    "estimated": True
-                }
+            return {
+                "token_count": token_count,
+                "estimated": True
+            }
 
     def count_tokens_for_messages(self, messages: List[Dict[str, str]], model: str) -> int:
         """
@@ -231,28 +246,65 @@ class OpenAIService(BaseAIService):
         Returns:
             Количество токенов
         """
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
+        encoding = TokenizerRegistry.get_encoding(model)
 
-        tokens_per_message = 3  # каждое сообщение начинается с <im_start>{role/name}\n
         tokens_per_name = 1  # если есть имя, формат: {name}\n
 
-        # Подсчет токенов
+        # Подсчет токенов: каждое сообщение начинается с <im_start>{role/name}\n
         num_tokens = 0
         for message in messages:
-            num_tokens += tokens_per_message
+            num_tokens += TOKENS_PER_MESSAGE
             for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
+                num_tokens += len(encoding.encode_ordinary(value))
                 if key == "name":  # только имя потребляет токены_на_имя
                     num_tokens += tokens_per_name
 
         # Каждый ответ начинается с <im_start>assistant
-        num_tokens += 3
+        num_tokens += TOKENS_PER_REPLY
 
         return num_tokens
 
+    async def get_stream_tokens_data(self,
+                                     usage: Any,
+                                     messages: List[Dict[str, str]],
+                                     response_parts: List[str],
+                                     model: str) -> Dict[str, int]:
+        """
+        Возвращает данные о токенах потокового ответа.
+
+        Используется usage, который OpenAI присылает в последнем чанке потока.
+        Локальный подсчет через tiktoken выполняется только если usage не пришел
+        (например, у совместимых API без поддержки stream_options), и уходит
+        в отдельный поток, чтобы не блокировать цикл событий.
+
+        Args:
+            usage: Объект usage из последнего чанка потока или None
+            messages: Сообщения запроса
+            response_parts: Куски сгенерированного ответа
+            model: Код модели
+
+        Returns:
+            Словарь с prompt_tokens, completion_tokens и total_tokens
+        """
+        if usage is not None:
+            return {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "total_tokens": usage.total_tokens
+            }
+
+        def count_locally() -> Dict[str, int]:
+            prompt_tokens = self.count_tokens_for_messages(messages, model)
+            completion_tokens = TokenizerRegistry.count_tokens("".join(response_parts), model)
+            return {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+
+        logger.info(f"Провайдер не вернул usage для модели {model}, токены подсчитаны локально")
+        return await asyncio.to_thread(count_locally)
+
     async def calculate_cost(self, prompt_tokens: int, completion_tokens: int, model: str) -> float:
         """
         Метод оставлен для совместимости с базовым классом.
@@ -287,43 +339,21 @@ class OpenAIService(BaseAIService):
         try:
             today = date.today()
 
-            # Получаем ID провайдера OpenAI
-            provider_query = select(ProviderOrm).filter(ProviderOrm.code == "openai")
-            provider_result = await db.execute(provider_query)
-            provider = provider_result.scalars().first()
+            # Провайдер и модель берутся из каталога в памяти
+            provider = await ModelCatalog.get_provider_by_code(db, "openai")
 
             if not provider:
                 print("Провайдер OpenAI не найден в базе данных")
                 return
 
-            # Получаем ID модели по коду модели или используем напрямую ID
-            model_id = model
-            if isinstance(model, str):
-                # Получаем модель по коду
-                model_query = select(AIModelOrm).filter(
-                    AIModelOrm.code == model,
-                    AIModelOrm.provider_id == provider.id
-                )
-                model_result = await db.execute(model_query)
-                model_obj = model_result.scalars().first()
-
-                if not model_obj:
-                    print(f"Модель {model} не найдена в базе данных")
-                    return
+            # Получаем модель по коду модели или по ID
+            model_obj = await ModelCatalog.find_model(db, model, provider.id)
 
-                model_id = model_obj.id
-            else:
-                # Проверяем существование модели по ID
-                model_query = select(AIModelOrm).filter(
-                    AIModelOrm.id == model_id,
-                    AIModelOrm.provider_id == provider.id
-                )
-                model_result = await db.execute(model_query)
-                model_obj = model_result.scalars().first()
+            if not model_obj:
+                print(f"Модель {model} не найдена в базе данных")
+                return
 
-                if not model_obj:
-                    print(f"Модель с ID {model_id} не найдена в базе данных")
-                    return
+            model_id = model_obj.id
 
             # Ищем или создаем запись статистики за сегодня
             query = select(UsageStatisticsOrm).filter(
@@ -398,39 +428,41 @@ class OpenAIService(BaseAIService):
         if system_prompt:
             messages.insert(0, {"role": "system", "content": system_prompt})
 
-        full_response = ""
-        prompt_tokens = self.count_tokens_for_messages(messages, model_code)
+        response_parts = []
+        usage = None
 
+        stream = None
         try:
             # Запрашиваем потоковый ответ
-            stream = await self.client.chat.completions.create(
-                model=model_code,
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                stream=True,
-                **kwargs
-            )
-
-            # Собираем ответ по кускам
-            async for chunk in stream:
-                if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'content'):
+            deadline = kwargs.pop("deadline", None)
+            await self.wait_for_rate_limit(messages, max_tokens)
+            with self.track_request():
+                stream = await self.call_provider(lambda timeout: self.client.chat.completions.create(
+                    model=model_code,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **kwargs,
+                    timeout=timeout if timeout is not None else openai.NOT_GIVEN
+                ), deadline)
+
+                # Собираем ответ по кускам. Последний чанк приходит без choices
+                # и содержит usage за весь запрос
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
                     content = chunk.choices[0].delta.content
                     if content:
-                        full_response += content
+                        response_parts.append(content)
                         yield {"text": content}
 
-            # Подсчет токенов по завершении
-            completion_tokens = len(tiktoken.encoding_for_model(model_code).encode(full_response))
-            total_tokens = prompt_tokens + completion_tokens
-
-            tokens_data = {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens
-            }
+            tokens_data = await self.get_stream_tokens_data(usage, messages, response_parts, model_code)
 
-            logger.info(f"AI результат: {full_response}")
+            logger.info(f"AI результат: {''.join(response_parts)}")
 
             # Стоимость должна приходить из другого источника
             yield {"tokens": tokens_data, "from_cache": False}
@@ -438,6 +470,11 @@ class OpenAIService(BaseAIService):
         except Exception as e:
             yield {"error": True, "error_message": str(e)}
 
+        finally:
+            # Закрываем HTTP поток сразу, в том числе при отмене генерации
+            if stream is not None:
+                await stream.close()
+
     async def stream_completion_with_context(self,
                                              context: List[Dict[str, str]],
                                              model: str = "gpt-3.5-turbo",
@@ -465,37 +502,39 @@ class OpenAIService(BaseAIService):
             print(f"Warning: Предоставлен ID модели {model}, но для потокового API нужен код модели")
             # Если необходимо, можно добавить логику получения кода модели по ID
 
-        full_response = ""
-        prompt_tokens = self.count_tokens_for_messages(context, model_code)
+        response_parts = []
+        usage = None
 
+        stream = None
         try:
             # Запрашиваем потоковый ответ
-            stream = await self.client.chat.completions.create(
-                model=model_code,
-                messages=context,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                stream=True,
-                **kwargs
-            )
-
-            # Собираем ответ по кускам
-            async for chunk in stream:
-                if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'content'):
+            deadline = kwargs.pop("deadline", None)
+            await self.wait_for_rate_limit(context, max_tokens)
+            with self.track_request():
+                stream = await self.call_provider(lambda timeout: self.client.chat.completions.create(
+                    model=model_code,
+                    messages=context,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **kwargs,
+                    timeout=timeout if timeout is not None else openai.NOT_GIVEN
+                ), deadline)
+
+                # Собираем ответ по кускам. Последний чанк приходит без choices
+                # и содержит usage за весь запрос
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
                     content = chunk.choices[0].delta.content
                     if content:
-                        full_response += content
+                        response_parts.append(content)
                         yield {"text": content}
 
-            # Подсчет токенов по завершении
-            completion_tokens = len(tiktoken.encoding_for_model(model_code).encode(full_response))
-            total_tokens = prompt_tokens + completion_tokens
-
-            tokens_data = {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens
-            }
+            tokens_data = await self.get_stream_tokens_data(usage, context, response_parts, model_code)
 
             # Стоимость должна приходить из другого источника
             yield {"tokens": tokens_data, "from_cache": False}
@@ -503,6 +542,11 @@ class OpenAIService(BaseAIService):
         except Exception as e:
             yield {"error": True, "error_message": str(e)}
 
+        finally:
+            # Закрываем HTTP поток сразу, в том числе при отмене генерации
+            if stream is not None:
+                await stream.close()
+
     async def sync_openai_models(self, db: AsyncSession) -> Dict[str, Any]:
         """
         Получает список доступных моделей от OpenAI API и синхронизирует их с базой данных.
@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import re
+import time
+from datetime import datetime
+from typing import Any, Dict, Mapping, Optional
+
+import httpx
+
+from app.core.settings import settings
+from app.utils.ttl_cache import TTLCache
+
+# Заголовки лимитов: (лимит, остаток, время до восстановления)
+OPENAI_REQUEST_HEADERS = ("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests", "x-ratelimit-reset-requests")
+OPENAI_TOKEN_HEADERS = ("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens")
+ANTHROPIC_REQUEST_HEADERS = (
+    "anthropic-ratelimit-requests-limit", "anthropic-ratelimit-requests-remaining", "anthropic-ratelimit-requests-reset"
+)
+ANTHROPIC_TOKEN_HEADERS = (
+    "anthropic-ratelimit-tokens-limit", "anthropic-ratelimit-tokens-remaining", "anthropic-ratelimit-tokens-reset"
+)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """
+    Преобразует время восстановления лимита в секунды.
+
+    OpenAI передает длительность ("1s", "6m0s", "20ms"), Anthropic - момент
+    времени в формате RFC 3339.
+
+    Args:
+        value: Значение заголовка
+
+    Returns:
+        Количество секунд до восстановления или None
+    """
+    if not value:
+        return None
+
+    parts = _DURATION_PART.findall(value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return max(0.0, reset_at.timestamp() - time.time())
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """
+    Локальное ведро токенов, синхронизируемое с заголовками провайдера.
+
+    После каждого ответа остаток берется из заголовков, а скорость пополнения
+    оценивается как (лимит - остаток) / время до полного восстановления.
+    Между ответами остаток уменьшается на зарезервированные запросы.
+    """
+
+    def __init__(self, capacity: float, remaining: float, refill_rate: float):
+        self.capacity = capacity
+        self.tokens = remaining
+        self.refill_rate = refill_rate
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def sync(self, capacity: float, remaining: float, reset_seconds: Optional[float]) -> None:
+        """Обновляет ведро по заголовкам ответа"""
+        self.capacity = capacity
+        self.tokens = remaining
+        self.updated_at = time.monotonic()
+        if reset_seconds and remaining < capacity:
+            self.refill_rate = (capacity - remaining) / reset_seconds
+
+    def wait_time(self, amount: float) -> float:
+        """Возвращает, сколько секунд ждать, пока в ведре наберется amount"""
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        if self.refill_rate <= 0:
+            return float("inf")
+        return (amount - self.tokens) / self.refill_rate
+
+    def consume(self, amount: float) -> None:
+        self.refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class KeyRateLimiter:
+    """
+    Ограничитель запросов одного API ключа по лимитам запросов и токенов.
+
+    Пока провайдер не прислал заголовки лимитов, запросы не ограничиваются.
+    """
+
+    def __init__(self):
+        self.requests: Optional[TokenBucket] = None
+        self.tokens: Optional[TokenBucket] = None
+        self.waiting = 0
+        self.waited_total = 0
+
+    def update(self, headers: Mapping[str, str], request_headers: tuple, token_headers: tuple) -> None:
+        """Синхронизирует ведра с заголовками ответа провайдера"""
+        self.requests = self._sync_bucket(self.requests, headers, request_headers)
+        self.tokens = self._sync_bucket(self.tokens, headers, token_headers)
+
+    @staticmethod
+    def _sync_bucket(bucket: Optional[TokenBucket], headers: Mapping[str, str], names: tuple) -> Optional[TokenBucket]:
+        limit_header, remaining_header, reset_header = names
+        try:
+            limit = float(headers[limit_header])
+            remaining = float(headers[remaining_header])
+        except (KeyError, TypeError, ValueError):
+            return bucket
+
+        reset_seconds = parse_reset(headers.get(reset_header))
+        if bucket is None:
+            # Пока скорость неизвестна, считаем, что лимит восстанавливается за минуту
+            bucket = TokenBucket(limit, remaining, limit / 60)
+        bucket.sync(limit, remaining, reset_seconds)
+        return bucket
+
+    def expected_wait(self, estimated_tokens: int = 0) -> float:
+        """
+        Оценивает задержку перед отправкой запроса.
+
+        Args:
+            estimated_tokens: Оценка токенов запроса (промпт + max_tokens)
+
+        Returns:
+            Время ожидания в секундах (0 - можно отправлять сразу)
+        """
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None and estimated_tokens:
+            wait = max(wait, self.tokens.wait_time(estimated_tokens))
+        return wait
+
+    async def acquire(self, estimated_tokens: int = 0) -> float:
+        """
+        Дожидается свободного места в лимитах и резервирует его под запрос.
+
+        Ожидание ограничено RATE_LIMIT_MAX_WAIT_SECONDS: после него запрос
+        отправляется, а ответ 429 обрабатывается пулом ключей.
+
+        Args:
+            estimated_tokens: Оценка токенов запроса
+
+        Returns:
+            Фактическое время ожидания в секундах
+        """
+        started = time.monotonic()
+        deadline = started + settings.RATE_LIMIT_MAX_WAIT_SECONDS
+
+        wait = self.expected_wait(estimated_tokens)
+        if wait > 0:
+            self.waiting += 1
+            self.waited_total += 1
+            try:
+                while wait > 0 and time.monotonic() < deadline:
+                    await asyncio.sleep(min(wait, deadline - time.monotonic()))
+                    wait = self.expected_wait(estimated_tokens)
+            finally:
+                self.waiting -= 1
+
+        if self.requests is not None:
+            self.requests.consume(1)
+        if self.tokens is not None and estimated_tokens:
+            self.tokens.consume(estimated_tokens)
+        return time.monotonic() - started
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает состояние лимитов ключа"""
+        def bucket_stats(bucket: Optional[TokenBucket]) -> Optional[Dict[str, float]]:
+            if bucket is None:
+                return None
+            bucket.refill()
+            return {
+                "limit": bucket.capacity,
+                "remaining": round(bucket.tokens, 1),
+                "refill_per_second": round(bucket.refill_rate, 3),
+            }
+
+        return {
+            "requests": bucket_stats(self.requests),
+            "tokens": bucket_stats(self.tokens),
+            "waiting": self.waiting,
+            "waited_total": self.waited_total,
+        }
+
+
+class RateLimiterRegistry:
+    """
+    Ограничители запросов по API ключам в текущем процессе.
+
+    Заголовки лимитов читаются из каждого ответа провайдера в общем HTTP
+    клиенте (см. HttpClientPool). Ключ определяется по заголовку авторизации
+    запроса и хранится в реестре только в виде хэша.
+
+    Реестр ограничен по размеру (LRU), ограничитель ключа, по которому не было
+    запросов дольше SERVICE_CACHE_TTL_SECONDS, удаляется.
+    """
+
+    _limiters = TTLCache(settings.SERVICE_CACHE_MAX_SIZE, settings.SERVICE_CACHE_TTL_SECONDS)
+
+    @staticmethod
+    def _key_hash(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get(cls, api_key: str) -> KeyRateLimiter:
+        """Возвращает ограничитель для API ключа"""
+        key_hash = cls._key_hash(api_key)
+        limiter = cls._limiters.get(key_hash)
+        if limiter is None:
+            limiter = KeyRateLimiter()
+        # Повторное сохранение продлевает жизнь ограничителя, пока ключ используется
+        cls._limiters.set(key_hash, limiter)
+        return limiter
+
+    @classmethod
+    async def on_response(cls, response: httpx.Response) -> None:
+        """Обработчик ответов общего HTTP клиента: обновляет лимиты ключа запроса"""
+        headers = response.headers
+        request_headers = response.request.headers
+
+        if "x-ratelimit-limit-requests" in headers or "x-ratelimit-limit-tokens" in headers:
+            authorization = request_headers.get("authorization", "")
+            if authorization.startswith("Bearer "):
+                cls.get(authorization[len("Bearer "):]).update(headers, OPENAI_REQUEST_HEADERS, OPENAI_TOKEN_HEADERS)
+        elif "anthropic-ratelimit-requests-limit" in headers or "anthropic-ratelimit-tokens-limit" in headers:
+            api_key = request_headers.get("x-api-key")
+            if api_key:
+                cls.get(api_key).update(headers, ANTHROPIC_REQUEST_HEADERS, ANTHROPIC_TOKEN_HEADERS)
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from app.core.settings import settings
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class CircuitOpenException(Exception):
+    """Исключение для случаев, когда запросы к провайдеру временно не выполняются"""
+
+    def __init__(self, provider: str, retry_after: float):
+        self.provider = provider
+        self.retry_after = retry_after
+        super().__init__(
+            f"Провайдер {provider} временно недоступен, повторите запрос через {int(retry_after) + 1} с"
+        )
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель запросов к одному провайдеру.
+
+    Считает результаты запросов за последние CIRCUIT_WINDOW_SECONDS. Если
+    доля сбоев провайдера (5xx, ошибки соединения, таймауты) превышает
+    CIRCUIT_ERROR_RATE, выключатель размыкается и запросы сразу завершаются
+    ошибкой. Через CIRCUIT_OPEN_SECONDS пропускается один пробный запрос:
+    при успехе выключатель замыкается, при сбое снова размыкается.
+    """
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.state = CIRCUIT_CLOSED
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self._results: Deque[Tuple[float, bool]] = deque()
+        self.opened_total = 0
+        self.rejected_total = 0
+        self.failures_total = 0
+        self.successes_total = 0
+
+    def _trim(self) -> None:
+        border = time.monotonic() - settings.CIRCUIT_WINDOW_SECONDS
+        while self._results and self._results[0][0] < border:
+            self._results.popleft()
+
+    def retry_after(self) -> float:
+        """Время до пробного запроса в секундах"""
+        return max(0.0, self.opened_at + settings.CIRCUIT_OPEN_SECONDS - time.monotonic())
+
+    def allow_request(self) -> bool:
+        """
+        Проверяет, можно ли отправить запрос провайдеру.
+
+        Returns:
+            True, если запрос разрешен
+        """
+        if self.state == CIRCUIT_OPEN:
+            if self.retry_after() > 0:
+                self.rejected_total += 1
+                return False
+            self.state = CIRCUIT_HALF_OPEN
+            logger.info(f"Провайдер {self.provider}: пробный запрос")
+
+        if self.state == CIRCUIT_HALF_OPEN:
+            if self.trial_in_flight:
+                self.rejected_total += 1
+                return False
+            self.trial_in_flight = True
+
+        return True
+
+    def record_success(self) -> None:
+        self.successes_total += 1
+        self._results.append((time.monotonic(), True))
+        self._trim()
+        if self.state == CIRCUIT_HALF_OPEN:
+            self.state = CIRCUIT_CLOSED
+            self.trial_in_flight = False
+            self._results.clear()
+            logger.info(f"Провайдер {self.provider}: запросы возобновлены")
+
+    def record_failure(self) -> None:
+        self.failures_total += 1
+        self._results.append((time.monotonic(), False))
+        self._trim()
+
+        if self.state == CIRCUIT_HALF_OPEN:
+            self._open()
+            return
+
+        failures = sum(1 for _, ok in self._results if not ok)
+        if (len(self._results) >= settings.CIRCUIT_MIN_REQUESTS
+                and failures / len(self._results) >= settings.CIRCUIT_ERROR_RATE):
+            self._open()
+
+    def release_trial(self) -> None:
+        """Снимает отметку пробного запроса, если он завершился без вердикта (отмена, ошибка клиента)"""
+        self.trial_in_flight = False
+
+    def _open(self) -> None:
+        self.state = CIRCUIT_OPEN
+        self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+        self.opened_total += 1
+        logger.warning(
+            f"Провайдер {self.provider}: запросы приостановлены на {settings.CIRCUIT_OPEN_SECONDS} с"
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает состояние выключателя"""
+        self._trim()
+        failures = sum(1 for _, ok in self._results if not ok)
+        return {
+            "state": self.state,
+            "retry_after_seconds": round(self.retry_after(), 1) if self.state == CIRCUIT_OPEN else 0,
+            "window_requests": len(self._results),
+            "window_error_rate": round(failures / len(self._results), 3) if self._results else 0.0,
+            "opened_total": self.opened_total,
+            "rejected_total": self.rejected_total,
+            "failures_total": self.failures_total,
+            "successes_total": self.successes_total,
+        }
+
+
+class RequestExecutor:
+    """
+    Общий исполнитель запросов к провайдерам для всех сервисов AI.
+
+    Проверяет выключатель провайдера, повторяет только повторяемые ошибки
+    (классификацию выполняет сервис) и укладывает попытки и паузы между ними
+    в оставшееся время вызывающего кода (deadline).
+    """
+
+    _breakers: Dict[str, CircuitBreaker] = {}
+
+    @classmethod
+    def get_breaker(cls, provider: str) -> CircuitBreaker:
+        """Возвращает выключатель провайдера"""
+        breaker = cls._breakers.get(provider)
+        if breaker is None:
+            breaker = CircuitBreaker(provider)
+            cls._breakers[provider] = breaker
+        return breaker
+
+    @classmethod
+    async def execute(cls,
+                      provider: str,
+                      call: Callable[[Optional[float]], Awaitable[T]],
+                      is_retryable: Callable[[Exception], bool],
+                      is_provider_failure: Callable[[Exception], bool],
+                      deadline: Optional[float] = None) -> T:
+        """
+        Выполняет запрос к провайдеру с выключателем и повторами.
+
+        Args:
+            provider: Код провайдера
+            call: Функция запроса, принимает таймаут попытки в секундах (None - по умолчанию клиента)
+            is_retryable: Можно ли повторить запрос после ошибки
+            is_provider_failure: Считается ли ошибка сбоем провайдера (для выключателя)
+            deadline: Крайний момент завершения по time.monotonic() (опционально)
+
+        Returns:
+            Результат запроса
+
+        Raises:
+            CircuitOpenException: Если запросы к провайдеру приостановлены
+        """
+        breaker = cls.get_breaker(provider)
+        attempt = 0
+
+        while True:
+            if not breaker.allow_request():
+                raise CircuitOpenException(provider, breaker.retry_after())
+
+            attempt += 1
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.1, deadline - time.monotonic())
+
+            try:
+                result = await call(timeout)
+            except Exception as e:
+                if is_provider_failure(e):
+                    breaker.record_failure()
+                else:
+                    breaker.release_trial()
+
+                delay = cls.get_retry_delay(e, attempt)
+                if (not is_retryable(e)
+                        or attempt >= settings.PROVIDER_MAX_ATTEMPTS
+                        or delay > settings.PROVIDER_RETRY_MAX_DELAY
+                        or breaker.state == CIRCUIT_OPEN
+                        or (deadline is not None and time.monotonic() + delay >= deadline)):
+                    raise
+
+                logger.info(
+                    f"Провайдер {provider}: попытка {attempt} не удалась ({type(e).__name__}), повтор через {delay:.1f} с"
+                )
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Отмена запроса не говорит о состоянии провайдера
+                breaker.release_trial()
+                raise
+
+            breaker.record_success()
+            return result
+
+    @staticmethod
+    def get_retry_delay(error: Exception, attempt: int) -> float:
+        """
+        Возвращает паузу перед повтором: Retry-After провайдера или экспоненциальную с разбросом.
+
+        Args:
+            error: Ошибка предыдущей попытки
+            attempt: Номер неудавшейся попытки
+
+        Returns:
+            Пауза в секундах
+        """
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                return float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        base = settings.PROVIDER_RETRY_BASE_DELAY * (2 ** (attempt - 1))
+        return min(settings.PROVIDER_RETRY_MAX_DELAY, base) * random.uniform(0.5, 1.0)
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Any]:
+        """Возвращает состояние выключателей по провайдерам"""
+        return {provider: breaker.get_stats() for provider, breaker in cls._breakers.items()}
@@ -0,0 +1,116 @@
+import importlib
+import logging
+from typing import Dict, Iterable, Tuple, Type
+
+from app.services.base_ai_service import BaseAIService
+from app.services.openai_service import OpenAIService
+from app.services.anthropic_service import AnthropicService
+
+
+class ServiceClassNotFoundException(ImportError):
+    """Исключение для случаев, когда класс сервиса провайдера не найден"""
+    pass
+
+
+class ServiceRegistry:
+    """
+    Реестр классов сервисов AI.
+
+    Сопоставляет код провайдера и строку service_class из таблицы providers
+    с классом сервиса. Встроенные сервисы регистрируются при импорте модуля,
+    дополнительные реализации подключаются через register(). Конфигурация
+    провайдеров проверяется один раз при запуске (validate), после чего поиск
+    класса - обращение к словарю без динамического импорта.
+    """
+
+    # (код провайдера, service_class) -> класс сервиса
+    _classes: Dict[Tuple[str, str], Type[BaseAIService]] = {}
+    _logger = logging.getLogger("service_registry")
+
+    @classmethod
+    def register(cls, provider_code: str, service_class: Type[BaseAIService]) -> None:
+        """
+        Регистрирует класс сервиса для провайдера.
+
+        Класс доступен по короткому имени ("OpenAIService") и по полному пути
+        ("app.services.openai_service.OpenAIService").
+
+        Args:
+            provider_code: Код провайдера (openai, anthropic и т.д.)
+            service_class: Класс сервиса, наследник BaseAIService
+        """
+        if not issubclass(service_class, BaseAIService):
+            raise TypeError(f"{service_class.__name__} не является наследником BaseAIService")
+
+        full_path = f"{service_class.__module__}.{service_class.__name__}"
+        cls._classes[(provider_code, service_class.__name__)] = service_class
+        cls._classes[(provider_code, full_path)] = service_class
+
+    @classmethod
+    def resolve(cls, provider_code: str, service_class: str) -> Type[BaseAIService]:
+        """
+        Возвращает класс сервиса провайдера.
+
+        Незарегистрированный класс загружается по пути из service_class
+        (или из app.services.{code}_service) один раз и запоминается в реестре.
+
+        Args:
+            provider_code: Код провайдера
+            service_class: Имя класса сервиса или полный путь к нему
+
+        Returns:
+            Класс сервиса
+
+        Raises:
+            ServiceClassNotFoundException: Если класс не удалось найти
+        """
+        registered = cls._classes.get((provider_code, service_class))
+        if registered is not None:
+            return registered
+
+        try:
+            if "." in service_class:
+                module_path, class_name = service_class.rsplit(".", 1)
+            else:
+                module_path, class_name = f"app.services.{provider_code}_service", service_class
+            loaded = getattr(importlib.import_module(module_path), class_name)
+        except (ImportError, AttributeError) as e:
+            raise ServiceClassNotFoundException(f"Не удалось загрузить класс сервиса {service_class}: {str(e)}")
+
+        if not isinstance(loaded, type) or not issubclass(loaded, BaseAIService):
+            raise ServiceClassNotFoundException(f"{service_class} не является сервисом AI")
+
+        cls._classes[(provider_code, service_class)] = loaded
+        cls._logger.info(f"Класс сервиса {service_class} для провайдера {provider_code} загружен динамически")
+        return loaded
+
+    @classmethod
+    def validate(cls, providers: Iterable) -> None:
+        """
+        Проверяет, что для всех активных провайдеров найдены классы сервисов.
+
+        Args:
+            providers: Провайдеры из каталога (нужны code, service_class, is_active)
+
+        Raises:
+            ServiceClassNotFoundException: Если у активного провайдера некорректный service_class
+        """
+        errors = []
+        for provider in providers:
+            try:
+                cls.resolve(provider.code, provider.service_class)
+            except ServiceClassNotFoundException as e:
+                if provider.is_active:
+                    errors.append(f"{provider.code}: {str(e)}")
+                else:
+                    cls._logger.warning(f"Неактивный провайдер {provider.code}: {str(e)}")
+
+        if errors:
+            raise ServiceClassNotFoundException(
+                "Некорректная конфигурация провайдеров: " + "; ".join(errors)
+            )
+
+
+# Встроенные провайдеры
+ServiceRegistry.register("openai", OpenAIService)
+ServiceRegistry.register("anthropic", AnthropicService)
@@ -0,0 +1,260 @@
+import json
+import os
+import uuid
+from collections import OrderedDict
+from itertools import chain
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core.settings import settings
+from app.db.models import MessageOrm, ThreadOrm, ThreadSummaryOrm
+from app.utils.token_counter import TOKENS_PER_MESSAGE
+
+THREAD_CONTEXT_CHANNEL = "aihub_thread_context"
+
+# Изменение этих полей сообщения меняет контекст треда
+CONTEXT_FIELDS = ("content", "role", "meta_data", "thread_id")
+
+
+class CachedMessage:
+    """Снимок сообщения треда для контекста (не привязан к сессии БД)"""
+
+    __slots__ = ("id", "thread_id", "role", "content", "meta_data", "content_tokens", "tokens_encoding")
+
+    def __init__(self, message: MessageOrm):
+        self.id = message.id
+        self.thread_id = message.thread_id
+        self.role = message.role
+        self.content = message.content
+        self.meta_data = dict(message.meta_data or {})
+        self.content_tokens = message.content_tokens
+        self.tokens_encoding = message.tokens_encoding
+
+
+class CachedSummary:
+    """Снимок краткого содержания треда (не привязан к сессии БД)"""
+
+    __slots__ = ("content", "last_message_id")
+
+    def __init__(self, summary: ThreadSummaryOrm):
+        self.content = summary.content
+        self.last_message_id = summary.last_message_id
+
+
+class ThreadContext:
+    """Сообщения треда с накопленными суммами токенов"""
+
+    def __init__(self, thread_id: int, messages: List[MessageOrm], summary: Optional[ThreadSummaryOrm] = None):
+        self.thread_id = thread_id
+        self.messages: List[CachedMessage] = []
+        # cumulative_tokens[i] - токены сообщений 0..i вместе со служебными токенами формата чата
+        self.cumulative_tokens: List[int] = []
+        self.summary = CachedSummary(summary) if summary is not None else None
+        for message in messages:
+            self.append(CachedMessage(message))
+
+    @property
+    def last_message_id(self) -> int:
+        return self.messages[-1].id if self.messages else 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.cumulative_tokens[-1] if self.cumulative_tokens else 0
+
+    def append(self, message: CachedMessage) -> None:
+        self.messages.append(message)
+        self.cumulative_tokens.append(self.total_tokens + (message.content_tokens or 0) + TOKENS_PER_MESSAGE)
+
+
+class ThreadContextCache:
+    """
+    LRU кэш контекстов тредов в памяти процесса.
+
+    Запись - снимки сообщений треда и краткого содержания, ключ - ID треда,
+    запись действительна для последнего известного ID сообщения. Новые
+    сообщения после commit дописываются в запись, поэтому при отправке
+    в активном диалоге история треда не загружается из базы данных.
+    Изменение или удаление сообщения, краткого содержания или треда
+    удаляет запись. Другие воркеры узнают об изменениях через канал
+    PostgreSQL LISTEN/NOTIFY и удаляют свои записи этих тредов.
+    """
+
+    _entries: "OrderedDict[int, ThreadContext]" = OrderedDict()
+    # ID треда -> [изменений с начала загрузки, загрузок в процессе]
+    _loading: Dict[int, List[int]] = {}
+    # Уведомления текущего процесса не сбрасывают записи, которые он только что дополнил
+    _origin = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def get(cls, thread_id: int, last_message_id: Optional[int] = None) -> Optional[ThreadContext]:
+        """
+        Возвращает контекст треда из кэша.
+
+        Args:
+            thread_id: ID треда
+            last_message_id: Ожидаемый ID последнего сообщения (опционально)
+
+        Returns:
+            Контекст треда или None, если его нет в кэше или он устарел
+        """
+        entry = cls._entries.get(thread_id)
+        if entry is None or (last_message_id is not None and entry.last_message_id != last_message_id):
+            cls.misses += 1
+            return None
+        cls._entries.move_to_end(thread_id)
+        cls.hits += 1
+        return entry
+
+    @classmethod
+    async def load(cls, db: AsyncSession, thread_id: int) -> ThreadContext:
+        """
+        Загружает сообщения и краткое содержание треда из базы данных и сохраняет их в кэш.
+
+        Если во время загрузки тред изменился, результат возвращается,
+        но в кэш не попадает.
+
+        Args:
+            db: Сессия базы данных
+            thread_id: ID треда
+
+        Returns:
+            Контекст треда
+        """
+        loading = cls._loading.setdefault(thread_id, [0, 0])
+        loading[1] += 1
+        changes = loading[0]
+        try:
+            result = await db.execute(
+                select(MessageOrm)
+                .filter(MessageOrm.thread_id == thread_id)
+                .order_by(MessageOrm.created_at, MessageOrm.id)
+            )
+            messages = result.scalars().all()
+
+            result = await db.execute(select(ThreadSummaryOrm).filter(ThreadSummaryOrm.thread_id == thread_id))
+            summary = result.scalars().first()
+
+            entry = ThreadContext(thread_id, messages, summary)
+            if loading[0] == changes:
+                cls.put(entry)
+            return entry
+        finally:
+            loading[1] -= 1
+            if loading[1] == 0:
+                cls._loading.pop(thread_id, None)
+
+    @classmethod
+    def _mark_changed(cls, thread_id: int) -> None:
+        loading = cls._loading.get(thread_id)
+        if loading is not None:
+            loading[0] += 1
+
+    @classmethod
+    def put(cls, entry: ThreadContext) -> None:
+        """Сохраняет контекст треда, вытесняя самые давние записи"""
+        cls._entries[entry.thread_id] = entry
+        cls._entries.move_to_end(entry.thread_id)
+        while len(cls._entries) > settings.THREAD_CONTEXT_CACHE_MAX_SIZE:
+            cls._entries.popitem(last=False)
+
+    @classmethod
+    def append(cls, message: CachedMessage) -> None:
+        """Дописывает новое сообщение в запись треда (запись с пропусками удаляется)"""
+        cls._mark_changed(message.thread_id)
+        entry = cls._entries.get(message.thread_id)
+        if entry is None:
+            return
+        if message.id > entry.last_message_id:
+            entry.append(message)
+        else:
+            cls.invalidate(message.thread_id)
+
+    @classmethod
+    def invalidate(cls, thread_id: int) -> None:
+        """Удаляет запись треда"""
+        cls._mark_changed(thread_id)
+        cls._entries.pop(thread_id, None)
+
+    @classmethod
+    async def handle_change_notification(cls, payload: Dict[str, Any]) -> None:
+        """Обработчик уведомлений об изменении тредов на других воркерах"""
+        if payload.get("origin") == cls._origin:
+            return
+        for thread_id in payload.get("thread_ids", []):
+            cls.invalidate(thread_id)
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Any]:
+        """Возвращает размер кэша и долю попаданий"""
+        requests = cls.hits + cls.misses
+        return {
+            "size": len(cls._entries),
+            "max_size": settings.THREAD_CONTEXT_CACHE_MAX_SIZE,
+            "messages": sum(len(entry.messages) for entry in cls._entries.values()),
+            "hits": cls.hits,
+            "misses": cls.misses,
+            "hit_ratio": cls.hits / requests if requests else 0.0,
+        }
+
+
+def _is_context_changed(message: MessageOrm) -> bool:
+    state = inspect(message)
+    return any(state.attrs[field].history.has_changes() for field in CONTEXT_FIELDS)
+
+
+@event.listens_for(Session, "after_flush")
+def thread_context_after_flush(session, flush_context):
+    """Запоминает изменения тредов до commit и уведомляет о них другие воркеры"""
+    appended = [CachedMessage(obj) for obj in session.new if isinstance(obj, MessageOrm)]
+    invalidated = set()
+    for obj in chain(session.dirty, session.deleted):
+        if isinstance(obj, MessageOrm) and (obj in session.deleted or _is_context_changed(obj)):
+            invalidated.add(obj.thread_id)
+            # Сообщение перенесено в другой тред
+            for thread_id in inspect(obj).attrs.thread_id.history.deleted or ():
+                invalidated.add(thread_id)
+        elif isinstance(obj, ThreadOrm) and obj in session.deleted:
+            invalidated.add(obj.id)
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, ThreadSummaryOrm):
+            invalidated.add(obj.thread_id)
+
+    if not appended and not invalidated:
+        return
+
+    changes = session.info.setdefault("thread_context_changes", {"appended": [], "invalidated": set()})
+    changes["appended"].extend(appended)
+    changes["invalidated"].update(invalidated)
+
+    # NOTIFY внутри транзакции доставляется слушателям только после commit
+    thread_ids = sorted(invalidated | {message.thread_id for message in appended})
+    session.connection().execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {
+            "channel": THREAD_CONTEXT_CHANNEL,
+            "payload": json.dumps({"origin": ThreadContextCache._origin, "thread_ids": thread_ids})
+        }
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def thread_context_after_commit(session):
+    """Применяет зафиксированные изменения к кэшу текущего процесса"""
+    changes = session.info.pop("thread_context_changes", None)
+    if changes is None:
+        return
+    for thread_id in changes["invalidated"]:
+        ThreadContextCache.invalidate(thread_id)
+    for message in sorted(changes["appended"], key=lambda m: m.id):
+        if message.thread_id not in changes["invalidated"]:
+            ThreadContextCache.append(message)
+
+
+@event.listens_for(Session, "after_rollback")
+def thread_context_after_rollback(session):
+    session.info.pop("thread_context_changes", None)
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.settings import settings
+from app.db.database import new_session
+from app.db.models import MessageOrm, ThreadSummaryOrm
+from app.services.ai_service_factory import AIServiceFactory, APIKeyNotFoundException
+from app.services.base_ai_service import get_default_deadline
+from app.services.model_catalog import ModelCatalog
+from app.utils.token_counter import TokenizerRegistry, get_message_tokens
+
+SUMMARY_INSTRUCTIONS = (
+    "Ты ведешь краткое содержание длинного диалога пользователя с ассистентом. "
+    "Дополни текущее краткое содержание новыми сообщениями. Сохрани факты, решения, "
+    "договоренности, имена, числа и открытые вопросы, опусти приветствия и повторы. "
+    "Ответь только обновленным кратким содержанием."
+)
+
+
+class ThreadSummarizer:
+    """
+    Фоновая свертка ранней части длинных тредов в краткое содержание.
+
+    После каждого ответа ассистента проверяется, сколько токенов накопилось
+    в сообщениях после контрольной точки (ThreadSummaryOrm.last_message_id).
+    Если больше SUMMARY_TRIGGER_TOKENS, все, кроме последних
+    SUMMARY_KEEP_RECENT_TOKENS, сворачивается недорогой моделью
+    SUMMARY_MODEL_CODE: в запрос идут только прежнее краткое содержание
+    и новые сообщения, поэтому стоимость свертки не растет с длиной треда.
+    Запрос выполняется с API ключом владельца треда.
+    """
+
+    _tasks: Dict[int, asyncio.Task] = {}
+    _logger = logging.getLogger("thread_summarizer")
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        return bool(settings.SUMMARY_MODEL_CODE)
+
+    @classmethod
+    def schedule(cls, thread_id: int, user_id: int) -> None:
+        """
+        Запускает свертку треда в фоне, если она включена и еще не выполняется.
+
+        Args:
+            thread_id: ID треда
+            user_id: ID владельца треда
+        """
+        if not cls.is_enabled():
+            return
+
+        task = cls._tasks.get(thread_id)
+        if task is not None and not task.done():
+            return
+
+        task = asyncio.create_task(cls._run(thread_id, user_id))
+        cls._tasks[thread_id] = task
+        task.add_done_callback(lambda _: cls._tasks.pop(thread_id, None))
+
+    @classmethod
+    async def _run(cls, thread_id: int, user_id: int) -> None:
+        try:
+            async with new_session() as db:
+                # Длинная история сворачивается за несколько запросов
+                while await cls.summarize(db, thread_id, user_id) is not None:
+                    pass
+        except Exception as e:
+            cls._logger.warning(f"Ошибка свертки треда #{thread_id}: {str(e)}")
+
+    @staticmethod
+    def select_messages_to_fold(messages: List[MessageOrm], model: str) -> List[MessageOrm]:
+        """
+        Выбирает сообщения для свертки.
+
+        Args:
+            messages: Сообщения после контрольной точки в хронологическом порядке
+            model: Код модели, по которой считаются токены
+
+        Returns:
+            Сообщения для свертки (пустой список, если порог не достигнут)
+        """
+        # Для порогов достаточно сохраненных счетчиков в любой кодировке
+        tokens = [
+            message.content_tokens if message.content_tokens is not None else get_message_tokens(message, model)
+            for message in messages
+        ]
+        if sum(tokens) <= settings.SUMMARY_TRIGGER_TOKENS:
+            return []
+
+        # Последние ходы остаются в контексте целиком
+        recent_tokens = 0
+        split = len(messages)
+        while split > 0 and recent_tokens + tokens[split - 1] <= settings.SUMMARY_KEEP_RECENT_TOKENS:
+            split -= 1
+            recent_tokens += tokens[split]
+
+        # Свертка за один запрос ограничена SUMMARY_BATCH_TOKENS, остальное - при следующем запуске
+        batch_tokens = 0
+        end = 0
+        while end < split and (end == 0 or batch_tokens + tokens[end] <= settings.SUMMARY_BATCH_TOKENS):
+            batch_tokens += tokens[end]
+            end += 1
+        return messages[:end]
+
+    @classmethod
+    async def summarize(cls, db: AsyncSession, thread_id: int, user_id: int) -> Optional[ThreadSummaryOrm]:
+        """
+        Сворачивает сообщения треда, добавленные после контрольной точки.
+
+        Args:
+            db: Сессия базы данных
+            thread_id: ID треда
+            user_id: ID владельца треда
+
+        Returns:
+            Обновленное краткое содержание или None, если свертка не понадобилась
+        """
+        model = settings.SUMMARY_MODEL_CODE
+
+        result = await db.execute(select(ThreadSummaryOrm).filter(ThreadSummaryOrm.thread_id == thread_id))
+        summary = result.scalars().first()
+        checkpoint = summary.last_message_id if summary else 0
+
+        result = await db.execute(
+            select(MessageOrm)
+            .filter(
+                (MessageOrm.thread_id == thread_id) &
+                (MessageOrm.id > checkpoint) &
+                (MessageOrm.role != "system")
+            )
+            .order_by(MessageOrm.created_at, MessageOrm.id)
+        )
+        messages = [m for m in result.scalars().all() if not (m.meta_data or {}).get("error")]
+
+        to_fold = cls.select_messages_to_fold(messages, model)
+        if not to_fold:
+            return None
+
+        provider = await ModelCatalog.get_provider_by_code(db, settings.SUMMARY_PROVIDER_CODE)
+        if provider is None:
+            cls._logger.warning(f"Провайдер {settings.SUMMARY_PROVIDER_CODE} для свертки не найден")
+            return None
+
+        try:
+            ai_service = await AIServiceFactory.get_service_by_user_and_provider(db, user_id, provider.id)
+        except APIKeyNotFoundException:
+            cls._logger.info(f"Нет API ключа {provider.code} для свертки треда #{thread_id}")
+            return None
+
+        dialog = "\n\n".join(f"{message.role}: {message.content}" for message in to_fold)
+        previous = summary.content if summary else "(пока пусто)"
+        context = [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {
+                "role": "user",
+                "content": f"Текущее краткое содержание:\n{previous}\n\nНовые сообщения:\n{dialog}"
+            }
+        ]
+
+        response = await ai_service.generate_completion_with_context(
+            context=context,
+            model=model,
+            max_tokens=settings.SUMMARY_MAX_TOKENS,
+            temperature=0,
+            deadline=get_default_deadline()
+        )
+        if response.get("error", False) or not response.get("text"):
+            cls._logger.warning(
+                f"Модель не вернула краткое содержание треда #{thread_id}: {response.get('error_message')}"
+            )
+            return None
+
+        content = response["text"].strip()
+        if summary is None:
+            summary = ThreadSummaryOrm(thread_id=thread_id, messages_count=0)
+            db.add(summary)
+        summary.content = content
+        summary.last_message_id = to_fold[-1].id
+        summary.messages_count = (summary.messages_count or 0) + len(to_fold)
+        summary.content_tokens = TokenizerRegistry.count_tokens(content, model)
+        summary.model_code = model
+        await db.commit()
+
+        tokens_data = response.get("tokens", {})
+        cost = response.get("cost")
+        if cost is None:
+            cost = await ai_service.calculate_cost(
+                tokens_data.get("prompt_tokens", 0), tokens_data.get("completion_tokens", 0), model
+            )
+        await ai_service.update_usage_statistics(
+            db=db, user_id=user_id, tokens_data=tokens_data, model=model, cost=cost
+        )
+
+        cls._logger.info(
+            f"Тред #{thread_id}: свернуто сообщений {len(to_fold)}, контрольная точка #{summary.last_message_id}"
+        )
+        return summary
@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.settings import settings
+from app.db.database import new_session
+from app.db.models import MessageOrm, TokenEstimatorRatiosOrm
+from app.utils.token_counter import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+
+# Виды символов и шаблоны для их подсчета (прочее - пунктуация, символы, эмодзи)
+SCRIPT_PATTERNS = {
+    "latin": re.compile(r"[A-Za-z\u00C0-\u024F]"),
+    "cyrillic": re.compile(r"[\u0400-\u04FF]"),
+    "cjk": re.compile(r"[\u3040-\u30FF\u3400-\u9FFF\uAC00-\uD7AF]"),
+    "digit": re.compile(r"[0-9]"),
+    "space": re.compile(r"\s"),
+}
+SCRIPTS = list(SCRIPT_PATTERNS) + ["other"]
+
+# Токенов на символ, пока коэффициенты не подобраны по истории
+DEFAULT_RATIOS = {
+    "latin": 0.25,
+    "cyrillic": 0.4,
+    "cjk": 1.0,
+    "digit": 0.4,
+    "space": 0.05,
+    "other": 0.6,
+}
+
+# Ключ общих коэффициентов для моделей без собственных
+COMMON_RATIOS_KEY = "*"
+
+# Префикс tokens_encoding сообщений, токены которых посчитаны оценкой
+ESTIMATE_ENCODING_PREFIX = "estimate:"
+
+
+class TokenEstimator:
+    """
+    Оценка количества токенов для моделей без локального токенизатора.
+
+    Текст раскладывается на количество символов каждого вида (латиница,
+    кириллица, CJK, цифры, пробелы, прочее), оценка - сумма символов,
+    умноженных на коэффициенты токенов на символ. Коэффициенты подбираются
+    по истории сообщений отдельным запуском (python -m app.services.token_estimator)
+    и загружаются при запуске приложения. Оценка занимает O(len(text))
+    и не обращается к сети и базе данных.
+    """
+
+    _ratios: Dict[str, Dict[str, float]] = {}
+    # Метки оценок по моделям: (коэффициенты, по которым посчитана метка, метка)
+    _encoding_tags: Dict[str, Tuple[Dict[str, float], str]] = {}
+    _logger = logging.getLogger("token_estimator")
+
+    @staticmethod
+    def count_scripts(text: str) -> Dict[str, int]:
+        """
+        Подсчитывает символы каждого вида в тексте.
+
+        Args:
+            text: Текст
+
+        Returns:
+            Словарь {вид символов: количество}
+        """
+        counts = {script: len(pattern.findall(text)) for script, pattern in SCRIPT_PATTERNS.items()}
+        counts["other"] = len(text) - sum(counts.values())
+        return counts
+
+    @classmethod
+    def get_ratios(cls, model: str) -> Dict[str, float]:
+        """Возвращает коэффициенты модели, общие коэффициенты или коэффициенты по умолчанию"""
+        return cls._ratios.get(model) or cls._ratios.get(COMMON_RATIOS_KEY) or DEFAULT_RATIOS
+
+    @classmethod
+    def get_encoding_tag(cls, model: str) -> str:
+        """
+        Возвращает значение tokens_encoding для оценки токенов сообщения.
+
+        Метка содержит хэш модели и ее коэффициентов, поэтому сохраненная оценка
+        пересчитывается только после загрузки других коэффициентов.
+
+        Args:
+            model: Код модели
+
+        Returns:
+            Строка вида estimate:<хэш>
+        """
+        ratios = cls.get_ratios(model)
+        cached = cls._encoding_tags.get(model)
+        if cached is not None and cached[0] is ratios:
+            return cached[1]
+
+        payload = json.dumps([model, ratios], sort_keys=True)
+        tag = ESTIMATE_ENCODING_PREFIX + hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+        cls._encoding_tags[model] = (ratios, tag)
+        return tag
+
+    @classmethod
+    def estimate(cls, text: str, model: str) -> int:
+        """
+        Оценивает количество токенов в тексте.
+
+        Args:
+            text: Текст
+            model: Код модели
+
+        Returns:
+            Оценка количества токенов
+        """
+        if not text:
+            return 0
+        ratios = cls.get_ratios(model)
+        counts = cls.count_scripts(text)
+        return max(1, round(sum(ratios.get(script, DEFAULT_RATIOS[script]) * counts[script] for script in SCRIPTS)))
+
+    @classmethod
+    def estimate_messages(cls, messages: List[Dict[str, str]], model: str) -> int:
+        """
+        Оценивает количество токенов в сообщениях чата вместе со служебными токенами.
+
+        Args:
+            messages: Сообщения [{"role": ..., "content": ...}, ...]
+            model: Код модели
+
+        Returns:
+            Оценка количества токенов
+        """
+        return sum(
+            cls.estimate(message.get("content") or "", model) + TOKENS_PER_MESSAGE for message in messages
+        ) + TOKENS_PER_REPLY
+
+    @classmethod
+    async def load(cls, db: AsyncSession) -> None:
+        """
+        Загружает подобранные коэффициенты из базы данных.
+
+        Args:
+            db: Сессия базы данных
+        """
+        result = await db.execute(select(TokenEstimatorRatiosOrm))
+        cls._ratios = {
+            row.model_code: {**DEFAULT_RATIOS, **(row.ratios or {})}
+            for row in result.scalars().all()
+        }
+        cls._encoding_tags = {}
+        cls._logger.info(f"Загружены коэффициенты оценки токенов для {len(cls._ratios)} моделей")
+
+    @staticmethod
+    def fit_ratios(samples: Iterable[Tuple[Dict[str, int], int]]) -> Tuple[Dict[str, float], int, int]:
+        """
+        Подбирает коэффициенты по примерам (символы по видам, фактические токены).
+
+        Взвешенный метод наименьших квадратов с неотрицательными коэффициентами:
+        вес примера обратно пропорционален его длине, чтобы длинные сообщения
+        не определяли результат целиком. Коэффициенты по умолчанию входят
+        как псевдопример из TOKEN_ESTIMATOR_PRIOR_CHARS символов каждого вида,
+        поэтому редкие виды символов остаются около значений по умолчанию.
+
+        Args:
+            samples: Пары (результат count_scripts, фактическое количество токенов)
+
+        Returns:
+            Кортеж (коэффициенты, количество примеров, суммарная длина)
+        """
+        size = len(SCRIPTS)
+        prior = settings.TOKEN_ESTIMATOR_PRIOR_CHARS
+        # Нормальные уравнения A r = b
+        a = [[0.0] * size for _ in range(size)]
+        b = [0.0] * size
+        for j, script in enumerate(SCRIPTS):
+            a[j][j] = prior
+            b[j] = prior * DEFAULT_RATIOS[script]
+
+        count = 0
+        total_chars = 0
+        for counts, tokens in samples:
+            length = sum(counts.values())
+            if length <= 0 or tokens <= 0:
+                continue
+            x = [counts[script] for script in SCRIPTS]
+            for j in range(size):
+                if x[j]:
+                    b[j] += x[j] * tokens / length
+                    for k in range(size):
+                        a[j][k] += x[j] * x[k] / length
+            count += 1
+            total_chars += length
+
+        # Покоординатный спуск с ограничением r >= 0
+        ratios = [DEFAULT_RATIOS[script] for script in SCRIPTS]
+        for _ in range(200):
+            delta = 0.0
+            for j in range(size):
+                rest = sum(a[j][k] * ratios[k] for k in range(size) if k != j)
+                value = max(0.0, (b[j] - rest) / a[j][j])
+                delta = max(delta, abs(value - ratios[j]))
+                ratios[j] = value
+            if delta < 1e-6:
+                break
+
+        return {script: round(ratios[j], 5) for j, script in enumerate(SCRIPTS)}, count, total_chars
+
+    @staticmethod
+    def mean_error(samples: List[Tuple[Dict[str, int], int]], ratios: Dict[str, float]) -> Optional[float]:
+        """Средняя относительная ошибка оценки на примерах"""
+        errors = [
+            abs(sum(ratios[script] * counts[script] for script in SCRIPTS) - tokens) / tokens
+            for counts, tokens in samples if tokens > 0
+        ]
+        return round(sum(errors) / len(errors), 4) if errors else None
+
+    @classmethod
+    async def collect_samples(cls,
+                              db: AsyncSession,
+                              provider_code: Optional[str] = None) -> Dict[str, List[Tuple[Dict[str, int], int]]]:
+        """
+        Собирает примеры из истории сообщений по моделям.
+
+        Ответ ассистента дает пару (его текст, tokens_output). Для первого ответа
+        в треде контекст запроса известен точно - все сообщения до него,
+        поэтому добавляется пара (их текст, tokens_input без служебных токенов).
+        Сообщения с ошибками, из кэша и остановленные генерации пропускаются.
+
+        Args:
+            db: Сессия базы данных
+            provider_code: Код провайдера, по сообщениям которого подбирать коэффициенты (опционально)
+
+        Returns:
+            Словарь {код модели: [(символы по видам, токены), ...]}
+        """
+        query = (
+            select(MessageOrm)
+            .order_by(MessageOrm.thread_id.desc(), MessageOrm.created_at, MessageOrm.id)
+            .execution_options(yield_per=1000)
+        )
+        samples: Dict[str, List[Tuple[Dict[str, int], int]]] = {}
+        collected = 0
+        thread_id = None
+        prompt: Optional[List[MessageOrm]] = []
+
+        stream = await db.stream_scalars(query)
+        async for message in stream:
+            if message.thread_id != thread_id:
+                if collected >= settings.TOKEN_ESTIMATOR_MAX_SAMPLES:
+                    break
+                thread_id = message.thread_id
+                prompt = []
+
+            meta_data = message.meta_data or {}
+            if meta_data.get("error"):
+                continue
+            if message.role != "assistant":
+                if prompt is not None:
+                    prompt.append(message)
+                continue
+
+            is_first_reply = prompt is not None
+            prompt_messages, prompt = prompt, None
+            if not message.model_code or (provider_code and message.provider_code != provider_code):
+                continue
+            if message.is_cached or meta_data.get("from_cache") or meta_data.get("stopped_early"):
+                continue
+
+            model_samples = samples.setdefault(message.model_code, [])
+            if message.tokens_output:
+                model_samples.append((cls.count_scripts(message.content), message.tokens_output))
+                collected += 1
+            if is_first_reply and prompt_messages and message.tokens_input:
+                overhead = TOKENS_PER_MESSAGE * len(prompt_messages) + TOKENS_PER_REPLY
+                text = "\n".join(m.content for m in prompt_messages)
+                model_samples.append((cls.count_scripts(text), message.tokens_input - overhead))
+                collected += 1
+
+        return samples
+
+    @classmethod
+    async def fit(cls, db: AsyncSession, provider_code: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Подбирает коэффициенты по истории сообщений и сохраняет их в базу данных.
+
+        Для моделей, у которых меньше TOKEN_ESTIMATOR_MIN_SAMPLES примеров,
+        отдельные коэффициенты не сохраняются - для них используются общие.
+
+        Args:
+            db: Сессия базы данных
+            provider_code: Код провайдера (опционально)
+
+        Returns:
+            Словарь {код модели: {"ratios", "samples", "chars", "mean_error"}}
+        """
+        samples = await cls.collect_samples(db, provider_code)
+        groups = {
+            model: model_samples
+            for model, model_samples in samples.items()
+            if len(model_samples) >= settings.TOKEN_ESTIMATOR_MIN_SAMPLES
+        }
+        groups[COMMON_RATIOS_KEY] = [sample for model_samples in samples.values() for sample in model_samples]
+
+        result = await db.execute(
+            select(TokenEstimatorRatiosOrm).filter(TokenEstimatorRatiosOrm.model_code.in_(list(groups)))
+        )
+        rows = {row.model_code: row for row in result.scalars().all()}
+
+        fitted = {}
+        for model, model_samples in groups.items():
+            ratios, count, chars = cls.fit_ratios(model_samples)
+            error = cls.mean_error(model_samples, ratios)
+            row = rows.get(model)
+            if row is None:
+                row = TokenEstimatorRatiosOrm(model_code=model)
+                db.add(row)
+            row.ratios = ratios
+            row.samples = count
+            row.chars = chars
+            row.mean_error = error
+            fitted[model] = {"ratios": ratios, "samples": count, "chars": chars, "mean_error": error}
+            cls._logger.info(f"Коэффициенты для {model}: {ratios}, примеров {count}, ошибка {error}")
+
+        await db.commit()
+        return fitted
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Any]:
+        """Возвращает загруженные коэффициенты"""
+        return {"defaults": DEFAULT_RATIOS, "models": dict(cls._ratios)}
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description="Подбор коэффициентов оценки токенов по истории сообщений")
+    parser.add_argument("--provider", help="Код провайдера, например anthropic")
+    args = parser.parse_args()
+
+    async with new_session() as db:
+        fitted = await TokenEstimator.fit(db, args.provider)
+    for model, info in sorted(fitted.items()):
+        print(f"{model}: примеров {info['samples']}, ошибка {info['mean_error']}, {info['ratios']}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
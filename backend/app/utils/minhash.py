@@ -0,0 +1,81 @@
+import hashlib
+import random
+import re
+from typing import List, Set, Tuple
+
+# Простое число Мерсенна 2^61 - 1 для универсального хэширования
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 61) - 1
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def shingles(text: str, size: int = 5) -> Set[int]:
+    """
+    Разбивает текст на символьные n-граммы и возвращает их 64-битные хэши.
+
+    Символьные n-граммы устойчивы к мелким правкам: замена имени переменной
+    меняет только n-граммы вокруг нее, остальные совпадают.
+
+    Args:
+        text: Исходный текст
+        size: Длина n-граммы в символах
+
+    Returns:
+        Множество хэшей n-грамм
+    """
+    normalized = _WHITESPACE.sub(" ", text.lower()).strip()
+    if len(normalized) <= size:
+        normalized = normalized.ljust(size)
+    return {
+        int.from_bytes(hashlib.blake2b(normalized[i:i + size].encode("utf-8"), digest_size=8).digest(), "big")
+        for i in range(len(normalized) - size + 1)
+    }
+
+
+class MinHasher:
+    """
+    Вычисляет MinHash сигнатуры текстов.
+
+    Доля совпадающих позиций двух сигнатур оценивает коэффициент Жаккара
+    множеств n-грамм текстов. Перестановки фиксируются seed, поэтому
+    сигнатуры одного хэшера сравнимы между собой.
+    """
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5, seed: int = 1):
+        """
+        Args:
+            num_perm: Длина сигнатуры (количество хэш-функций)
+            shingle_size: Длина n-граммы в символах
+            seed: Зерно генератора перестановок
+        """
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self._permutations: List[Tuple[int, int]] = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        """
+        Возвращает MinHash сигнатуру текста.
+
+        Args:
+            text: Исходный текст
+
+        Returns:
+            Кортеж из num_perm минимальных значений хэш-функций
+        """
+        hashes = shingles(text, self.shingle_size)
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self._permutations
+        )
+
+    @staticmethod
+    def similarity(first: Tuple[int, ...], second: Tuple[int, ...]) -> float:
+        """Оценка коэффициента Жаккара по двум сигнатурам одинаковой длины"""
+        if not first or len(first) != len(second):
+            return 0.0
+        return sum(1 for x, y in zip(first, second) if x == y) / len(first)
@@ -0,0 +1,89 @@
+import asyncio
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+# Заголовки ответа для потоковой передачи Server-Sent Events
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Content-Type': 'text/event-stream'
+}
+
+
+def format_sse_event(data: Dict[str, Any], event_id: Optional[str] = None) -> str:
+    """
+    Форматирует кусок ответа как событие SSE.
+
+    Args:
+        data: Данные события
+        event_id: Идентификатор события для переподключения через Last-Event-ID (опционально)
+
+    Returns:
+        Строка события SSE
+    """
+    if event_id is not None:
+        return f"id: {event_id}\ndata: {json.dumps(data)}\n\n"
+    return f"data: {json.dumps(data)}\n\n"
+
+
+class TextChunkCoalescer:
+    """
+    Склеивает текстовые куски ответа в одно событие SSE.
+
+    Первый текстовый кусок передается сразу, чтобы клиент увидел начало ответа
+    без задержки. Последующие накапливаются и отправляются одним куском раз
+    в interval_ms миллисекунд или при накоплении max_bytes байт. Любой
+    нетекстовый кусок (done, error и т.д.) сначала выталкивает накопленный текст.
+    """
+
+    def __init__(self, emit: Callable[[Dict[str, Any]], None], interval_ms: int, max_bytes: int):
+        """
+        Args:
+            emit: Функция, которая публикует готовый кусок
+            interval_ms: Окно склейки в миллисекундах (0 - без склейки)
+            max_bytes: Объем текста, при котором кусок отправляется досрочно
+        """
+        self._emit = emit
+        self._interval = interval_ms / 1000
+        self._max_bytes = max_bytes
+        self._parts: List[str] = []
+        self._size = 0
+        self._first_sent = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def push(self, chunk: Dict[str, Any]) -> None:
+        """
+        Принимает очередной кусок ответа.
+
+        Args:
+            chunk: Кусок ответа
+        """
+        if chunk.keys() != {"text"} or self._interval <= 0:
+            self.flush()
+            self._emit(chunk)
+            return
+
+        if not self._first_sent:
+            self._first_sent = True
+            self._emit(chunk)
+            return
+
+        self._parts.append(chunk["text"])
+        self._size += len(chunk["text"].encode("utf-8"))
+
+        if self._size >= self._max_bytes:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._interval, self.flush)
+
+    def flush(self) -> None:
+        """Отправляет накопленный текст одним куском"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._parts:
+            return
+        text = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._emit({"text": text})
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Sequence
+
+import tiktoken
+
+from app.core.settings import settings
+
+# Кодировка для моделей, которых нет в таблице tiktoken (новые модели, другие провайдеры)
+DEFAULT_ENCODING = "cl100k_base"
+
+# Служебные токены формата чата: на каждое сообщение и на начало ответа
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+class TokenizerRegistry:
+    """
+    Реестр токенизаторов tiktoken в памяти процесса.
+
+    Соответствие модель -> кодировка определяется один раз, загруженные
+    кодировки запоминаются. Загрузка BPE файла кодировки занимает заметное
+    время, поэтому при запуске приложения реестр прогревается для всех
+    активных моделей (warm_up), а время загрузки каждой кодировки
+    сохраняется для статистики.
+    """
+
+    _encodings: Dict[str, tiktoken.Encoding] = {}
+    _model_encodings: Dict[str, str] = {}
+    _load_times: Dict[str, float] = {}
+    _lock = threading.Lock()
+    _logger = logging.getLogger("token_counter")
+
+    @classmethod
+    def get_encoding_name(cls, model: str) -> str:
+        """
+        Возвращает имя кодировки для модели.
+
+        Args:
+            model: Код модели
+
+        Returns:
+            Имя кодировки tiktoken (DEFAULT_ENCODING для неизвестных моделей)
+        """
+        name = cls._model_encodings.get(model)
+        if name is None:
+            try:
+                name = tiktoken.encoding_name_for_model(model)
+            except KeyError:
+                name = DEFAULT_ENCODING
+            cls._model_encodings[model] = name
+        return name
+
+    @classmethod
+    def get_encoding_by_name(cls, name: str) -> tiktoken.Encoding:
+        """Возвращает кодировку по имени, загружая ее при первом обращении"""
+        encoding = cls._encodings.get(name)
+        if encoding is not None:
+            return encoding
+
+        # Загрузку выполняет один поток, остальные ждут готовую кодировку
+        with cls._lock:
+            encoding = cls._encodings.get(name)
+            if encoding is None:
+                started = time.perf_counter()
+                encoding = tiktoken.get_encoding(name)
+                cls._load_times[name] = time.perf_counter() - started
+                cls._encodings[name] = encoding
+                cls._logger.info(f"Кодировка {name} загружена за {cls._load_times[name]:.3f} с")
+        return encoding
+
+    @classmethod
+    def get_encoding(cls, model: str) -> tiktoken.Encoding:
+        """Возвращает кодировку для модели"""
+        return cls.get_encoding_by_name(cls.get_encoding_name(model))
+
+    @classmethod
+    def count_tokens(cls, text: str, model: str) -> int:
+        """
+        Подсчитывает количество токенов в тексте.
+
+        Args:
+            text: Текст
+            model: Код модели
+
+        Returns:
+            Количество токенов
+        """
+        # Служебные токены вида <|endoftext|> в тексте пользователя считаются обычным текстом
+        return len(cls.get_encoding(model).encode_ordinary(text))
+
+    @classmethod
+    def count_tokens_batch(cls, texts: Sequence[str], model: str) -> List[int]:
+        """
+        Подсчитывает токены в нескольких текстах за один вызов encode_ordinary_batch.
+
+        Args:
+            texts: Тексты
+            model: Код модели
+
+        Returns:
+            Количество токенов для каждого текста
+        """
+        if not texts:
+            return []
+        return [len(tokens) for tokens in cls.get_encoding(model).encode_ordinary_batch(list(texts))]
+
+    @classmethod
+    def count_messages_batch(cls, conversations: Sequence[Sequence[Dict[str, str]]], model: str) -> List[int]:
+        """
+        Подсчитывает токены в нескольких наборах сообщений чата.
+
+        Все сообщения токенизируются одним пакетом, затем к каждому
+        набору добавляются служебные токены формата чата.
+
+        Args:
+            conversations: Наборы сообщений [{"role": ..., "content": ...}, ...]
+            model: Код модели
+
+        Returns:
+            Количество токенов для каждого набора
+        """
+        contents = [message.get("content") or "" for messages in conversations for message in messages]
+        counts = iter(cls.count_tokens_batch(contents, model))
+        return [
+            sum(next(counts) + TOKENS_PER_MESSAGE for _ in messages) + TOKENS_PER_REPLY
+            for messages in conversations
+        ]
+
+    @classmethod
+    def warm_up(cls, models: Iterable[str]) -> None:
+        """
+        Загружает кодировки для списка моделей.
+
+        Выполняется синхронно, при запуске вызывается в отдельном потоке.
+
+        Args:
+            models: Коды моделей
+        """
+        started = time.perf_counter()
+        names = {cls.get_encoding_name(model) for model in models}
+        names.add(DEFAULT_ENCODING)
+        for name in sorted(names):
+            try:
+                cls.get_encoding_by_name(name)
+            except Exception as e:
+                # Кодировка будет загружена при первом подсчете токенов
+                cls._logger.warning(f"Не удалось загрузить кодировку {name}: {str(e)}")
+        cls._logger.info(
+            f"Токенизаторы прогреты: моделей {len(cls._model_encodings)}, кодировок {len(cls._encodings)}, "
+            f"{time.perf_counter() - started:.3f} с"
+        )
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Any]:
+        """Возвращает загруженные кодировки, время их загрузки и соответствие моделей"""
+        return {
+            "encodings": {name: {"load_seconds": round(seconds, 4)} for name, seconds in cls._load_times.items()},
+            "models": dict(cls._model_encodings),
+        }
+
+
+def store_message_tokens(message: Any, model: str) -> int:
+    """
+    Считает токены содержимого сообщения и сохраняет их в content_tokens и tokens_encoding.
+
+    Args:
+        message: Сообщение (MessageOrm или объект с полями content, content_tokens, tokens_encoding)
+        model: Код модели, по которому выбирается кодировка
+
+    Returns:
+        Количество токенов содержимого
+    """
+    encoding_name = TokenizerRegistry.get_encoding_name(model)
+    encoding = TokenizerRegistry.get_encoding_by_name(encoding_name)
+    message.content_tokens = len(encoding.encode_ordinary(message.content or ""))
+    message.tokens_encoding = encoding_name
+    return message.content_tokens
+
+
+def get_message_tokens(message: Any, model: str, estimated: bool = False) -> int:
+    """
+    Возвращает токены содержимого сообщения для модели.
+
+    Используется сохраненное значение, если оно посчитано в кодировке модели,
+    иначе сообщение токенизируется заново и значение перезаписывается
+    (при сохранении сессии оно попадет в базу данных).
+
+    Для моделей без локального токенизатора (estimated) сохраняется оценка
+    TokenEstimator с меткой коэффициентов в tokens_encoding; она пересчитывается
+    после загрузки новых коэффициентов.
+
+    Args:
+        message: Сообщение (MessageOrm или объект с полями content, content_tokens, tokens_encoding)
+        model: Код модели
+        estimated: Оценивать токены по TokenEstimator вместо tiktoken
+
+    Returns:
+        Количество токенов содержимого
+    """
+    if estimated:
+        from app.services.token_estimator import TokenEstimator
+        encoding_name = TokenEstimator.get_encoding_tag(model)
+        if message.content_tokens is not None and message.tokens_encoding == encoding_name:
+            return message.content_tokens
+        message.content_tokens = TokenEstimator.estimate(message.content or "", model)
+        message.tokens_encoding = encoding_name
+        return message.content_tokens
+    if message.content_tokens is not None and message.tokens_encoding == TokenizerRegistry.get_encoding_name(model):
+        return message.content_tokens
+    return store_message_tokens(message, model)
+
+
+def count_context_tokens(messages: List[Any], model: str) -> int:
+    """
+    Оценивает размер контекста из сохраненных сообщений в токенах.
+
+    Сумма сохраненных счетчиков плюс служебные токены формата чата,
+    без повторной токенизации содержимого.
+
+    Args:
+        messages: Сообщения треда (MessageOrm)
+        model: Код модели
+
+    Returns:
+        Количество токенов контекста
+    """
+    return sum(get_message_tokens(message, model) + TOKENS_PER_MESSAGE for message in messages) + TOKENS_PER_REPLY
+
+
+async def count_tokens_batch(texts: Sequence[str],
+                             conversations: Sequence[Sequence[Dict[str, str]]],
+                             model: str) -> Dict[str, List[int]]:
+    """
+    Подсчитывает токены текстов и наборов сообщений, не блокируя цикл событий на больших объемах.
+
+    Если суммарная длина превышает TOKEN_COUNT_OFFLOAD_CHARS, токенизация
+    выполняется в пуле потоков.
+
+    Args:
+        texts: Тексты
+        conversations: Наборы сообщений
+        model: Код модели
+
+    Returns:
+        Словарь {"texts": [...], "conversations": [...]} с количеством токенов
+    """
+    def count() -> Dict[str, List[int]]:
+        return {
+            "texts": TokenizerRegistry.count_tokens_batch(texts, model),
+            "conversations": TokenizerRegistry.count_messages_batch(conversations, model),
+        }
+
+    size = sum(len(text) for text in texts) + sum(
+        len(message.get("content") or "") for messages in conversations for message in messages
+    )
+    if size > settings.TOKEN_COUNT_OFFLOAD_CHARS:
+        return await asyncio.to_thread(count)
+    return count()
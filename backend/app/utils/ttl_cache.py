@@ -0,0 +1,122 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+
+class TTLCache:
+    """
+    LRU кэш в памяти процесса с ограничением размера и временем жизни записей.
+
+    При превышении max_size вытесняется запись, к которой дольше всего не обращались.
+    Запись с истекшим сроком считается отсутствующей и удаляется при обращении.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        """
+        Args:
+            max_size: Максимальное количество записей
+            ttl_seconds: Время жизни записи в секундах
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Возвращает значение из кэша.
+
+        Args:
+            key: Ключ записи
+
+        Returns:
+            Значение или None, если записи нет или срок ее жизни истек
+        """
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Сохраняет значение в кэш, вытесняя самые старые записи при переполнении.
+
+        Args:
+            key: Ключ записи
+            value: Значение
+        """
+        self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """
+        Удаляет запись из кэша.
+
+        Args:
+            key: Ключ записи
+
+        Returns:
+            Удаленное значение или None
+        """
+        item = self._data.pop(key, None)
+        if item is None:
+            return None
+        self.invalidations += 1
+        return item[1]
+
+    def values(self) -> List[Any]:
+        """
+        Возвращает значения записей, срок жизни которых не истек.
+
+        Порядок записей и счетчики попаданий не меняются.
+
+        Returns:
+            Список значений
+        """
+        now = time.monotonic()
+        return [value for expires_at, value in self._data.values() if expires_at > now]
+
+    def clear(self) -> None:
+        """Удаляет все записи"""
+        self._data.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Возвращает счетчики работы кэша.
+
+        Returns:
+            Словарь с размером, лимитами и счетчиками попаданий/промахов/вытеснений
+        """
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 4) if requests else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
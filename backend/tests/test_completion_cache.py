@@ -0,0 +1,86 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+from app.services.completion_cache import CompletionCache
+from app.services.near_duplicate_index import NearDuplicateRegistry
+
+CONTEXT = [{"role": "user", "content": "Как отсортировать список словарей по ключу в Python?"}]
+
+
+class FakeService:
+    provider_code = "openai"
+
+    async def stream_completion_with_context(self, **kwargs):
+        yield {"text": "sorted(items, key=...)"}
+        yield {"tokens": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}, "cost": 0.01}
+
+    async def generate_completion_with_context(self, **kwargs):
+        return {
+            "text": "sorted(items, key=...)",
+            "tokens": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+            "cost": 0.01
+        }
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """Хранилище кэша в словаре вместо памяти процесса и PostgreSQL"""
+    entries = {}
+
+    async def get(db, cache_key):
+        return entries.get(cache_key)
+
+    async def put(db, cache_key, provider_code, model, response, tokens_data, cost):
+        entries[cache_key] = {"response": response, "tokens": dict(tokens_data), "cost": cost}
+
+    async def record(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(CompletionCache, "get", get)
+    monkeypatch.setattr(CompletionCache, "put", put)
+    monkeypatch.setattr(CompletionCache, "record_hit", record)
+    monkeypatch.setattr(CompletionCache, "record_miss", record)
+    monkeypatch.setattr(NearDuplicateRegistry, "_indexes", OrderedDict())
+    monkeypatch.setattr(NearDuplicateRegistry, "lookups", 0)
+    monkeypatch.setattr(NearDuplicateRegistry, "matches", 0)
+    return entries
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+@pytest.mark.parametrize("generate", ["stream", "complete"])
+def test_sampled_response_is_not_served_by_exact_key(store, generate):
+    async def run(temperature, **kwargs):
+        params = dict(
+            db=None, user_id=1, ai_service=FakeService(), context=CONTEXT,
+            model="gpt-4o", max_tokens=100, temperature=temperature, **kwargs
+        )
+        if generate == "stream":
+            return await collect(CompletionCache.stream(**params))
+        return await CompletionCache.complete(**params)
+
+    # Недетерминированный ответ сохраняется только для поиска похожих запросов
+    asyncio.run(run(0.7, near_duplicates="reuse"))
+    exact_key = CompletionCache.make_key("gpt-4o", CONTEXT, 100)
+    near_key = CompletionCache.make_key("gpt-4o", CONTEXT, 100, near_duplicates_only=True)
+    assert exact_key not in store
+    assert near_key in store
+
+    # Детерминированный запрос не получает случайный ответ по точному ключу
+    result = asyncio.run(run(0))
+    if generate == "stream":
+        assert not any(chunk.get("from_cache") for chunk in result)
+    else:
+        assert not result.get("from_cache")
+    assert exact_key in store
+
+    # Похожий запрос с явным согласием получает сохраненный ответ
+    result = asyncio.run(run(0.7, near_duplicates="reuse"))
+    if generate == "stream":
+        assert result[-1]["from_cache"] is True
+    else:
+        assert result["from_cache"] is True
@@ -0,0 +1,210 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+from app.core.settings import settings
+from app.services.context_builder import (
+    ContextBudgetExceededException, ContextBuilder, MIN_TRUNCATED_TOKENS, OVERFLOW_REJECT, OVERFLOW_TRIM
+)
+from app.services.thread_context_cache import ThreadContext, ThreadContextCache
+from app.services.token_estimator import TokenEstimator
+from app.utils.token_counter import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+
+
+class Message:
+    def __init__(self, id, role, content, thread_id=1, meta_data=None):
+        self.id = id
+        self.thread_id = thread_id
+        self.role = role
+        self.content = content
+        self.meta_data = meta_data or {}
+        self.content_tokens = None
+        self.tokens_encoding = None
+
+
+@pytest.fixture
+def reject(monkeypatch):
+    monkeypatch.setattr(settings, "CONTEXT_OVERFLOW_POLICY", OVERFLOW_REJECT)
+
+
+@pytest.fixture
+def trim(monkeypatch):
+    monkeypatch.setattr(settings, "CONTEXT_OVERFLOW_POLICY", OVERFLOW_TRIM)
+
+
+@pytest.fixture(autouse=True)
+def default_ratios(monkeypatch):
+    monkeypatch.setattr(TokenEstimator, "_ratios", {})
+    monkeypatch.setattr(ThreadContextCache, "_entries", OrderedDict())
+
+
+def test_check_budget_accepts_request_within_budget(reject):
+    ContextBuilder.check_budget(1000, 100, 400, 1000 - 100 - TOKENS_PER_REPLY - 400)
+
+
+def test_check_budget_rejects_overflow(reject):
+    with pytest.raises(ContextBudgetExceededException) as error:
+        ContextBuilder.check_budget(1000, 100, 400, 600)
+
+    details = error.value.to_dict()
+    assert details["error_type"] == "context_length_exceeded"
+    assert details["tokens_required"] == 400 + 600 + TOKENS_PER_REPLY + 100
+    assert details["tokens_over"] == details["tokens_required"] - 1000
+    assert (details["max_context_length"], details["max_tokens"]) == (1000, 100)
+
+
+def test_check_budget_trims_last_message(trim):
+    ContextBuilder.check_budget(1000, 100, 400, 5000)
+
+
+def test_check_budget_rejects_when_trimmed_message_too_short(trim):
+    required = 1000 - 100 - TOKENS_PER_REPLY - TOKENS_PER_MESSAGE - MIN_TRUNCATED_TOKENS + 1
+    with pytest.raises(ContextBudgetExceededException):
+        ContextBuilder.check_budget(1000, 100, required, 5000)
+    # Без последнего сообщения обрезать нечего
+    with pytest.raises(ContextBudgetExceededException):
+        ContextBuilder.check_budget(1000, 100, 2000)
+
+
+def test_preflight_counts_openai_models_with_tokenizer(byte_encodings, catalog, reject):
+    # 1000 символов латиницы - 1000 токенов в побайтовой кодировке, около 250 по оценке
+    with pytest.raises(ContextBudgetExceededException):
+        asyncio.run(ContextBuilder.preflight(None, "gpt-4o", 100, "a" * 1000, provider_id=1))
+
+
+def test_preflight_estimates_claude_models(byte_encodings, catalog, reject):
+    asyncio.run(ContextBuilder.preflight(None, "claude-3-opus", 100, "a" * 1000, provider_id=2))
+    # Провайдер определяется по модели из каталога
+    asyncio.run(ContextBuilder.preflight(None, "claude-3-opus", 100, "a" * 1000))
+    with pytest.raises(ContextBudgetExceededException):
+        asyncio.run(ContextBuilder.preflight(None, "claude-3-opus", 100, "a" * 3000, provider_id=2))
+
+
+def test_preflight_accepts_special_tokens_in_text(byte_encodings, catalog, reject):
+    asyncio.run(ContextBuilder.preflight(None, "gpt-4o", 100, "<|endoftext|>", provider_id=1))
+    asyncio.run(ContextBuilder.preflight(None, "claude-3-opus", 100, "<|endoftext|>", provider_id=2))
+
+
+def test_preflight_counts_thread_system_messages_and_summary(byte_encodings, catalog, reject):
+    class Summary:
+        content = "s" * 100
+        last_message_id = 1
+
+    ThreadContextCache.put(ThreadContext(7, [Message(1, "system", "x" * 200, thread_id=7)], Summary()))
+
+    asyncio.run(ContextBuilder.preflight(None, "gpt-4o", 100, "a" * 150, provider_id=1))
+    with pytest.raises(ContextBudgetExceededException):
+        asyncio.run(ContextBuilder.preflight(None, "gpt-4o", 100, "a" * 150, provider_id=1, thread_id=7))
+    # Системный промпт запроса заменяет системные сообщения треда
+    asyncio.run(ContextBuilder.preflight(
+        None, "gpt-4o", 100, "a" * 150, provider_id=1, system_prompt="p", thread_id=7
+    ))
+
+
+def test_pack_rejects_overflowing_system_prompt(byte_encodings, reject):
+    messages = [Message(1, "user", "hello")]
+    with pytest.raises(ContextBudgetExceededException):
+        ContextBuilder.pack(messages, "gpt-4o", 600, 100, system_prompt="p" * 600)
+
+
+def test_pack_rejects_overflowing_last_message(byte_encodings, reject):
+    messages = [Message(1, "user", "a" * 1000)]
+    with pytest.raises(ContextBudgetExceededException):
+        ContextBuilder.pack(messages, "gpt-4o", 600, 100)
+    # Оценка для Claude помещается в тот же бюджет
+    context, _ = ContextBuilder.pack(messages, "claude-3-opus", 600, 100, estimated=True)
+    assert context == [{"role": "user", "content": "a" * 1000}]
+
+
+def test_pack_trims_overflowing_last_message(byte_encodings, trim):
+    messages = [Message(1, "user", "a" * 500 + "b" * 500)]
+    context, packing = ContextBuilder.pack(messages, "gpt-4o", 600, 100)
+
+    budget = 600 - 100 - TOKENS_PER_REPLY
+    assert context == [{"role": "user", "content": "b" * (budget - TOKENS_PER_MESSAGE)}]
+    assert packing["truncated_message_id"] == 1
+    assert packing["tokens_used"] == budget + TOKENS_PER_REPLY
+
+
+def test_pack_keeps_system_messages_and_newest_dialog(byte_encodings, reject):
+    messages = [
+        Message(1, "system", "s" * 50),
+        Message(2, "user", "a" * 200),
+        Message(3, "assistant", "b" * 200),
+        Message(4, "user", "c" * 100),
+    ]
+    context, packing = ContextBuilder.pack(messages, "gpt-4o", 600, 100)
+
+    # Бюджет 497: system 53 + c 103 + b 203 = 359, для a остается 135 токенов со служебными
+    assert context == [
+        {"role": "system", "content": "s" * 50},
+        {"role": "user", "content": "a" * (497 - 359 - TOKENS_PER_MESSAGE)},
+        {"role": "assistant", "content": "b" * 200},
+        {"role": "user", "content": "c" * 100},
+    ]
+    assert packing == {
+        "messages_total": 3,
+        "messages_included": 3,
+        "messages_dropped": 0,
+        "truncated_message_id": 2,
+        "tokens_used": 497 + TOKENS_PER_REPLY,
+        "token_budget": 497 + TOKENS_PER_REPLY,
+        "summary_until_message_id": None,
+    }
+
+
+def test_pack_drops_old_messages_when_remainder_is_small(byte_encodings, reject):
+    messages = [
+        Message(1, "user", "a" * 100),
+        Message(2, "assistant", "b" * 200),
+        # После c и b для a остается MIN_TRUNCATED_TOKENS - 1 токенов
+        Message(3, "user", "c" * (497 - 203 - 2 * TOKENS_PER_MESSAGE - MIN_TRUNCATED_TOKENS + 1)),
+    ]
+    context, packing = ContextBuilder.pack(messages, "gpt-4o", 600, 100)
+
+    assert [message["content"][0] for message in context] == ["b", "c"]
+    assert packing["messages_dropped"] == 1
+    assert packing["truncated_message_id"] is None
+
+
+def test_pack_skips_error_messages_and_uses_system_prompt(byte_encodings, reject):
+    messages = [
+        Message(1, "system", "thread system"),
+        Message(2, "user", "question"),
+        Message(3, "assistant", "failed", meta_data={"error": True}),
+        Message(4, "user", "again"),
+    ]
+    context, packing = ContextBuilder.pack(messages, "gpt-4o", 600, 100, system_prompt="override")
+
+    assert context == [
+        {"role": "system", "content": "override"},
+        {"role": "user", "content": "question"},
+        {"role": "user", "content": "again"},
+    ]
+    assert packing["messages_total"] == 2
+
+
+def test_pack_replaces_folded_messages_with_summary(byte_encodings, reject):
+    class Summary:
+        content = "folded"
+        last_message_id = 2
+
+    messages = [Message(1, "user", "old"), Message(2, "assistant", "older answer"), Message(3, "user", "new")]
+    context, packing = ContextBuilder.pack(messages, "gpt-4o", 600, 100, summary=Summary())
+
+    assert context[0]["role"] == "system" and context[0]["content"].endswith("folded")
+    assert context[1:] == [{"role": "user", "content": "new"}]
+    assert packing["summary_until_message_id"] == 2
+
+
+def test_pack_reuses_stored_token_counts(byte_encodings, reject):
+    message = Message(1, "user", "short")
+    message.content_tokens, message.tokens_encoding = 10000, "o200k_base"
+
+    # Сохраненный счетчик в кодировке модели не пересчитывается
+    with pytest.raises(ContextBudgetExceededException):
+        ContextBuilder.pack([message], "gpt-4o", 600, 100)
+    # Для другой кодировки счетчик пересчитывается
+    context, _ = ContextBuilder.pack([message], "gpt-4", 600, 100)
+    assert context == [{"role": "user", "content": "short"}]
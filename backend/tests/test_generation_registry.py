@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+import pytest
+
+from app.core.settings import settings
+from app.services.generation_registry import GenerationRegistry
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(GenerationRegistry, "_generations", {})
+    monkeypatch.setattr(GenerationRegistry, "_buffer_bytes", 0)
+    # Без склейки каждый кусок - отдельное событие
+    monkeypatch.setattr(settings, "SSE_FLUSH_INTERVAL_MS", 0)
+
+
+async def source(chunks, pause=None):
+    for chunk in chunks:
+        if pause is not None:
+            await pause.wait()
+        yield chunk
+
+
+def parse(event):
+    lines = event.strip().split("\n")
+    return lines[0][len("id: "):], json.loads(lines[1][len("data: "):])
+
+
+async def collect(events):
+    return [parse(event) async for event in events]
+
+
+def test_subscriber_receives_all_events_with_ids():
+    async def run():
+        generation = GenerationRegistry.create(1)
+        events = generation.subscribe()
+        generation.start(source([{"text": "a"}, {"text": "b"}, {"done": True, "message_id": 7}]))
+        return generation, await collect(events)
+
+    generation, events = asyncio.run(run())
+    assert [event_id for event_id, _ in events] == [f"{generation.id}:{seq}" for seq in (1, 2, 3)]
+    assert [data for _, data in events] == [{"text": "a"}, {"text": "b"}, {"done": True, "message_id": 7}]
+    assert generation.partial_text == "ab"
+    assert generation.message_id == 7
+
+
+def test_resume_replays_events_after_last_event_id():
+    async def run():
+        generation = GenerationRegistry.create(1)
+        generation.start(source([{"text": "a"}, {"text": "b"}, {"done": True}]))
+        await generation.task
+
+        found, after_seq = GenerationRegistry.find_for_resume(1, f"{generation.id}:1")
+        assert found is generation
+        return await collect(found.subscribe(after_seq))
+
+    assert [data for _, data in asyncio.run(run())] == [{"text": "b"}, {"done": True}]
+
+
+def test_resume_joins_live_stream_without_gap():
+    async def run():
+        pause = asyncio.Event()
+        generation = GenerationRegistry.create(1)
+        generation.publish({"text": "a"})
+        generation.start(source([{"text": "b"}, {"done": True}], pause))
+
+        found, after_seq = GenerationRegistry.find_for_resume(1, "unknown:5")
+        events = found.subscribe(after_seq)
+        pause.set()
+        return await collect(events)
+
+    assert [data for _, data in asyncio.run(run())] == [{"text": "a"}, {"text": "b"}, {"done": True}]
+
+
+def test_ring_buffer_keeps_last_events(monkeypatch):
+    monkeypatch.setattr(settings, "SSE_REPLAY_BUFFER_SIZE", 3)
+
+    async def run():
+        generation = GenerationRegistry.create(1)
+        generation.start(source([{"text": str(i)} for i in range(10)]))
+        await generation.task
+        return generation, await collect(generation.subscribe())
+
+    generation, events = asyncio.run(run())
+    assert [data for _, data in events] == [{"text": "7"}, {"text": "8"}, {"text": "9"}]
+    assert generation.buffer_bytes == GenerationRegistry._buffer_bytes
+    assert generation.buffer_bytes == sum(len(event) for _, event in generation._frames)
+
+
+def test_memory_limit_evicts_finished_generations_first(monkeypatch):
+    async def run():
+        old = GenerationRegistry.create(1)
+        old.start(source([{"text": "x" * 100}, {"done": True}]))
+        await old.task
+
+        monkeypatch.setattr(settings, "SSE_REPLAY_MAX_BYTES", GenerationRegistry._buffer_bytes + 150)
+        current = GenerationRegistry.create(2)
+        current.publish({"text": "y" * 100})
+        return old, current
+
+    old, current = asyncio.run(run())
+    assert old.id not in GenerationRegistry._generations.get(1, {})
+    assert old.buffer_bytes == 0
+    assert GenerationRegistry._buffer_bytes == current.buffer_bytes
+
+
+def test_memory_limit_keeps_last_event_of_current_generation(monkeypatch):
+    monkeypatch.setattr(settings, "SSE_REPLAY_MAX_BYTES", 10)
+
+    async def run():
+        generation = GenerationRegistry.create(1)
+        generation.publish({"text": "a"})
+        generation.publish({"text": "b"})
+        return generation
+
+    generation = asyncio.run(run())
+    assert [seq for seq, _ in generation._frames] == [2]
+
+
+def test_cancel_publishes_stopped_event():
+    async def run():
+        pause = asyncio.Event()
+        generation = GenerationRegistry.create(1, user_message_id=3)
+        events = generation.subscribe()
+        generation.start(source([{"text": "a"}], pause))
+        await asyncio.sleep(0)
+
+        assert GenerationRegistry.cancel(1, message_id=3) == 1
+        return generation, await collect(events)
+
+    generation, events = asyncio.run(run())
+    assert generation.stopped and generation.finished
+    assert events[-1][1] == {"stopped": True, "done": True, "message_id": None}
+    assert GenerationRegistry.get_active(1) == []
@@ -0,0 +1,120 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from app.core.settings import settings
+from app.services.key_pool import KeyPool, KeyPoolRegistry
+from app.utils.ttl_cache import TTLCache
+
+
+def make_pool(count=3):
+    pool = KeyPool(user_id=1, provider_id=1)
+    pool.update_keys([(i, f"sk-{i}") for i in range(1, count + 1)])
+    return pool
+
+
+def test_choose_empty_pool():
+    assert KeyPool(1, 1).choose() is None
+
+
+def test_choose_rotates_idle_keys():
+    pool = make_pool()
+    chosen = []
+    for _ in range(6):
+        key = pool.choose()
+        key.request_started()
+        key.request_finished()
+        chosen.append(key.api_key_id)
+    assert chosen == [1, 2, 3, 1, 2, 3]
+
+
+def test_choose_prefers_fewest_in_flight():
+    pool = make_pool()
+    pool.keys[1].request_started()
+    pool.keys[1].request_finished()
+    pool.keys[2].request_started()
+    pool.keys[2].request_started()
+    pool.keys[3].request_started()
+    # У ключа 1 больше запросов всего, но ни одного в работе
+    assert pool.choose().api_key_id == 1
+
+
+def test_choose_skips_cooling_down_keys():
+    pool = make_pool()
+    pool.keys[1].request_started()
+    pool.keys[1].request_finished(error=Exception("429"), rate_limited=True, retry_after=60)
+
+    assert pool.keys[1].is_cooling_down
+    assert pool.keys[1].rate_limited_total == 1
+    assert {pool.choose().api_key_id for _ in range(3)} == {2}
+
+
+def test_choose_returns_earliest_available_when_all_cool_down():
+    pool = make_pool(2)
+    pool.keys[1].request_finished(error=Exception("429"), rate_limited=True, retry_after=60)
+    pool.keys[2].request_finished(error=Exception("429"), rate_limited=True, retry_after=10)
+    assert pool.choose().api_key_id == 2
+
+
+def test_cooldown_defaults_and_expires(monkeypatch):
+    monkeypatch.setattr(settings, "API_KEY_COOLDOWN_SECONDS", 30)
+    key = make_pool().keys[1]
+    key.request_finished(error=Exception("429"), rate_limited=True)
+    assert 29 < key.cooldown_until - time.monotonic() <= 30
+
+    key.request_finished(error=Exception("429"), rate_limited=True, retry_after=0)
+    assert not key.is_cooling_down
+
+
+def test_errors_without_rate_limit_do_not_cool_down():
+    key = make_pool().keys[1]
+    key.request_started()
+    key.request_finished(error=Exception("500"))
+    assert key.errors_total == 1 and key.in_flight == 0
+    assert not key.is_cooling_down
+    assert key.get_stats()["last_error"] == "500"
+
+
+def test_update_keys_keeps_counters_of_known_keys():
+    pool = make_pool(2)
+    pool.keys[1].request_started()
+    pool.keys[2].request_started()
+
+    pool.update_keys([(1, "sk-1"), (2, "sk-rotated"), (3, "sk-3")])
+
+    assert pool.keys[1].in_flight == 1
+    assert pool.keys[2].in_flight == 0
+    assert set(pool.keys) == {1, 2, 3}
+
+
+class KeysDb:
+    """Сессия, возвращающая один и тот же список ключей на любой запрос"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    async def execute(self, statement):
+        self.queries += 1
+        return SimpleNamespace(all=lambda: self.rows)
+
+
+def test_registry_is_bounded_and_drops_invalidated_pools(monkeypatch):
+    monkeypatch.setattr(KeyPoolRegistry, "_pools", TTLCache(max_size=2, ttl_seconds=60))
+    db = KeysDb([(1, "sk-1")])
+
+    async def run():
+        first = await KeyPoolRegistry.get_pool(db, 1, 1)
+        assert await KeyPoolRegistry.get_pool(db, 1, 1) is first
+        await KeyPoolRegistry.get_pool(db, 2, 1)
+        await KeyPoolRegistry.get_pool(db, 3, 1)
+        return first
+
+    first = asyncio.run(run())
+    # Пул, к которому дольше всех не обращались, вытеснен вместе с ключами
+    assert db.queries == 3
+    assert [pool["user_id"] for pool in KeyPoolRegistry.get_stats()] == [2, 3]
+
+    KeyPoolRegistry.invalidate(2, 1)
+    assert [pool["user_id"] for pool in KeyPoolRegistry.get_stats()] == [3]
+    assert asyncio.run(KeyPoolRegistry.get_pool(db, 1, 1)) is not first
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+from sqlalchemy import insert
+
+from app.db.models import AIModelOrm, ProviderOrm
+from app.services.model_catalog import ModelCatalog
+
+
+@pytest.fixture(autouse=True)
+def empty_catalog(monkeypatch):
+    monkeypatch.setattr(ModelCatalog, "_providers", {})
+    monkeypatch.setattr(ModelCatalog, "_providers_by_code", {})
+    monkeypatch.setattr(ModelCatalog, "_models", {})
+    monkeypatch.setattr(ModelCatalog, "_models_by_code", {})
+    monkeypatch.setattr(ModelCatalog, "_version", 1)
+    monkeypatch.setattr(ModelCatalog, "_loaded_version", 0)
+
+
+@pytest.fixture
+def rows(session):
+    # Строки добавляются без событий ORM: каталог читает таблицы напрямую
+    session.execute(insert(ProviderOrm), [
+        {"id": 1, "code": "openai", "name": "OpenAI", "service_class": "OpenAIService", "is_active": True},
+        {"id": 2, "code": "anthropic", "name": "Anthropic", "service_class": "AnthropicService", "is_active": True},
+    ])
+    session.execute(insert(AIModelOrm), [
+        {"id": 1, "provider_id": 1, "code": "gpt-4o", "name": "GPT-4o", "max_context_length": 128000,
+         "is_active": True},
+        {"id": 2, "provider_id": 1, "code": "gpt-3.5-turbo", "name": "GPT-3.5", "is_active": False},
+        {"id": 3, "provider_id": 2, "code": "claude-3-opus", "name": "Claude 3 Opus", "is_active": True},
+    ])
+    session.commit()
+
+
+class CountingSession:
+    def __init__(self, db):
+        self.db = db
+        self.queries = 0
+
+    async def execute(self, statement):
+        self.queries += 1
+        return await self.db.execute(statement)
+
+
+def test_lookups_are_served_from_memory(rows, async_session):
+    db = CountingSession(async_session())
+
+    async def run():
+        provider = await ModelCatalog.get_provider_by_code(db, "anthropic")
+        model = await ModelCatalog.find_model(db, "gpt-4o")
+        by_provider = await ModelCatalog.find_model(db, "gpt-4o", provider_id=2)
+        by_id = await ModelCatalog.find_model(db, 3, provider_id=2)
+        active = await ModelCatalog.get_active_models(db, 1)
+        return provider, model, by_provider, by_id, active
+
+    provider, model, by_provider, by_id, active = asyncio.run(run())
+    assert (provider.id, provider.service_class) == (2, "AnthropicService")
+    assert (model.id, model.max_context_length) == (1, 128000)
+    assert by_provider is None
+    assert by_id.code == "claude-3-opus"
+    assert [model.code for model in active] == ["gpt-4o"]
+    # Провайдеры и модели загружены один раз
+    assert db.queries == 2
+
+
+def test_committed_changes_reload_catalog(session, rows, async_session):
+    db = CountingSession(async_session())
+    assert asyncio.run(ModelCatalog.get_model(db, 2)) is not None
+
+    session.delete(session.get(AIModelOrm, 2))
+    session.flush()
+    assert asyncio.run(ModelCatalog.get_model(db, 2)) is not None
+
+    session.commit()
+    assert asyncio.run(ModelCatalog.get_model(db, 2)) is None
+    assert db.queries == 4
+
+
+def test_rolled_back_changes_keep_catalog(session, rows, async_session):
+    db = CountingSession(async_session())
+    asyncio.run(ModelCatalog.get_providers(db))
+
+    session.delete(session.get(AIModelOrm, 3))
+    session.flush()
+    session.rollback()
+
+    assert asyncio.run(ModelCatalog.get_model(db, 3)).code == "claude-3-opus"
+    assert db.queries == 2
+
+
+def test_change_notification_from_other_worker_reloads_catalog(rows, async_session):
+    db = CountingSession(async_session())
+    asyncio.run(ModelCatalog.get_providers(db))
+    asyncio.run(ModelCatalog.handle_change_notification({"changed": True}))
+    asyncio.run(ModelCatalog.get_providers(db))
+    assert db.queries == 4
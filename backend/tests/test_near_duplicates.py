@@ -0,0 +1,90 @@
+from collections import OrderedDict
+
+import pytest
+
+from app.core.settings import settings
+from app.services.near_duplicate_index import NearDuplicateIndex, NearDuplicateRegistry
+from app.utils.minhash import MinHasher, shingles
+
+PROMPT = "Напиши функцию на Python, которая считает количество гласных в строке и возвращает словарь"
+
+
+def jaccard(first, second):
+    return len(first & second) / len(first | second)
+
+
+def test_shingles_normalize_case_and_whitespace():
+    assert shingles("Hello   World") == shingles("hello world")
+    assert len(shingles("abcdefg", size=5)) == 3
+    # Короткий текст дополняется до одной n-граммы
+    assert len(shingles("ab", size=5)) == 1
+
+
+def test_signature_is_deterministic_for_seed():
+    assert MinHasher(seed=3).signature(PROMPT) == MinHasher(seed=3).signature(PROMPT)
+    assert MinHasher(seed=3).signature(PROMPT) != MinHasher(seed=4).signature(PROMPT)
+    assert len(MinHasher(num_perm=16).signature(PROMPT)) == 16
+
+
+def test_similarity_estimates_jaccard():
+    hasher = MinHasher(num_perm=256)
+    edited = PROMPT.replace("гласных", "согласных")
+    other = "Расскажи, как приготовить борщ и сколько его варить"
+
+    assert MinHasher.similarity(hasher.signature(PROMPT), hasher.signature(PROMPT)) == 1.0
+    estimate = MinHasher.similarity(hasher.signature(PROMPT), hasher.signature(edited))
+    assert estimate == pytest.approx(jaccard(shingles(PROMPT), shingles(edited)), abs=0.1)
+    assert MinHasher.similarity(hasher.signature(PROMPT), hasher.signature(other)) < 0.1
+
+
+def test_similarity_of_incomparable_signatures():
+    assert MinHasher.similarity((), ()) == 0.0
+    assert MinHasher.similarity((1, 2), (1,)) == 0.0
+
+
+def test_index_finds_best_match_above_threshold():
+    hasher = MinHasher(num_perm=64)
+    index = NearDuplicateIndex(rows=4, max_entries=10)
+    index.add("same", hasher.signature(PROMPT))
+    index.add("other", hasher.signature("Переведи на английский: добрый вечер, как дела"))
+
+    assert index.find(hasher.signature(PROMPT + "!"), threshold=0.8)[0] == "same"
+    assert index.find(hasher.signature("Что такое монада в Haskell?"), threshold=0.8) is None
+
+
+def test_index_remove_and_eviction():
+    hasher = MinHasher(num_perm=64)
+    index = NearDuplicateIndex(rows=4, max_entries=2)
+    signatures = {key: hasher.signature(f"{key} {PROMPT}") for key in ("a", "b", "c")}
+
+    index.add("a", signatures["a"])
+    index.add("b", signatures["b"])
+    index.add("a", signatures["a"])
+    index.add("c", signatures["c"])
+    # Вытеснен самый давний по обращению ключ
+    assert len(index) == 2
+    assert index.find(signatures["b"], threshold=1.0) is None
+
+    index.remove("a")
+    index.remove("a")
+    assert len(index) == 1
+    assert all("a" not in bucket for bucket in index._buckets.values())
+
+
+def test_registry_scopes_indexes_by_user_and_model(monkeypatch):
+    monkeypatch.setattr(NearDuplicateRegistry, "_indexes", OrderedDict())
+    monkeypatch.setattr(NearDuplicateRegistry, "lookups", 0)
+    monkeypatch.setattr(NearDuplicateRegistry, "matches", 0)
+    monkeypatch.setattr(settings, "NEAR_DUPLICATE_SIMILARITY", 0.8)
+    context = [{"role": "user", "content": PROMPT}]
+    signature = NearDuplicateRegistry.signature(context)
+
+    NearDuplicateRegistry.add(1, "gpt-4o", signature, "key")
+
+    assert NearDuplicateRegistry.find(1, "gpt-4o", signature) == ("key", 1.0)
+    assert NearDuplicateRegistry.find(2, "gpt-4o", signature) is None
+    assert NearDuplicateRegistry.find(1, "gpt-4o-mini", signature) is None
+
+    NearDuplicateRegistry.discard(1, "gpt-4o", "key")
+    assert NearDuplicateRegistry.find(1, "gpt-4o", signature) is None
+    assert (NearDuplicateRegistry.lookups, NearDuplicateRegistry.matches) == (4, 1)
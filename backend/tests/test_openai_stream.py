@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.openai_service import OpenAIService
+from app.services.request_executor import RequestExecutor
+from app.utils.token_counter import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+
+CONTEXT = [{"role": "user", "content": "hello"}]
+
+
+def text_chunk(text):
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+def usage_chunk(prompt_tokens, completion_tokens):
+    usage = SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+    return SimpleNamespace(usage=usage, choices=[])
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeCompletions:
+    def __init__(self, stream):
+        self.stream = stream
+        self.requests = []
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return self.stream
+
+
+@pytest.fixture(autouse=True)
+def breakers(monkeypatch):
+    monkeypatch.setattr(RequestExecutor, "_breakers", {})
+
+
+def run_stream(chunks):
+    service = OpenAIService("sk-test-stream")
+    completions = FakeCompletions(FakeStream(chunks))
+    service.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    async def collect():
+        return [chunk async for chunk in service.stream_completion_with_context(CONTEXT, "gpt-4o", 10, 0)]
+
+    return asyncio.run(collect()), completions
+
+
+def test_stream_uses_usage_from_last_chunk(byte_encodings):
+    chunks, completions = run_stream([text_chunk("Hel"), text_chunk("lo"), usage_chunk(11, 7)])
+
+    assert chunks == [
+        {"text": "Hel"},
+        {"text": "lo"},
+        {"tokens": {"prompt_tokens": 11, "completion_tokens": 7, "total_tokens": 18}, "from_cache": False},
+    ]
+    assert completions.requests[0]["stream_options"] == {"include_usage": True}
+    assert completions.stream.closed
+
+
+def test_stream_counts_tokens_locally_without_usage(byte_encodings):
+    chunks, _ = run_stream([text_chunk("Hel"), text_chunk("lo")])
+
+    # Побайтовая кодировка: "user" + "hello" и "Hello"
+    prompt_tokens = TOKENS_PER_MESSAGE + len("user") + len("hello") + TOKENS_PER_REPLY
+    assert chunks[-1] == {
+        "tokens": {"prompt_tokens": prompt_tokens, "completion_tokens": 5, "total_tokens": prompt_tokens + 5},
+        "from_cache": False,
+    }
@@ -0,0 +1,112 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.core.settings import settings
+from app.services.rate_limiter import (
+    KeyRateLimiter, RateLimiterRegistry, TokenBucket, parse_reset, OPENAI_REQUEST_HEADERS, OPENAI_TOKEN_HEADERS
+)
+from app.utils.ttl_cache import TTLCache
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1s", 1.0),
+    ("6m0s", 360.0),
+    ("20ms", 0.02),
+    ("1h2m3.5s", 3723.5),
+])
+def test_parse_reset_durations(value, expected):
+    assert parse_reset(value) == pytest.approx(expected)
+
+
+def test_parse_reset_timestamp():
+    reset_at = (datetime.now(timezone.utc) + timedelta(seconds=30)).isoformat().replace("+00:00", "Z")
+    assert parse_reset(reset_at) == pytest.approx(30, abs=1)
+
+
+@pytest.mark.parametrize("value", [None, "", "soon", "1x"])
+def test_parse_reset_invalid(value):
+    assert parse_reset(value) is None
+
+
+def test_token_bucket_wait_and_consume():
+    bucket = TokenBucket(capacity=10, remaining=2, refill_rate=1)
+    assert bucket.wait_time(1) == 0
+    bucket.consume(2)
+    assert bucket.wait_time(3) == pytest.approx(3, abs=0.05)
+    # Запрос больше емкости ждет только полного ведра
+    assert bucket.wait_time(100) == pytest.approx(10, abs=0.05)
+
+
+def test_token_bucket_sync_estimates_refill_rate():
+    bucket = TokenBucket(capacity=60, remaining=60, refill_rate=1)
+    bucket.sync(capacity=100, remaining=40, reset_seconds=30)
+    assert bucket.capacity == 100
+    assert bucket.refill_rate == pytest.approx(2)
+
+
+def test_token_bucket_without_refill_waits_forever():
+    bucket = TokenBucket(capacity=10, remaining=0, refill_rate=0)
+    assert bucket.wait_time(1) == float("inf")
+
+
+def test_limiter_update_from_headers():
+    limiter = KeyRateLimiter()
+    limiter.update(
+        {
+            "x-ratelimit-limit-requests": "100",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-reset-requests": "10s",
+            "x-ratelimit-limit-tokens": "1000",
+            "x-ratelimit-remaining-tokens": "1000",
+        },
+        OPENAI_REQUEST_HEADERS,
+        OPENAI_TOKEN_HEADERS,
+    )
+    assert limiter.requests.capacity == 100
+    assert limiter.requests.refill_rate == pytest.approx(10)
+    assert limiter.expected_wait() == pytest.approx(0.1, abs=0.02)
+    assert limiter.expected_wait(500) == pytest.approx(0.1, abs=0.02)
+
+
+def test_acquire_without_limits_does_not_wait():
+    limiter = KeyRateLimiter()
+    assert asyncio.run(limiter.acquire(1000)) < 0.05
+    assert limiter.waited_total == 0
+
+
+def test_acquire_reserves_capacity():
+    limiter = KeyRateLimiter()
+    limiter.requests = TokenBucket(capacity=2, remaining=2, refill_rate=0.001)
+    asyncio.run(limiter.acquire())
+    asyncio.run(limiter.acquire())
+    assert limiter.expected_wait() > 0
+
+
+def test_acquire_wait_is_bounded(monkeypatch):
+    monkeypatch.setattr(settings, "RATE_LIMIT_MAX_WAIT_SECONDS", 0.05)
+    limiter = KeyRateLimiter()
+    limiter.requests = TokenBucket(capacity=1, remaining=0, refill_rate=0)
+
+    started = time.monotonic()
+    waited = asyncio.run(limiter.acquire())
+    assert 0.04 <= waited < 0.5
+    assert time.monotonic() - started < 0.5
+    assert limiter.waited_total == 1
+    assert limiter.waiting == 0
+
+
+def test_registry_keeps_limiters_of_used_keys_and_evicts_idle(monkeypatch):
+    monkeypatch.setattr(RateLimiterRegistry, "_limiters", TTLCache(max_size=2, ttl_seconds=60))
+
+    first = RateLimiterRegistry.get("sk-1")
+    RateLimiterRegistry.get("sk-2")
+    assert RateLimiterRegistry.get("sk-1") is first
+
+    # Вытесняется ключ, по которому дольше всех не было запросов
+    RateLimiterRegistry.get("sk-3")
+    assert len(RateLimiterRegistry._limiters) == 2
+    assert RateLimiterRegistry.get("sk-1") is first
+    assert RateLimiterRegistry._limiters.get(RateLimiterRegistry._key_hash("sk-2")) is None
@@ -0,0 +1,187 @@
+import asyncio
+import time
+
+import pytest
+
+from app.core.settings import settings
+from app.services.request_executor import (
+    CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, CircuitBreaker, CircuitOpenException, RequestExecutor
+)
+
+
+class ProviderError(Exception):
+    pass
+
+
+class ClientError(Exception):
+    pass
+
+
+def is_retryable(error):
+    return isinstance(error, ProviderError)
+
+
+def is_provider_failure(error):
+    return isinstance(error, ProviderError)
+
+
+@pytest.fixture(autouse=True)
+def breaker_settings(monkeypatch):
+    monkeypatch.setattr(RequestExecutor, "_breakers", {})
+    monkeypatch.setattr(settings, "CIRCUIT_MIN_REQUESTS", 4)
+    monkeypatch.setattr(settings, "CIRCUIT_ERROR_RATE", 0.5)
+    monkeypatch.setattr(settings, "CIRCUIT_OPEN_SECONDS", 30)
+    monkeypatch.setattr(settings, "PROVIDER_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(settings, "PROVIDER_RETRY_BASE_DELAY", 0.001)
+    monkeypatch.setattr(settings, "PROVIDER_RETRY_MAX_DELAY", 8.0)
+
+
+def open_breaker(breaker):
+    for _ in range(settings.CIRCUIT_MIN_REQUESTS):
+        breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN
+
+
+def test_breaker_opens_at_error_rate():
+    breaker = CircuitBreaker("openai")
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN
+    assert not breaker.allow_request()
+    assert breaker.rejected_total == 1
+
+
+def test_breaker_needs_minimum_requests():
+    breaker = CircuitBreaker("openai")
+    for _ in range(settings.CIRCUIT_MIN_REQUESTS - 1):
+        breaker.record_failure()
+    assert breaker.state == CIRCUIT_CLOSED
+    assert breaker.allow_request()
+
+
+def test_breaker_allows_single_trial_after_pause(monkeypatch):
+    breaker = CircuitBreaker("openai")
+    open_breaker(breaker)
+    monkeypatch.setattr(settings, "CIRCUIT_OPEN_SECONDS", 0)
+
+    assert breaker.allow_request()
+    assert breaker.state == CIRCUIT_HALF_OPEN
+    assert not breaker.allow_request()
+
+    breaker.record_success()
+    assert breaker.state == CIRCUIT_CLOSED
+    assert breaker.get_stats()["window_requests"] == 0
+
+
+def test_breaker_reopens_after_failed_trial(monkeypatch):
+    breaker = CircuitBreaker("openai")
+    open_breaker(breaker)
+    monkeypatch.setattr(settings, "CIRCUIT_OPEN_SECONDS", 0)
+
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN
+    assert breaker.opened_total == 2
+
+
+def test_breaker_release_trial_allows_next_trial(monkeypatch):
+    breaker = CircuitBreaker("openai")
+    open_breaker(breaker)
+    monkeypatch.setattr(settings, "CIRCUIT_OPEN_SECONDS", 0)
+
+    assert breaker.allow_request()
+    breaker.release_trial()
+    assert breaker.allow_request()
+
+
+def test_breaker_forgets_results_outside_window(monkeypatch):
+    breaker = CircuitBreaker("openai")
+    for _ in range(3):
+        breaker.record_failure()
+    monkeypatch.setattr(settings, "CIRCUIT_WINDOW_SECONDS", 0)
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_CLOSED
+
+
+def test_execute_retries_provider_errors():
+    calls = []
+
+    async def call(timeout):
+        calls.append(timeout)
+        if len(calls) < 3:
+            raise ProviderError()
+        return "ok"
+
+    result = asyncio.run(RequestExecutor.execute("openai", call, is_retryable, is_provider_failure))
+    assert result == "ok"
+    assert calls == [None, None, None]
+    assert RequestExecutor.get_breaker("openai").successes_total == 1
+
+
+def test_execute_does_not_retry_client_errors():
+    calls = []
+
+    async def call(timeout):
+        calls.append(timeout)
+        raise ClientError()
+
+    with pytest.raises(ClientError):
+        asyncio.run(RequestExecutor.execute("openai", call, is_retryable, is_provider_failure))
+    assert len(calls) == 1
+    assert RequestExecutor.get_breaker("openai").failures_total == 0
+
+
+def test_execute_stops_at_max_attempts():
+    calls = []
+
+    async def call(timeout):
+        calls.append(timeout)
+        raise ProviderError()
+
+    with pytest.raises(ProviderError):
+        asyncio.run(RequestExecutor.execute("openai", call, is_retryable, is_provider_failure))
+    assert len(calls) == settings.PROVIDER_MAX_ATTEMPTS
+
+
+def test_execute_passes_remaining_time_and_respects_deadline(monkeypatch):
+    # Пауза перед повтором 10..20 с
+    monkeypatch.setattr(settings, "PROVIDER_RETRY_BASE_DELAY", 20.0)
+    monkeypatch.setattr(settings, "PROVIDER_RETRY_MAX_DELAY", 20.0)
+    calls = []
+
+    async def call(timeout):
+        calls.append(timeout)
+        raise ProviderError()
+
+    with pytest.raises(ProviderError):
+        asyncio.run(RequestExecutor.execute(
+            "openai", call, is_retryable, is_provider_failure, deadline=time.monotonic() + 5
+        ))
+    # Пауза перед повтором не помещается в оставшееся время
+    assert len(calls) == 1
+    assert 4 < calls[0] <= 5
+
+
+def test_execute_rejects_when_circuit_open():
+    open_breaker(RequestExecutor.get_breaker("openai"))
+
+    async def call(timeout):
+        raise AssertionError("запрос не должен выполняться")
+
+    with pytest.raises(CircuitOpenException) as error:
+        asyncio.run(RequestExecutor.execute("openai", call, is_retryable, is_provider_failure))
+    assert error.value.retry_after > 0
+
+
+def test_retry_delay_uses_retry_after_header():
+    class Response:
+        headers = {"retry-after": "2.5"}
+
+    error = ProviderError()
+    error.response = Response()
+    assert RequestExecutor.get_retry_delay(error, 1) == 2.5
+    assert 0 < RequestExecutor.get_retry_delay(ProviderError(), 1) <= settings.PROVIDER_RETRY_BASE_DELAY
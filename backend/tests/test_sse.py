@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+from app.utils.sse import TextChunkCoalescer, format_sse_event
+
+
+def test_format_sse_event():
+    assert format_sse_event({"text": "a"}) == 'data: {"text": "a"}\n\n'
+    assert format_sse_event({"done": True}, event_id="g:3") == 'id: g:3\ndata: {"done": true}\n\n'
+    assert json.loads(format_sse_event({"text": "ж"})[len("data: "):]) == {"text": "ж"}
+
+
+def test_coalescer_sends_first_chunk_immediately_and_joins_the_rest():
+    async def run():
+        emitted = []
+        coalescer = TextChunkCoalescer(emitted.append, interval_ms=20, max_bytes=1000)
+        coalescer.push({"text": "a"})
+        coalescer.push({"text": "b"})
+        coalescer.push({"text": "c"})
+        before_timer = list(emitted)
+        await asyncio.sleep(0.05)
+        return before_timer, emitted
+
+    before_timer, emitted = asyncio.run(run())
+    assert before_timer == [{"text": "a"}]
+    assert emitted == [{"text": "a"}, {"text": "bc"}]
+
+
+def test_coalescer_flushes_at_max_bytes():
+    async def run():
+        emitted = []
+        coalescer = TextChunkCoalescer(emitted.append, interval_ms=10000, max_bytes=4)
+        coalescer.push({"text": "a"})
+        coalescer.push({"text": "жж"})
+        coalescer.push({"text": "b"})
+        coalescer.flush()
+        return emitted
+
+    # "жж" - 4 байта UTF-8
+    assert asyncio.run(run()) == [{"text": "a"}, {"text": "жж"}, {"text": "b"}]
+
+
+def test_coalescer_flushes_text_before_other_chunks():
+    async def run():
+        emitted = []
+        coalescer = TextChunkCoalescer(emitted.append, interval_ms=10000, max_bytes=1000)
+        coalescer.push({"text": "a"})
+        coalescer.push({"text": "b"})
+        coalescer.push({"text": "c"})
+        coalescer.push({"done": True, "message_id": 5})
+        # Таймер отменен, повторной отправки нет
+        await asyncio.sleep(0)
+        coalescer.flush()
+        return emitted
+
+    assert asyncio.run(run()) == [{"text": "a"}, {"text": "bc"}, {"done": True, "message_id": 5}]
+
+
+def test_coalescer_without_interval_passes_chunks_through():
+    emitted = []
+    coalescer = TextChunkCoalescer(emitted.append, interval_ms=0, max_bytes=1000)
+    for text in "abc":
+        coalescer.push({"text": text})
+    assert emitted == [{"text": "a"}, {"text": "b"}, {"text": "c"}]
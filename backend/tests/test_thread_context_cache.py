@@ -0,0 +1,136 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+from app.core.settings import settings
+from app.db.models import MessageOrm, ThreadOrm, ThreadSummaryOrm
+from app.services.thread_context_cache import ThreadContextCache
+from app.utils.token_counter import TOKENS_PER_MESSAGE
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setattr(ThreadContextCache, "_entries", OrderedDict())
+    monkeypatch.setattr(ThreadContextCache, "_loading", {})
+    monkeypatch.setattr(ThreadContextCache, "hits", 0)
+    monkeypatch.setattr(ThreadContextCache, "misses", 0)
+
+
+@pytest.fixture
+def thread(byte_encodings, session):
+    thread = ThreadOrm(user_id=1, title="Тред", provider_id=1, model_id=1, model_code="gpt-4o")
+    session.add(thread)
+    session.flush()
+    session.add_all([
+        MessageOrm(thread_id=thread.id, role="user", content="ab"),
+        MessageOrm(thread_id=thread.id, role="assistant", content="cde"),
+    ])
+    session.commit()
+    return thread
+
+
+@pytest.fixture
+def load(async_session):
+    def load(thread_id, on_execute=None):
+        return asyncio.run(ThreadContextCache.load(async_session(on_execute), thread_id))
+    return load
+
+
+def add_message(session, thread, content, role="user"):
+    message = MessageOrm(thread_id=thread.id, role=role, content=content)
+    session.add(message)
+    session.commit()
+    return message
+
+
+def test_load_caches_messages_with_cumulative_tokens(session, thread, load):
+    entry = load(thread.id)
+
+    assert [message.content for message in entry.messages] == ["ab", "cde"]
+    assert entry.cumulative_tokens == [2 + TOKENS_PER_MESSAGE, 5 + 2 * TOKENS_PER_MESSAGE]
+    assert ThreadContextCache.get(thread.id, entry.last_message_id) is entry
+    assert ThreadContextCache.get(thread.id, entry.last_message_id + 1) is None
+    assert (ThreadContextCache.hits, ThreadContextCache.misses) == (1, 1)
+
+
+def test_commit_extends_cached_thread(session, thread, load):
+    entry = load(thread.id)
+    message = add_message(session, thread, "fghi", role="assistant")
+
+    assert ThreadContextCache.get(thread.id, message.id) is entry
+    assert entry.messages[-1].content == "fghi"
+    assert entry.total_tokens == 9 + 3 * TOKENS_PER_MESSAGE
+
+
+def test_rollback_does_not_extend_cached_thread(session, thread, load):
+    entry = load(thread.id)
+    session.add(MessageOrm(thread_id=thread.id, role="user", content="lost"))
+    session.flush()
+    session.rollback()
+
+    assert len(entry.messages) == 2
+    assert ThreadContextCache.get(thread.id) is entry
+
+
+def test_edit_and_delete_invalidate_thread(session, thread, load):
+    load(thread.id)
+    message = session.query(MessageOrm).filter(MessageOrm.thread_id == thread.id).first()
+    message.content = "changed"
+    session.commit()
+    assert ThreadContextCache.get(thread.id) is None
+
+    load(thread.id)
+    session.delete(message)
+    session.commit()
+    assert ThreadContextCache.get(thread.id) is None
+
+
+def test_unrelated_message_changes_keep_entry(session, thread, load):
+    entry = load(thread.id)
+    message = session.query(MessageOrm).filter(MessageOrm.thread_id == thread.id).first()
+    message.is_cached = True
+    session.commit()
+    assert ThreadContextCache.get(thread.id) is entry
+
+
+def test_summary_change_invalidates_thread(session, thread, load):
+    load(thread.id)
+    session.add(ThreadSummaryOrm(thread_id=thread.id, content="summary", last_message_id=1))
+    session.commit()
+    assert ThreadContextCache.get(thread.id) is None
+
+    entry = load(thread.id)
+    assert entry.summary.content == "summary"
+
+
+def test_changes_during_load_are_not_cached(session, thread, load):
+    entry = load(thread.id, on_execute=lambda: ThreadContextCache.invalidate(thread.id))
+
+    assert [message.content for message in entry.messages] == ["ab", "cde"]
+    assert ThreadContextCache.get(thread.id) is None
+    assert ThreadContextCache._loading == {}
+
+
+def test_lru_eviction(monkeypatch, session, thread, load):
+    monkeypatch.setattr(settings, "THREAD_CONTEXT_CACHE_MAX_SIZE", 1)
+    other = ThreadOrm(user_id=1, title="Другой", provider_id=1, model_id=1, model_code="gpt-4o")
+    session.add(other)
+    session.commit()
+
+    load(thread.id)
+    load(other.id)
+
+    assert ThreadContextCache.get(thread.id) is None
+    assert ThreadContextCache.get(other.id) is not None
+
+
+def test_notifications_from_other_workers_invalidate(session, thread, load):
+    load(thread.id)
+    asyncio.run(ThreadContextCache.handle_change_notification(
+        {"origin": ThreadContextCache._origin, "thread_ids": [thread.id]}
+    ))
+    assert ThreadContextCache.get(thread.id) is not None
+
+    asyncio.run(ThreadContextCache.handle_change_notification({"origin": "other", "thread_ids": [thread.id]}))
+    assert ThreadContextCache.get(thread.id) is None
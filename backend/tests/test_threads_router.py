@@ -0,0 +1,148 @@
+import asyncio
+import importlib
+import json
+import sys
+import types
+from types import SimpleNamespace
+
+import pytest
+
+from app.core.settings import settings
+from app.services.generation_registry import GenerationRegistry
+
+
+class ThreadNotFoundException(Exception):
+    pass
+
+
+class AccessDeniedException(Exception):
+    pass
+
+
+@pytest.fixture
+def threads(monkeypatch):
+    """
+    Модуль роутера тредов с заменой сервисов тредов и сообщений.
+
+    ThreadService и MessageService подменяются модулями с теми же именами,
+    методы задаются в каждом тесте через monkeypatch.
+    """
+    thread_service = types.ModuleType("app.services.thread_service")
+    thread_service.ThreadService = type("ThreadService", (), {})
+    thread_service.ThreadNotFoundException = ThreadNotFoundException
+    thread_service.AccessDeniedException = AccessDeniedException
+    thread_service.CategoryNotFoundException = type("CategoryNotFoundException", (Exception,), {})
+
+    message_service = types.ModuleType("app.services.message_service")
+    message_service.MessageService = type("MessageService", (), {})
+    message_service.MessageServiceException = type("MessageServiceException", (Exception,), {})
+
+    monkeypatch.setitem(sys.modules, "app.services.thread_service", thread_service)
+    monkeypatch.setitem(sys.modules, "app.services.message_service", message_service)
+    monkeypatch.delitem(sys.modules, "app.routers.threads", raising=False)
+    module = importlib.import_module("app.routers.threads")
+    # Следующий импорт роутера должен получить настоящие сервисы
+    monkeypatch.delitem(sys.modules, "app.routers.threads")
+
+    monkeypatch.setattr(GenerationRegistry, "_generations", {})
+    monkeypatch.setattr(GenerationRegistry, "_buffer_bytes", 0)
+    monkeypatch.setattr(settings, "SSE_FLUSH_INTERVAL_MS", 0)
+    return module
+
+
+def parse(event):
+    return json.loads(event.strip().split("\n")[1][len("data: "):])
+
+
+def patch_services(threads, monkeypatch, thread, handle_stream_response, wait_seconds=0):
+    """Подменяет сервисы, к которым обращается потоковый эндпоинт; возвращает вызовы get_expected_wait."""
+    expected_wait_calls = []
+
+    async def get_thread_by_id(db, user_id, thread_id):
+        return thread
+
+    async def preflight(*args, **kwargs):
+        return None
+
+    class Service:
+        def get_expected_wait(self, messages, max_tokens):
+            expected_wait_calls.append((messages, max_tokens))
+            return wait_seconds
+
+    async def get_service_by_user_and_provider(db, user_id, provider_id):
+        assert provider_id == thread.provider_id
+        return Service()
+
+    monkeypatch.setattr(threads.ThreadService, "get_thread_by_id", get_thread_by_id, raising=False)
+    monkeypatch.setattr(threads.MessageService, "handle_stream_response", handle_stream_response, raising=False)
+    monkeypatch.setattr(threads.ContextBuilder, "preflight", preflight)
+    monkeypatch.setattr(
+        threads.AIServiceFactory, "get_service_by_user_and_provider", get_service_by_user_and_provider
+    )
+    monkeypatch.setattr(threads.ThreadSummarizer, "schedule", lambda thread_id, user_id: None)
+    return expected_wait_calls
+
+
+async def stream(threads, thread, db=None, timeout=120):
+    response = await threads.stream_message(
+        thread_id=thread.id,
+        message_data=threads.SendMessageRequestSchema(content="Привет", max_tokens=None),
+        background_tasks=None,
+        db=db,
+        current_user=SimpleNamespace(id=3),
+        use_context=True,
+        timeout=timeout,
+        last_event_id=None
+    )
+    return [parse(event) async for event in response.body_iterator]
+
+
+def test_stream_message_reports_queue_and_streams_answer(threads, monkeypatch):
+    thread = SimpleNamespace(id=10, provider_id=1, model_id=1, model_code="gpt-4o", max_tokens=500)
+    stream_calls = []
+
+    async def handle_stream_response(**kwargs):
+        stream_calls.append(kwargs)
+        yield {"text": "Привет"}
+        yield {"done": True, "message_id": 5}
+
+    expected_wait_calls = patch_services(threads, monkeypatch, thread, handle_stream_response, wait_seconds=2.04)
+
+    events = asyncio.run(stream(threads, thread))
+
+    assert events == [
+        {"queued": True, "wait_seconds": 2.0},
+        {"text": "Привет"},
+        {"done": True, "message_id": 5},
+    ]
+    # Без max_tokens в запросе используется значение треда
+    assert expected_wait_calls == [([{"role": "user", "content": "Привет"}], 500)]
+    assert stream_calls[0]["thread_id"] == thread.id
+    assert stream_calls[0]["timeout"] == 120
+
+
+def test_stream_message_stops_generation_after_timeout(threads, monkeypatch):
+    thread = SimpleNamespace(id=10, provider_id=1, model_id=1, model_code="gpt-4o", max_tokens=500)
+    saved_errors = []
+
+    async def handle_stream_response(**kwargs):
+        yield {"text": "Прив"}
+        await asyncio.sleep(10)
+        yield {"text": "ет"}
+
+    async def save_error_message(**kwargs):
+        saved_errors.append(kwargs)
+
+    class Db:
+        async def execute(self, statement):
+            return SimpleNamespace(scalar_one_or_none=lambda: thread)
+
+    patch_services(threads, monkeypatch, thread, handle_stream_response)
+    monkeypatch.setattr(threads.MessageService, "save_error_message", save_error_message, raising=False)
+
+    events = asyncio.run(stream(threads, thread, db=Db(), timeout=0.05))
+
+    assert events[0] == {"text": "Прив"}
+    assert events[1]["error"] is True
+    assert "таймаут" in events[1]["error_message"]
+    assert saved_errors[0]["error_type"] == "stream_error"
@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+from pydantic import ValidationError
+
+from app.core.settings import settings
+from app.db.models import MessageOrm, ThreadOrm
+from app.schemas.thread import TokenCountBatchRequestSchema
+from app.utils import token_counter
+from app.utils.token_counter import (
+    TokenizerRegistry, count_context_tokens, count_tokens_batch, get_message_tokens, store_message_tokens,
+    TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+)
+
+SPECIAL = "<|endoftext|>"
+
+
+class Message:
+    def __init__(self, content, content_tokens=None, tokens_encoding=None):
+        self.content = content
+        self.content_tokens = content_tokens
+        self.tokens_encoding = tokens_encoding
+
+
+def test_count_tokens_treats_special_tokens_as_text(byte_encodings):
+    assert TokenizerRegistry.count_tokens(f"a {SPECIAL}", "gpt-4o") == 2 + len(SPECIAL)
+
+
+def test_count_tokens_batch(byte_encodings):
+    assert TokenizerRegistry.count_tokens_batch(["ab", "", SPECIAL], "gpt-4o") == [2, 0, len(SPECIAL)]
+    assert TokenizerRegistry.count_tokens_batch([], "gpt-4o") == []
+
+
+def test_count_messages_batch_adds_chat_overhead(byte_encodings):
+    conversations = [
+        [{"role": "system", "content": "ab"}, {"role": "user", "content": "cde"}],
+        [{"role": "user", "content": ""}],
+    ]
+    assert TokenizerRegistry.count_messages_batch(conversations, "gpt-4o") == [
+        5 + 2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY,
+        TOKENS_PER_MESSAGE + TOKENS_PER_REPLY,
+    ]
+
+
+def test_store_message_tokens_with_special_tokens(byte_encodings):
+    message = Message(f"hi {SPECIAL}")
+    assert store_message_tokens(message, "gpt-4o") == 3 + len(SPECIAL)
+    assert message.tokens_encoding == "o200k_base"
+
+
+def test_get_message_tokens_reuses_count_of_same_encoding(byte_encodings):
+    message = Message("abc", content_tokens=100, tokens_encoding="o200k_base")
+    assert get_message_tokens(message, "gpt-4o") == 100
+    # Другая кодировка - пересчет
+    assert get_message_tokens(message, "gpt-4") == 3
+    assert message.tokens_encoding == "cl100k_base"
+
+
+def test_count_context_tokens(byte_encodings):
+    messages = [Message("ab", 2, "o200k_base"), Message("cde", 3, "o200k_base")]
+    assert count_context_tokens(messages, "gpt-4o") == 5 + 2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+
+
+def test_user_message_is_counted_with_thread_model(byte_encodings, session):
+    thread = ThreadOrm(user_id=1, title="Тред", provider_id=1, model_id=1, model_code="gpt-4o")
+    session.add(thread)
+    session.flush()
+
+    message = MessageOrm(thread_id=thread.id, role="user", content=f"hi {SPECIAL}")
+    session.add(message)
+    session.flush()
+
+    assert message.content_tokens == 3 + len(SPECIAL)
+    assert message.tokens_encoding == "o200k_base"
+
+
+def test_user_message_model_is_loaded_when_thread_not_in_session(byte_encodings, session):
+    thread = ThreadOrm(user_id=1, title="Тред", provider_id=1, model_id=1, model_code="gpt-4o")
+    session.add(thread)
+    session.commit()
+    thread_id = thread.id
+    session.expunge_all()
+
+    message = MessageOrm(thread_id=thread_id, role="user", content="hi")
+    session.add(message)
+    session.flush()
+
+    assert message.tokens_encoding == "o200k_base"
+
+
+@pytest.fixture
+def offloads(monkeypatch):
+    calls = []
+    to_thread = asyncio.to_thread
+
+    async def record(function, *args):
+        calls.append(function)
+        return await to_thread(function, *args)
+
+    monkeypatch.setattr(token_counter.asyncio, "to_thread", record)
+    monkeypatch.setattr(settings, "TOKEN_COUNT_OFFLOAD_CHARS", 10)
+    return calls
+
+
+def test_async_batch_counts_small_input_inline(byte_encodings, offloads):
+    result = asyncio.run(count_tokens_batch(["ab"], [[{"role": "user", "content": "cde"}]], "gpt-4o"))
+
+    assert result == {"texts": [2], "conversations": [3 + TOKENS_PER_MESSAGE + TOKENS_PER_REPLY]}
+    assert offloads == []
+
+
+def test_async_batch_offloads_large_input(byte_encodings, offloads):
+    result = asyncio.run(count_tokens_batch(["a" * 6], [[{"role": "user", "content": "b" * 6}]], "gpt-4o"))
+
+    assert result == {"texts": [6], "conversations": [6 + TOKENS_PER_MESSAGE + TOKENS_PER_REPLY]}
+    assert len(offloads) == 1
+
+
+def test_batch_request_requires_items_within_limit(monkeypatch):
+    monkeypatch.setattr(settings, "TOKEN_COUNT_BATCH_MAX_ITEMS", 2)
+
+    TokenCountBatchRequestSchema(texts=["a"], messages=[[{"role": "user", "content": "b"}]], model_preferences_id=1)
+    with pytest.raises(ValidationError):
+        TokenCountBatchRequestSchema(model_preferences_id=1)
+    with pytest.raises(ValidationError):
+        TokenCountBatchRequestSchema(texts=["a", "b", "c"], model_preferences_id=1)
+    with pytest.raises(ValidationError):
+        TokenCountBatchRequestSchema(texts=["a"], provider_id=1)
@@ -0,0 +1,122 @@
+import random
+
+import pytest
+
+from app.core.settings import settings
+from app.services.context_builder import ContextBuilder
+from app.services.token_estimator import (
+    COMMON_RATIOS_KEY, DEFAULT_RATIOS, ESTIMATE_ENCODING_PREFIX, SCRIPTS, TokenEstimator
+)
+from app.utils.token_counter import get_message_tokens
+
+RATIOS = {"latin": 0.3, "cyrillic": 0.5, "cjk": 1.2, "digit": 0.2, "space": 0.1, "other": 0.7}
+
+
+def make_samples(ratios, scripts, count=300, seed=1):
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(count):
+        counts = {script: 0 for script in SCRIPTS}
+        for script in scripts:
+            counts[script] = rng.randint(0, 500)
+        tokens = round(sum(ratios[script] * counts[script] for script in SCRIPTS))
+        samples.append((counts, tokens))
+    return samples
+
+
+def test_count_scripts():
+    assert TokenEstimator.count_scripts("Ab Бв 12 漢字!") == {
+        "latin": 2, "cyrillic": 2, "cjk": 2, "digit": 2, "space": 3, "other": 1,
+    }
+
+
+def test_fit_ratios_recovers_known_ratios(monkeypatch):
+    # Слабый псевдопример почти не смещает коэффициенты к значениям по умолчанию
+    monkeypatch.setattr(settings, "TOKEN_ESTIMATOR_PRIOR_CHARS", 1)
+    samples = make_samples(RATIOS, SCRIPTS)
+    ratios, count, chars = TokenEstimator.fit_ratios(samples)
+
+    assert count == len(samples)
+    assert chars == sum(sum(counts.values()) for counts, _ in samples)
+    for script in SCRIPTS:
+        assert ratios[script] == pytest.approx(RATIOS[script], abs=0.02)
+
+
+def test_fit_ratios_keeps_defaults_for_unseen_scripts():
+    ratios, _, _ = TokenEstimator.fit_ratios(make_samples(RATIOS, ["latin", "space"]))
+
+    assert ratios["latin"] == pytest.approx(RATIOS["latin"], abs=0.02)
+    for script in ("cyrillic", "cjk", "digit", "other"):
+        assert ratios[script] == DEFAULT_RATIOS[script]
+
+
+def test_fit_ratios_are_non_negative():
+    # Без ограничения коэффициент пробелов получился бы отрицательным
+    ratios, _, _ = TokenEstimator.fit_ratios(
+        make_samples({**RATIOS, "space": -0.5}, ["latin", "space"])
+    )
+    assert all(value >= 0 for value in ratios.values())
+    assert ratios["space"] == 0
+
+
+def test_fit_ratios_skips_empty_samples():
+    ratios, count, chars = TokenEstimator.fit_ratios([({script: 0 for script in SCRIPTS}, 5)])
+    assert (count, chars) == (0, 0)
+    assert ratios == DEFAULT_RATIOS
+
+
+def test_estimate_uses_model_then_common_ratios(monkeypatch):
+    monkeypatch.setattr(TokenEstimator, "_ratios", {
+        "claude-3-opus": {**DEFAULT_RATIOS, "latin": 1.0},
+        COMMON_RATIOS_KEY: {**DEFAULT_RATIOS, "latin": 0.5},
+    })
+    assert TokenEstimator.estimate("abcd", "claude-3-opus") == 4
+    assert TokenEstimator.estimate("abcd", "claude-3-haiku") == 2
+    assert TokenEstimator.estimate("", "claude-3-opus") == 0
+
+
+class Message:
+    def __init__(self, content, content_tokens=None, tokens_encoding=None):
+        self.content = content
+        self.content_tokens = content_tokens
+        self.tokens_encoding = tokens_encoding
+
+
+def test_get_message_tokens_estimated_replaces_tiktoken_count(monkeypatch):
+    monkeypatch.setattr(TokenEstimator, "_ratios", {})
+    message = Message("<|endoftext|> " * 10, content_tokens=1, tokens_encoding="cl100k_base")
+
+    assert get_message_tokens(message, "claude-3-opus", estimated=True) == \
+        TokenEstimator.estimate(message.content, "claude-3-opus")
+    assert message.content_tokens == TokenEstimator.estimate(message.content, "claude-3-opus")
+    assert message.tokens_encoding == TokenEstimator.get_encoding_tag("claude-3-opus")
+    assert message.tokens_encoding.startswith(ESTIMATE_ENCODING_PREFIX)
+
+
+def test_get_message_tokens_estimated_reuses_count_until_ratios_change(monkeypatch):
+    monkeypatch.setattr(TokenEstimator, "_ratios", {})
+    message = Message("hello world")
+    first = get_message_tokens(message, "claude-3-opus", estimated=True)
+
+    # Сохраненная оценка используется без пересчета
+    message.content = "hello world " * 100
+    assert get_message_tokens(message, "claude-3-opus", estimated=True) == first
+
+    # Другие коэффициенты дают другую метку, оценка пересчитывается
+    monkeypatch.setattr(TokenEstimator, "_ratios", {"claude-3-opus": RATIOS})
+    assert get_message_tokens(message, "claude-3-opus", estimated=True) == \
+        TokenEstimator.estimate(message.content, "claude-3-opus")
+    assert message.tokens_encoding == TokenEstimator.get_encoding_tag("claude-3-opus")
+
+
+def test_truncate_estimated_keeps_end_within_limit(monkeypatch):
+    monkeypatch.setattr(TokenEstimator, "_ratios", {})
+    text = "начало " + "слово " * 500 + "конец"
+
+    truncated = ContextBuilder.truncate(text, 100, "claude-3-opus", estimated=True)
+
+    assert text.endswith(truncated)
+    assert truncated.endswith("конец")
+    assert 0 < TokenEstimator.estimate(truncated, "claude-3-opus") <= 100
+    assert ContextBuilder.truncate(text, 0, "claude-3-opus", estimated=True) == ""
+    assert ContextBuilder.truncate("abc", 100, "claude-3-opus", estimated=True) == "abc"
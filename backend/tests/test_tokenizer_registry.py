@@ -0,0 +1,68 @@
+import threading
+
+import pytest
+import tiktoken
+
+from app.utils.token_counter import DEFAULT_ENCODING, TokenizerRegistry
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """Подсчет загрузок кодировок; BPE файлы заменены побайтовой кодировкой"""
+    monkeypatch.setattr(TokenizerRegistry, "_encodings", {})
+    monkeypatch.setattr(TokenizerRegistry, "_model_encodings", {})
+    monkeypatch.setattr(TokenizerRegistry, "_load_times", {})
+    calls = []
+
+    def get_encoding(name):
+        calls.append(name)
+        if name == "broken":
+            raise OSError("нет сети")
+        return tiktoken.Encoding(
+            name=name, pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={}
+        )
+
+    monkeypatch.setattr(tiktoken, "get_encoding", get_encoding)
+    return calls
+
+
+def test_encoding_name_for_known_and_unknown_models(loads):
+    assert TokenizerRegistry.get_encoding_name("gpt-4o") == "o200k_base"
+    assert TokenizerRegistry.get_encoding_name("gpt-4") == "cl100k_base"
+    assert TokenizerRegistry.get_encoding_name("claude-3-opus") == DEFAULT_ENCODING
+    assert TokenizerRegistry.get_stats()["models"] == {
+        "gpt-4o": "o200k_base", "gpt-4": "cl100k_base", "claude-3-opus": DEFAULT_ENCODING,
+    }
+
+
+def test_encoding_is_loaded_once(loads):
+    first = TokenizerRegistry.get_encoding("gpt-4o")
+    assert TokenizerRegistry.get_encoding("gpt-4o-mini") is first
+    assert loads == ["o200k_base"]
+    assert "o200k_base" in TokenizerRegistry.get_stats()["encodings"]
+
+
+def test_concurrent_first_use_loads_once(loads):
+    threads = [threading.Thread(target=TokenizerRegistry.get_encoding, args=("gpt-4",)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == ["cl100k_base"]
+
+
+def test_warm_up_loads_encodings_of_models_and_default(loads):
+    TokenizerRegistry.warm_up(["gpt-4o", "gpt-4o-mini", "claude-3-opus"])
+
+    assert sorted(loads) == ["cl100k_base", "o200k_base"]
+    TokenizerRegistry.count_tokens("abc", "gpt-4o")
+    assert len(loads) == 2
+
+
+def test_warm_up_survives_failed_load(loads):
+    TokenizerRegistry._model_encodings["custom-model"] = "broken"
+
+    TokenizerRegistry.warm_up(["custom-model", "gpt-4"])
+
+    assert "broken" in loads
+    assert set(TokenizerRegistry._encodings) == {"cl100k_base"}